@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+
+from viewer.asgi import StreamingASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dropboxviewer.settings')
 
-application = get_asgi_application()
+# Like django.core.asgi.get_asgi_application(), but able to send the
+# responses streamed by the async views
+django.setup(set_prefix=False)
+application = StreamingASGIHandler()
@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'viewer.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -56,8 +57,15 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Templates are compiled once per process, so changes to them
+            # need a restart, even with DEBUG
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -123,3 +131,88 @@ STATIC_URL = '/static/'
 # Custom settings
 DROPBOX_APP_KEY = 'bgoij6ipeipwsk1'
 
+# Maximum number of entries displayed in each page of a folder listing
+VIEWER_PAGE_SIZE = 1000
+
+# Maximum number of entries in each page of the JSON API (viewer/api/folder)
+VIEWER_API_MAX_LIMIT = 10000
+
+# Cache (one of CACHES) where the rendered listing of each version of a
+# folder is kept, or None to render listings on every request
+VIEWER_FRAGMENT_CACHE = 'default'
+
+# Folder where downloaded files are cached (None disables the cache), the
+# maximum size of the cache, and of each file in it, in bytes, and how many
+# seconds a download waits for the same file being cached by another one
+DROPBOX_CONTENT_CACHE_DIR = BASE_DIR / 'cache'
+DROPBOX_CONTENT_CACHE_SIZE = 1024 * 1024 * 1024
+DROPBOX_CONTENT_CACHE_MAX_FILE = 64 * 1024 * 1024
+DROPBOX_CONTENT_CACHE_WAIT = 30
+
+
+# Serve folders, downloads, uploads and new folders with async views, which
+# require running the ASGI application (dropboxviewer.asgi)
+VIEWER_ASYNC_VIEWS = False
+
+# Update open folder pages as their contents change, through a stream of
+# Server-Sent Events (viewer/events). Each open page holds one stream, which
+# takes a whole worker thread unless served by the async views
+VIEWER_LIVE_UPDATES = VIEWER_ASYNC_VIEWS
+
+# How files are downloaded: 'proxy' relays them through the app, while
+# 'redirect' sends clients to a temporary Dropbox link, for files with at
+# least DROPBOX_REDIRECT_MIN_SIZE bytes or one of DROPBOX_REDIRECT_EXTENSIONS
+DROPBOX_DOWNLOAD_MODE = 'proxy'
+DROPBOX_REDIRECT_MIN_SIZE = 16 * 1024 * 1024
+DROPBOX_REDIRECT_EXTENSIONS = ['.mp4', '.mov', '.iso']
+
+# Calls to Dropbox are limited to DROPBOX_RATE_LIMIT per second for each
+# account (None disables the limit), in bursts of up to DROPBOX_RATE_BURST.
+# Failed calls are retried up to DROPBOX_RETRIES times, and all calls stop
+# for DROPBOX_BREAKER_RESET seconds after DROPBOX_BREAKER_THRESHOLD failures
+# in a row
+DROPBOX_RATE_LIMIT = 50
+DROPBOX_RATE_BURST = 100
+DROPBOX_RETRIES = 4
+DROPBOX_BREAKER_THRESHOLD = 5
+DROPBOX_BREAKER_RESET = 30
+
+# Files of at least DROPBOX_PARALLEL_DOWNLOAD_MIN_SIZE bytes are downloaded
+# from Dropbox in parts of DROPBOX_DOWNLOAD_PART_SIZE bytes, over up to
+# DROPBOX_DOWNLOAD_WORKERS connections at once (1 disables it)
+DROPBOX_DOWNLOAD_WORKERS = 4
+DROPBOX_DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+DROPBOX_PARALLEL_DOWNLOAD_MIN_SIZE = 32 * 1024 * 1024
+
+# Keep the size of every folder, and the names looked up by searches, in an
+# index of each account, built in the background by listing the whole
+# account, and then updated with its changes
+DROPBOX_TREE_INDEX = False
+
+# Threads that run bulk copies, moves and deletions in the background, for
+# all accounts; each job waits for Dropbox most of the time. Jobs fail if a
+# batch of them is not finished by Dropbox within DROPBOX_BATCH_TIMEOUT
+# seconds, and each account runs one job at a time
+DROPBOX_JOB_WORKERS = 2
+DROPBOX_BATCH_TIMEOUT = 600
+
+# Measure requests and Dropbox calls: VIEWER_METRICS serves the counters for
+# Prometheus on viewer/metrics, to INTERNAL_IPS and staff users only,
+# VIEWER_SERVER_TIMING adds a Server-Timing header to responses, and
+# VIEWER_REQUEST_LOG logs a JSON line for each request to the
+# 'viewer.requests' logger
+VIEWER_METRICS = False
+INTERNAL_IPS = ['127.0.0.1']
+VIEWER_SERVER_TIMING = True
+VIEWER_REQUEST_LOG = False
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'viewer.requests': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
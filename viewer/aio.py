@@ -0,0 +1,612 @@
+import asyncio
+import json
+from collections import deque
+from heapq import nsmallest
+from weakref import WeakKeyDictionary
+
+import httpx
+from asgiref.sync import sync_to_async
+from dropbox import files
+from dropbox.auth import AuthError_validator
+from dropbox.exceptions import (
+    ApiError, AuthError, BadInputError, HttpError, InternalServerError,
+    RateLimitError,
+)
+from dropbox.session import (
+    API_CONTENT_HOST, API_HOST, API_NOTIFICATION_HOST,
+)
+from dropbox.stone_serializers import json_compat_obj_decode, json_encode
+
+from .dropbox import (
+    DropBoxStorage, DropBoxStorageException, _correct_offset, setting,
+)
+from .metrics import CallTimer, record_retry, record_transfer
+from .scheduler import CallScheduler
+from .wrapper import DropboxMetaFile, FolderListing
+
+_DEFAULT_ASYNC_POOL_SIZE = 100
+
+_HOSTS = {
+    'api': API_HOST,
+    'content': API_CONTENT_HOST,
+    'notify': API_NOTIFICATION_HOST,
+}
+
+_clients = WeakKeyDictionary()
+
+# ----------------------------------------------------------------------------
+def get_http_client():
+    '''Return the httpx client shared by all requests in this event loop.
+
+    Connections cannot be shared among event loops, so each loop has its
+    own pool, of settings.DROPBOX_ASYNC_POOL_SIZE connections.
+    '''
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        size = setting('DROPBOX_ASYNC_POOL_SIZE', _DEFAULT_ASYNC_POOL_SIZE)
+        client = httpx.AsyncClient(
+                timeout=DropBoxStorage.timeout,
+                limits=httpx.Limits(max_connections=size,
+                                    max_keepalive_connections=size))
+        _clients[loop] = client
+    return client
+
+
+# ----------------------------------------------------------------------------
+class AsyncDropbox:
+    '''Asynchronous client for the Dropbox API routes used by the viewer.
+
+    It follows the Dropbox SDK: arguments and results are the SDK's own
+    objects (e.g., dropbox.files.FileMetadata), and failures raise the same
+    exceptions from dropbox.exceptions. Calls are sent by a CallScheduler,
+    which retries rate limits, server errors and failed connections without
+    blocking the event loop.
+
+    Parameters:
+    access_token : the OAuth2 access token
+    http_client  : the httpx.AsyncClient that sends the requests
+    scheduler    : the CallScheduler of the account; by default, calls
+                   are only retried
+    '''
+
+    # ........................................................................
+    def __init__(self, access_token, http_client, scheduler=None):
+        self.access_token = access_token
+        self.http_client = http_client
+        self.scheduler = scheduler or CallScheduler()
+
+    # ........................................................................
+    def _endpoint(self, route):
+        '''Return the name of a route of the files namespace, as in URLs.'''
+        name = route.name
+        if route.version > 1:
+            name += f'_v{route.version}'
+        return f'files/{name}'
+
+    # ........................................................................
+    def _build_request(self, route, arg, body, headers):
+        '''Build the HTTP request that calls a route of the files namespace.'''
+        host = _HOSTS[route.attrs['host'] or 'api']
+        style = route.attrs['style'] or 'rpc'
+        request_headers = {}
+        if route.attrs['auth'] != 'noauth':
+            request_headers['Authorization'] = f'Bearer {self.access_token}'
+        request_headers.update(headers or {})
+        serialized_arg = json_encode(route.arg_type, arg)
+        if style == 'rpc':
+            request_headers['Content-Type'] = 'application/json'
+            body = serialized_arg.encode()
+        else:
+            request_headers['Dropbox-API-Arg'] = serialized_arg
+            if style == 'upload':
+                request_headers['Content-Type'] = 'application/octet-stream'
+        return self.http_client.build_request('POST',
+                f'https://{host}/2/{self._endpoint(route)}',
+                headers=request_headers, content=body)
+
+    # ........................................................................
+    async def request(self, route, arg, body=None, headers=None,
+                      timeout=None):
+        '''Call a route and return its result.
+
+        Download routes return a (result, response) tuple instead, whose
+        response body was not read yet; the response must be closed.
+
+        Parameters:
+        route   : a route from dropbox.files (e.g., dropbox.files.download)
+        arg     : the route's argument
+        body    : the bytes sent by upload routes
+        headers : extra HTTP headers (e.g., Range)
+        timeout : the seconds to wait for Dropbox, if not the client's
+        '''
+        endpoint = self._endpoint(route)
+        attempts = []
+
+        async def attempt():
+            if attempts:
+                record_retry(endpoint)
+            attempts.append(endpoint)
+            return await self._send(route, arg, body, headers, timeout)
+        return await self.scheduler.acall(attempt)
+
+    # ........................................................................
+    async def _send(self, route, arg, body, headers, timeout=None):
+        '''Send a single request, measured; see request().'''
+        options = {} if timeout is None else {'timeout': timeout}
+        with CallTimer(self._endpoint(route), len(body or b'')) as timer:
+            response = await self.http_client.send(
+                    self._build_request(route, arg, body, headers),
+                    stream=True, **options)
+            result = await self._result(route, response)
+            if route.attrs['style'] != 'download':
+                timer.received = len(response.content)
+        return result
+
+    # ........................................................................
+    async def _result(self, route, response):
+        '''Decode the result of a route, or raise its error.'''
+        download = route.attrs['style'] == 'download'
+        status = response.status_code
+        if not download or not 200 <= status <= 299:
+            await response.aread()
+            await response.aclose()
+        request_id = response.headers.get('x-dropbox-request-id')
+        if status >= 500:
+            raise InternalServerError(request_id, status, response.text)
+        if status == 400:
+            raise BadInputError(request_id, response.text)
+        if status == 401:
+            error = json_compat_obj_decode(AuthError_validator,
+                    response.json()['error'])
+            raise AuthError(request_id, error)
+        if status == 429:
+            retry_after = response.headers.get('retry-after')
+            raise RateLimitError(request_id, None,
+                    int(retry_after) if retry_after else None)
+        if status in (403, 404, 409):
+            content = response.json()
+            error = json_compat_obj_decode(route.error_type,
+                    content['error'], strict=False)
+            message = content.get('user_message') or {}
+            raise ApiError(request_id, error, message.get('text'),
+                    message.get('locale'))
+        if not 200 <= status <= 299:
+            raise HttpError(request_id, status, response.text)
+        if download:
+            result = json.loads(response.headers['dropbox-api-result'])
+            return json_compat_obj_decode(route.result_type, result,
+                    strict=False), response
+        return json_compat_obj_decode(route.result_type, response.json(),
+                strict=False)
+
+    # ........................................................................
+    async def files_list_folder(self, path):
+        return await self.request(files.list_folder,
+                files.ListFolderArg(path))
+
+    # ........................................................................
+    async def files_list_folder_continue(self, cursor):
+        return await self.request(files.list_folder_continue,
+                files.ListFolderContinueArg(cursor))
+
+    # ........................................................................
+    async def files_list_folder_get_latest_cursor(self, path):
+        return await self.request(files.list_folder_get_latest_cursor,
+                files.ListFolderArg(path))
+
+    # ........................................................................
+    async def files_list_folder_longpoll(self, cursor, timeout=30):
+        # Dropbox may hold the call for up to 90 more seconds
+        return await self.request(files.list_folder_longpoll,
+                files.ListFolderLongpollArg(cursor, timeout),
+                timeout=timeout + 90 + DropBoxStorage.timeout)
+
+    # ........................................................................
+    async def files_get_metadata(self, path):
+        return await self.request(files.get_metadata,
+                files.GetMetadataArg(path))
+
+    # ........................................................................
+    async def files_download(self, path, byte_range=None):
+        headers = None
+        if byte_range is not None:
+            start, end = byte_range
+            headers = {'Range': f"bytes={start}-{'' if end is None else end}"}
+        return await self.request(files.download, files.DownloadArg(path),
+                headers=headers)
+
+    # ........................................................................
+    async def files_get_temporary_link(self, path):
+        return await self.request(files.get_temporary_link,
+                files.GetTemporaryLinkArg(path))
+
+    # ........................................................................
+    async def files_upload(self, data, commit):
+        return await self.request(files.upload, commit, data)
+
+    # ........................................................................
+    async def files_upload_session_start(self, data):
+        return await self.request(files.upload_session_start,
+                files.UploadSessionStartArg(), data)
+
+    # ........................................................................
+    async def files_upload_session_append_v2(self, data, cursor):
+        return await self.request(files.upload_session_append_v2,
+                files.UploadSessionAppendArg(cursor), data)
+
+    # ........................................................................
+    async def files_upload_session_finish(self, data, cursor, commit):
+        return await self.request(files.upload_session_finish,
+                files.UploadSessionFinishArg(cursor, commit), data)
+
+    # ........................................................................
+    async def files_create_folder_v2(self, path):
+        return await self.request(files.create_folder_v2,
+                files.CreateFolderArg(path))
+
+
+# ----------------------------------------------------------------------------
+class AsyncDropboxFile:
+    '''A Dropbox file being downloaded, read through an async iterator.
+
+    Given the client and storage it comes from, a large file is downloaded
+    in parts (see DropBoxStorage.download_parts): the first one is read
+    from the response, while the next ones are downloaded at once, by up to
+    storage.download_workers connections, and held until their turn comes.
+
+    Attributes:
+    metadata   : the file's Dropbox metadata
+    size       : the number of bytes that will be read
+    byte_range : the (start, end) tuple of the bytes read, or None
+    '''
+
+    # ........................................................................
+    def __init__(self, metadata, response, byte_range=None, client=None,
+                 storage=None):
+        self.metadata = metadata
+        self.byte_range = byte_range
+        self.size = metadata.size
+        if byte_range is not None:
+            start, end = byte_range
+            if end is None or end >= metadata.size:
+                end = metadata.size - 1
+            self.size = end - start + 1
+        self._response = response
+        self._client = client
+        self._parts = None
+        if client is not None and storage is not None:
+            self._parts = storage.download_parts(
+                    byte_range[0] if byte_range is not None else 0, self.size)
+            self._workers = storage.download_workers
+
+    # ........................................................................
+    async def chunks(self):
+        '''Yield the file's bytes as they arrive from Dropbox.'''
+        if self._parts is None:
+            async for data in self._iter_response():
+                yield data
+            return
+        path = 'rev:' + self.metadata.rev
+        pending = deque()
+        remaining = iter(self._parts[1:])
+
+        def submit():
+            part = next(remaining, None)
+            if part is not None:
+                pending.append(asyncio.ensure_future(
+                        self._download_part(path, part)))
+        try:
+            for i in range(self._workers - 1):
+                submit()
+            start, end = self._parts[0]
+            async for data in self._iter_response(end - start + 1):
+                yield data
+            submit()
+            while pending:
+                data = await pending.popleft()
+                submit()
+                for offset in range(0, len(data),
+                                    DropBoxStorage.STREAM_CHUNK_SIZE):
+                    yield data[offset:
+                               offset + DropBoxStorage.STREAM_CHUNK_SIZE]
+        finally:
+            for task in pending:
+                task.cancel()
+            await self._response.aclose()
+
+    # ........................................................................
+    async def _iter_response(self, limit=None):
+        '''Yield the bytes of the response, up to limit.'''
+        received = 0
+        try:
+            async for data in self._response.aiter_bytes():
+                if limit is not None and received + len(data) >= limit:
+                    data = data[:limit - received]
+                    received += len(data)
+                    yield data
+                    break
+                received += len(data)
+                yield data
+        finally:
+            record_transfer('files/download', received=received)
+            await self._response.aclose()
+
+    # ........................................................................
+    async def _download_part(self, path, part):
+        '''Return the bytes in the part (start, end) range of a file.'''
+        start, end = part
+        metadata, response = await self._client.files_download(path, part)
+        try:
+            data = await response.aread()
+        finally:
+            await response.aclose()
+        if response.status_code != 206:
+            data = b''
+        record_transfer('files/download', received=len(data))
+        if len(data) != end - start + 1:
+            raise DropBoxStorageException(
+                    f'Dropbox server returned a {response.status_code} '
+                    f'response with {len(data)} bytes when accessing '
+                    f'bytes {start}-{end} of {path}')
+        return data
+
+
+# ----------------------------------------------------------------------------
+class AsyncDropboxWrapper:
+    '''Asynchronous counterpart of DropboxWrapper, for the async views.
+
+    It shares the account, the listing cache and the settings of the given
+    DropboxWrapper, but calls Dropbox through AsyncDropbox, so that waiting
+    for Dropbox never holds a thread.
+
+    Parameter:
+    dropbox : the DropboxWrapper of a connected account
+    '''
+
+    # ........................................................................
+    def __init__(self, dropbox):
+        self.dropbox = dropbox
+        self.storage = dropbox.storage
+        self.client = AsyncDropbox(dropbox.access_token, get_http_client(),
+                self.storage.scheduler)
+        # Some listing caches (e.g., the database) must not be used from
+        # the event loop
+        self._expire_listing = sync_to_async(dropbox._expire_listing,
+                thread_sensitive=False)
+        listings = dropbox.listings
+        if listings is not None:
+            self._get_listing = sync_to_async(listings.get,
+                    thread_sensitive=False)
+            self._set_listing = sync_to_async(listings.set,
+                    thread_sensitive=False)
+
+    # ........................................................................
+    def _full_path(self, name):
+        full_path = self.storage._full_path(name)
+        return '' if full_path == '/' else full_path
+
+    # ........................................................................
+    async def list_pages(self, path, cursor=None):
+        '''Yield the result pages of a folder listing; see
+        DropBoxStorage.list_pages.'''
+        if cursor is None:
+            result = await self.client.files_list_folder(
+                    self._full_path(path))
+        else:
+            result = await self.client.files_list_folder_continue(cursor)
+        yield result
+        while result.has_more:
+            result = await self.client.files_list_folder_continue(
+                    result.cursor)
+            yield result
+
+    # ........................................................................
+    async def _scan_folder(self, path):
+        '''Return the metadata of the entries in a folder; see
+        DropboxWrapper._scan_folder.'''
+        if self.dropbox.listings is None:
+            return [metadata async for result in self.list_pages(path)
+                    for metadata in result.entries]
+        return (await self._folder_listing(path)).entries.values()
+
+    # ........................................................................
+    async def _folder_listing(self, path):
+        '''Return the FolderListing of a folder, from the listing cache; see
+        DropboxWrapper._folder_listing.'''
+        key = self.dropbox._listing_key(path)
+        listing = await self._get_listing(key)
+        if listing is not None and \
+                self.dropbox.removed_since(path, listing.checked):
+            listing = None
+        if listing is not None and self.dropbox.is_current(listing, key):
+            return listing
+        if listing is not None:
+            try:
+                listing = listing.apply([result async for result in
+                        self.list_pages(path, listing.cursor)])
+            except ApiError as e:
+                if not e.error.is_reset():
+                    raise
+                listing = None
+        if listing is None:
+            listing = FolderListing().apply(
+                    [result async for result in self.list_pages(path)])
+        await self._set_listing(key, listing)
+        return listing
+
+    # ........................................................................
+    async def folder_version(self, path):
+        '''Return a string that changes whenever the listing of a folder
+        changes, or None; see DropboxWrapper.folder_version.'''
+        if self.dropbox.listings is None:
+            return None
+        version = (await self._folder_listing(path)).version
+        if version is None:
+            return None
+        index = self.dropbox.index
+        if index is not None:
+            index.refresh()
+            version += f'.{index.version}'
+        return version
+
+    # ........................................................................
+    async def listdir(self, path, offset=0, limit=None):
+        '''List all files and directories in the given path; see
+        DropboxWrapper.listdir.'''
+        entries = await self._scan_folder(path)
+        key = DropboxMetaFile.sort_key
+        if limit is None:
+            entries = sorted(entries, key=key)[offset:]
+        else:
+            entries = nsmallest(offset + limit, entries, key=key)[offset:]
+        entries = [DropboxMetaFile(metadata) for metadata in entries]
+        self.dropbox.check_links(entries)
+        return self.dropbox.add_folder_sizes(entries)
+
+    # ........................................................................
+    def prefetch_thumbnails(self, entries):
+        '''Start fetching the thumbnails of images in the background; see
+        DropboxWrapper.prefetch_thumbnails.'''
+        self.dropbox.prefetch_thumbnails(entries)
+
+    # ........................................................................
+    async def get_metadata(self, name):
+        '''Obtain the Dropbox metadata of a file, without downloading it.'''
+        return await self.client.files_get_metadata(self._full_path(name))
+
+    # ........................................................................
+    async def get_file(self, name, byte_range=None):
+        '''Start the download of a file, and return an AsyncDropboxFile.
+
+        Parameters:
+        name       : the file's path in Dropbox
+        byte_range : optional (start, end) tuple, both inclusive, to read
+                     only part of the file; end may be None
+        '''
+        metadata, response = await self.client.files_download(
+                self._full_path(name), byte_range)
+        expected_status = 200 if byte_range is None else 206
+        if response.status_code != expected_status:
+            await response.aclose()
+            raise DropBoxStorageException(
+                    f'Dropbox server returned a {response.status_code} '
+                    f'response when accessing {name}')
+        return AsyncDropboxFile(metadata, response, byte_range, self.client,
+                self.storage)
+
+    # ........................................................................
+    async def get_temporary_link(self, name):
+        '''Obtain the metadata of a file and a link to download it; see
+        DropboxWrapper.get_temporary_link.'''
+        cached = self.dropbox._cached_link(name)
+        if cached is not None:
+            return cached
+        result = await self.client.files_get_temporary_link(
+                self._full_path(name))
+        return self.dropbox._store_link(name, result.metadata, result.link)
+
+    # ........................................................................
+    def redirects(self, name, metadata=None):
+        '''Whether a file should be downloaded through a temporary link; see
+        DropboxWrapper.redirects.'''
+        return self.dropbox.redirects(name, metadata)
+
+    # ........................................................................
+    def caches_content(self):
+        '''Whether downloaded files are kept in a local content cache.'''
+        return self.dropbox.caches_content()
+
+    # ........................................................................
+    def open_cached(self, metadata):
+        '''Open the copy of a file kept in the local content cache.
+
+        Return None if the file is not in the cache; it is not added.
+        '''
+        if self.storage.content_cache is None:
+            return None
+        return self.storage.content_cache.open(metadata.content_hash)
+
+    # ........................................................................
+    async def _read_chunks(self, upfile):
+        '''Yield the contents of a File object, read in another thread.'''
+        read = sync_to_async(upfile.read, thread_sensitive=False)
+        await sync_to_async(upfile.open, thread_sensitive=False)()
+        while True:
+            data = await read(self.storage.upload_chunk_size)
+            if not data:
+                break
+            yield data
+
+    # ........................................................................
+    async def save(self, chunks, commit):
+        '''Upload the bytes from an async iterator as a new Dropbox file.
+
+        A chunk is only sent once the next one arrives, so that the last
+        chunk finishes the upload session; a single chunk is sent with a
+        single request. If Dropbox already received part of a chunk, e.g.
+        when a retry follows a lost answer, the upload resumes from the
+        offset Dropbox reports. Return the file's metadata.
+
+        Parameters:
+        chunks : async iterable of bytes
+        commit : the dropbox.files.CommitInfo with the file's path
+        '''
+        session_id = None
+        offset = 0
+        pending = None
+        async for data in chunks:
+            if pending is not None:
+                if session_id is None:
+                    result = await self.client.files_upload_session_start(
+                            pending)
+                    session_id = result.session_id
+                else:
+                    await self._resume(self.client.files_upload_session_append_v2,
+                            session_id, offset, pending)
+                offset += len(pending)
+            pending = data
+        if session_id is None:
+            return await self.client.files_upload(pending or b'', commit)
+        return await self._resume(self.client.files_upload_session_finish,
+                session_id, offset, pending or b'', commit)
+
+    # ........................................................................
+    async def _resume(self, send, session_id, offset, data, *args):
+        '''Send data to an upload session at offset, resending only the
+        part that Dropbox did not receive if the offset is wrong.'''
+        while True:
+            try:
+                return await send(data,
+                        files.UploadSessionCursor(session_id, offset), *args)
+            except ApiError as e:
+                correct = _correct_offset(e)
+                if correct is None or not offset < correct <= offset + len(data):
+                    raise
+                data = data[correct - offset:]
+                offset = correct
+
+    # ........................................................................
+    async def upload_file(self, path, upfile):
+        '''Upload a File object to Dropbox; see DropboxWrapper.upload_file.
+
+        A file with the same name is kept, and the new one is renamed by
+        Dropbox, unless the storage's write mode is 'overwrite'.
+        '''
+        name = ('/' if path == '' else ('/' + path + '/')) + upfile.name
+        commit = files.CommitInfo(self._full_path(name),
+                mode=files.WriteMode(self.storage.write_mode),
+                autorename=self.storage.write_mode == 'add')
+        metadata = await self.save(self._read_chunks(upfile), commit)
+        self.storage.clear_stat(metadata.path_display)
+        await self._expire_listing(path)
+        self.dropbox._forget_link(metadata.path_display)
+        return metadata.path_display
+
+    # ........................................................................
+    async def create_folder(self, path, name):
+        '''Create a folder in Dropbox; see DropboxWrapper.create_folder.'''
+        name = ('/' if path == '' else ('/' + path + '/')) + name
+        await self.client.files_create_folder_v2(self._full_path(name))
+        self.storage.clear_stat(name)
+        await self._expire_listing(path)
@@ -0,0 +1,63 @@
+from django.core.handlers.asgi import ASGIHandler
+from django.http import StreamingHttpResponse
+from asgiref.sync import sync_to_async
+
+
+# ----------------------------------------------------------------------------
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    '''A streaming response whose content comes from an async iterator.
+
+    The content is consumed in the event loop, so a slow download from
+    Dropbox does not hold a thread while it is relayed. Django 3.1 only
+    sends synchronous iterators, so this response must be sent by
+    StreamingASGIHandler.
+    '''
+
+    # ........................................................................
+    def __init__(self, content, *args, **kwargs):
+        super().__init__((), *args, **kwargs)
+        self.async_content = content
+
+    # ........................................................................
+    async def aclose(self):
+        '''Stop the async iterator, releasing its connection to Dropbox.'''
+        aclose = getattr(self.async_content, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+# ----------------------------------------------------------------------------
+class StreamingASGIHandler(ASGIHandler):
+    '''ASGI handler that can also send an AsyncStreamingHttpResponse.'''
+
+    # ........................................................................
+    async def send_response(self, response, send):
+        if not isinstance(response, AsyncStreamingHttpResponse):
+            return await super().send_response(response, send)
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            headers.append((bytes(header), bytes(value)))
+        for c in response.cookies.values():
+            headers.append(
+                (b'Set-Cookie', c.output(header='').encode('ascii').strip()))
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': headers,
+        })
+        try:
+            async for part in response.async_content:
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True,
+                    })
+            await send({'type': 'http.response.body'})
+        finally:
+            await response.aclose()
+            await sync_to_async(response.close, thread_sensitive=True)()
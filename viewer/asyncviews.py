@@ -0,0 +1,196 @@
+import asyncio
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponseRedirect
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from dropbox.exceptions import ApiError, AuthError
+
+from .aio import AsyncDropboxWrapper
+from .asgi import AsyncStreamingHttpResponse
+from .scheduler import TRANSIENT_ERRORS, DropboxUnavailable
+from .views import (
+    _EVENTS_KEEPALIVE, _EVENTS_RETRY, _api_error, _api_etag, _api_listing,
+    _api_params, _cached_listing, _event_stream, _file_headers,
+    _listing_etag, _listing_headers, _needs_metadata, _page_number,
+    _preconditions, _redirect, _render_folder, _render_listing, _sse,
+    _unavailable, _uploaded_redirect, registry,
+)
+from .watcher import watcher
+
+# Asynchronous versions of the main views, used when
+# settings.VIEWER_ASYNC_VIEWS is True. They must be served by
+# dropboxviewer.asgi, so that while a view waits for Dropbox the worker
+# goes on serving other requests.
+
+# ----------------------------------------------------------------------------
+def requires_access(view):
+    '''Decorate an async view that redirects to the authorization page if
+    there is no access to a Dropbox account.
+
+    The AsyncDropboxWrapper for the session's account is set as
+    request.dropbox; see views.requires_access.
+    '''
+    @wraps(view)
+    async def checked_view(request, *args, **kwargs):
+        # The session may be stored in the database
+        dropbox = await sync_to_async(registry.get)(request.session)
+        try:
+            if dropbox is None or not await sync_to_async(dropbox.has_access,
+                    thread_sensitive=False)():
+                return HttpResponseRedirect(reverse('auth'))
+            request.dropbox = AsyncDropboxWrapper(dropbox)
+            return await view(request, *args, **kwargs)
+        except AuthError:
+            await sync_to_async(registry.forget)(request.session)
+            return HttpResponseRedirect(reverse('auth'))
+        except (DropboxUnavailable,) + TRANSIENT_ERRORS as e:
+            return _unavailable(e)
+    return checked_view
+
+# ----------------------------------------------------------------------------
+@requires_access
+async def listfolder(request, url='', uploaded=None, created=None):
+    '''List all contents from a Dropbox folder; see views.listfolder.
+
+    The cache of rendered listings is used from a thread, since some caches
+    (e.g., the database) must not be used from the event loop.
+    '''
+    uploaded = uploaded or request.GET.get('uploaded')
+    page = _page_number(request)
+    page_size = settings.VIEWER_PAGE_SIZE
+    path = '' if len(url) == 0 else ('/' + url)
+
+    version = await request.dropbox.folder_version(path)
+    etag = _listing_etag(request, page, version, uploaded, created)
+    if etag is not None:
+        response = get_conditional_response(request, etag=etag)
+        if response is not None:
+            return _listing_headers(response, etag)
+
+    account = request.dropbox.dropbox.account.account_id
+    listing = await sync_to_async(_cached_listing, thread_sensitive=False)(
+            account, url, page, version)
+    if listing is None:
+        files = await request.dropbox.listdir(path,
+                offset=(page - 1) * page_size, limit=page_size + 1)
+        request.dropbox.prefetch_thumbnails(files[:page_size])
+        listing = await sync_to_async(_render_listing,
+                thread_sensitive=False)(account, url, files, page, version)
+    return _render_folder(request, url, listing, uploaded, created, etag)
+
+# ----------------------------------------------------------------------------
+@requires_access
+async def api_folder(request, url=''):
+    '''List a page of the contents of a Dropbox folder, as JSON; see
+    views.api_folder.'''
+    try:
+        offset, limit, fields = _api_params(request)
+    except ValueError as e:
+        return _api_error(str(e), 400)
+    path = '' if len(url) == 0 else ('/' + url)
+    try:
+        etag = _api_etag(await request.dropbox.folder_version(path), offset,
+                limit, fields)
+        if etag is not None:
+            response = get_conditional_response(request, etag=etag)
+            if response is not None:
+                return _listing_headers(response, etag)
+        entries = await request.dropbox.listdir(path, offset=offset,
+                limit=limit + 1)
+    except ApiError:
+        return _api_error('Folder not found', 404)
+    return _api_listing(path, offset, limit, fields, entries, etag)
+
+# ----------------------------------------------------------------------------
+@requires_access
+async def watch_folder(request, url=''):
+    '''Stream the changes made to a Dropbox folder, as Server-Sent Events;
+    see views.watch_folder.
+
+    Open streams wait in the event loop, so they hold no thread.
+    '''
+    if not settings.VIEWER_LIVE_UPDATES:
+        raise Http404
+    path = '' if len(url) == 0 else ('/' + url)
+
+    async def stream():
+        subscription = watcher.subscribe(request.dropbox.dropbox, path,
+                                         asyncio.get_running_loop())
+        try:
+            yield f'retry: {_EVENTS_RETRY}\n\n'.encode()
+            while True:
+                event = await subscription.aget(_EVENTS_KEEPALIVE)
+                yield (_sse(event) if event is not None
+                       else ': keepalive\n\n').encode()
+        finally:
+            watcher.unsubscribe(subscription)
+
+    return _event_stream(AsyncStreamingHttpResponse(stream()))
+
+# ----------------------------------------------------------------------------
+@requires_access
+async def download(request, name):
+    '''Download the named file from Dropbox; see views.download.
+
+    The file is relayed as it arrives from Dropbox, by the event loop.
+    Files already in the local content cache are sent from disk, but files
+    missing from it are not added by this view.
+    '''
+    if request.dropbox.redirects(name):
+        metadata, link = await request.dropbox.get_temporary_link(name)
+        if request.dropbox.redirects(name, metadata):
+            return _redirect(request, metadata, link)
+
+    byte_range = None
+    if _needs_metadata(request) or request.dropbox.caches_content():
+        metadata = await request.dropbox.get_metadata(name)
+        response, byte_range = _preconditions(request, metadata)
+        if response is not None:
+            return response
+        local_file = None
+        if byte_range is None:
+            local_file = request.dropbox.open_cached(metadata)
+        if local_file is not None:
+            response = FileResponse(local_file,
+                    content_type="application/octet-stream")
+            return _file_headers(response, name, metadata, metadata.size,
+                    None)
+
+    fd = await request.dropbox.get_file(name, byte_range)
+    response = AsyncStreamingHttpResponse(fd.chunks(),
+            content_type="application/octet-stream",
+            status=200 if byte_range is None else 206)
+    return _file_headers(response, name, fd.metadata, fd.size, byte_range)
+
+# ----------------------------------------------------------------------------
+@requires_access
+async def upload(request):
+    '''Upload the file sent by POST to Dropbox; see views.upload.
+
+    Under ASGI, Django reads the whole request before the view runs, so
+    the file is only sent to Dropbox afterwards, in chunks.
+    '''
+    upfiles = await sync_to_async(getattr)(request, 'FILES')
+    if request.method == 'POST' and upfiles['input_file']:
+        path = request.POST['folder_path']
+        name = await request.dropbox.upload_file(path=path,
+                upfile=upfiles['input_file'])
+        return _uploaded_redirect(path, name)
+    return HttpResponseRedirect(reverse('index'))
+
+# ----------------------------------------------------------------------------
+@requires_access
+async def newfolder(request):
+    '''Create the folder sent by POST in Dropbox; see views.newfolder.'''
+    if request.method == 'POST':
+        data = await sync_to_async(getattr)(request, 'POST')
+        path = data['folder_path']
+        name = data['folder_name']
+        if len(name) == 0:
+            return await listfolder(request, url=path)
+        await request.dropbox.create_folder(path=path, name=name)
+        return await listfolder(request, url=path, created=name)
+    return HttpResponseRedirect(reverse('index'))
@@ -8,24 +8,64 @@
 # DROPBOX_OAUTH2_TOKEN = 'YourOauthToken'
 # DROPBOX_ROOT_PATH = '/dir/'
 
-from io import BytesIO
-from shutil import copyfileobj
-from tempfile import SpooledTemporaryFile
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import closing
+from functools import lru_cache
+from tempfile import SpooledTemporaryFile, mkstemp
+from threading import Event, Lock
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.base import File
+from django.core.files.uploadedfile import UploadedFile
 from django.core.files.storage import Storage
 from django.utils._os import safe_join
 from django.utils.deconstruct import deconstructible
 from dropbox import Dropbox
+from dropbox.dropbox_client import RouteErrorResult
 from dropbox.exceptions import ApiError
+from dropbox.stone_base import Union
 from dropbox.files import (
-    CommitInfo, FolderMetadata, UploadSessionCursor, WriteMode,
+    CommitInfo, DeleteArg, FolderMetadata, GetMetadataError,
+    LookupError as PathLookupError, RelocationPath, UploadSessionCursor, UploadSessionFinishArg,
+    UploadSessionType, WriteMode,
 )
 
+from .metrics import CallTimer, record_retry, record_transfer
+from .scheduler import CallScheduler, TokenBucket, get_circuit_breaker
+
 _DEFAULT_TIMEOUT = 100
 _DEFAULT_MODE = 'add'
+_DEFAULT_UPLOAD_WORKERS = 4
+_DEFAULT_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+_DEFAULT_CONTENT_CACHE_SIZE = 1024 * 1024 * 1024
+_DEFAULT_CONTENT_CACHE_MAX_FILE = 64 * 1024 * 1024
+_DEFAULT_CONTENT_CACHE_WAIT = 30
+_DEFAULT_STAT_TTL = 10
+_DEFAULT_RATE_LIMIT = 50
+_DEFAULT_RATE_BURST = 100
+_DEFAULT_RETRIES = 4
+_DEFAULT_BREAKER_THRESHOLD = 5
+_DEFAULT_BREAKER_RESET = 30
+_DEFAULT_DOWNLOAD_WORKERS = 4
+_DEFAULT_DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+_DEFAULT_PARALLEL_DOWNLOAD_MIN_SIZE = 32 * 1024 * 1024
+_DEFAULT_BATCH_TIMEOUT = 600
+
+def _error_summary(error):
+    """
+    Describe a Dropbox error by the tags of its unions, like the
+    ``error_summary`` of the API; e.g. 'relocation_error/to/conflict/file'.
+    """
+    tags = []
+    while isinstance(error, Union):
+        tags.append(error._tag)
+        error = error._value
+    return '/'.join(tags)
+
 
 def get_available_overwrite_name(name, max_length):
     if max_length is None or len(name) <= max_length:
@@ -54,29 +94,393 @@ class DropBoxStorageException(Exception):
     pass
 
 
+class ScheduledDropbox(Dropbox):
+    """
+    Dropbox client whose calls are sent by a ``CallScheduler``.
+
+    Every route goes through ``request_json_string_with_retry``, so the
+    scheduler retries failures, paces the calls and trips the circuit
+    breaker for all of them; the client itself must be created without
+    retries. Clones share the scheduler. Each attempt is measured, see
+    ``viewer.metrics``.
+    """
+    scheduler = None
+
+    def request_json_string_with_retry(self, host, route_name, *args, **kwargs):
+        send = super().request_json_string_with_retry
+        if self.scheduler is None:
+            return send(host, route_name, *args, **kwargs)
+        attempts = []
+
+        def attempt():
+            if attempts:
+                record_retry(route_name)
+            attempts.append(route_name)
+            return send(host, route_name, *args, **kwargs)
+        return self.scheduler.call(attempt)
+
+    def request_json_string(self, host, func_name, route_style, request_json_arg,
+                            auth_type, request_binary, timeout=None):
+        sent = len(request_binary) if isinstance(request_binary, bytes) else 0
+        with CallTimer(func_name, sent) as timer:
+            result = super().request_json_string(
+                host, func_name, route_style, request_json_arg, auth_type,
+                request_binary, timeout=timeout
+            )
+            if isinstance(result, RouteErrorResult):
+                timer.result = 'api_error'
+            if route_style != self._ROUTE_STYLE_DOWNLOAD:
+                timer.received = len(result.obj_result)
+        return result
+
+    def clone(self, *args, **kwargs):
+        client = super().clone(*args, **kwargs)
+        client.scheduler = self.scheduler
+        return client
+
+
+def _correct_offset(error):
+    """
+    Return the offset that Dropbox expected, from the ``ApiError`` of an
+    upload session call sent at the wrong offset, or None.
+    """
+    lookup = error.error
+    if getattr(lookup, 'is_lookup_failed', lambda: False)():
+        lookup = lookup.get_lookup_failed()
+    if getattr(lookup, 'is_incorrect_offset', lambda: False)():
+        return lookup.get_incorrect_offset().correct_offset
+    return None
+
+
+class DropBoxContentCache:
+    """
+    Local copies of Dropbox files, keyed by their content hash.
+
+    Copies are written under a temporary name while the file is being sent
+    (see ``tee()``), and then renamed, so readers never see partial files.
+    Only one request in a process stores each key at a time; others for the
+    same key may ``wait()`` for its copy, and no lock is held while
+    downloading. When the total size goes over ``max_size`` bytes, the least
+    recently used copies are removed.
+    """
+
+    def __init__(self, location, max_size):
+        self.location = str(location)
+        self.max_size = max_size
+        self._size = None
+        self._size_lock = Lock()
+        # The keys being stored, with the events set once they are done
+        self._filling = {}
+        self._filling_lock = Lock()
+
+    def _path(self, key):
+        return os.path.join(self.location, key[:2], key)
+
+    def open(self, key):
+        """Return the copy stored under ``key``, open for reading, or None."""
+        path = self._path(key)
+        try:
+            local_file = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            # Mark the copy as recently used
+            os.utime(path)
+        except OSError:
+            # Evicted meanwhile; the open file can still be read
+            pass
+        return local_file
+
+    def wait(self, key, timeout):
+        """
+        Wait up to ``timeout`` seconds while ``key`` is being stored by
+        another request. Return whether it was being stored.
+        """
+        with self._filling_lock:
+            done = self._filling.get(key)
+        if done is None:
+            return False
+        done.wait(timeout)
+        return True
+
+    def tee(self, key, chunks, size):
+        """
+        Yield the chunks from the iterable ``chunks``, storing them under
+        ``key`` as they pass, so the first byte is not delayed by the cache.
+
+        The copy is only kept if all its ``size`` bytes were read. If the key
+        is already being stored by another request, the chunks are just passed
+        on.
+        """
+        if not self._claim(key):
+            yield from chunks
+            return
+        try:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = mkstemp(suffix='.part', dir=os.path.dirname(path))
+            try:
+                written = 0
+                with os.fdopen(fd, 'wb') as temp_file:
+                    for chunk in chunks:
+                        temp_file.write(chunk)
+                        written += len(chunk)
+                        yield chunk
+                if written != size:
+                    raise DropBoxStorageException(
+                        "Received {} bytes of {} for {}".format(written, size, key)
+                    )
+                os.replace(temp_path, path)
+            except BaseException:
+                # Includes GeneratorExit, when the client goes away
+                os.remove(temp_path)
+                raise
+        finally:
+            self._release(key)
+        self._grow(size)
+
+    def store(self, key, data):
+        """Store the bytes ``data`` under ``key``, unless already stored."""
+        if not os.path.exists(self._path(key)):
+            deque(self.tee(key, [data], len(data)), maxlen=0)
+
+    def _claim(self, key):
+        with self._filling_lock:
+            if key in self._filling:
+                return False
+            self._filling[key] = Event()
+            return True
+
+    def _release(self, key):
+        with self._filling_lock:
+            done = self._filling.pop(key, None)
+        if done is not None:
+            done.set()
+
+    def _grow(self, size):
+        with self._size_lock:
+            if self._size is None:
+                # The scan finds the new copy too
+                self._size = sum(size for path, used, size in self._scan())
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _scan(self):
+        for folder in os.scandir(self.location):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if not entry.name.endswith('.part'):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_mtime, stat.st_size
+
+    def _evict(self):
+        # Leave some room, so that eviction does not run on every fill
+        target = self.max_size * 0.9
+        copies = sorted(self._scan(), key=lambda copy: copy[1])
+        self._size = sum(size for path, used, size in copies)
+        for path, used, size in copies:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except OSError:
+                # Files being read cannot be removed on some systems
+                pass
+
+
+@lru_cache(maxsize=None)
+def get_content_cache(location, max_size):
+    """Return the content cache in ``location``, shared by all storages."""
+    return DropBoxContentCache(location, max_size)
+
+
 class DropBoxFile(File):
-    def __init__(self, name, storage):
+    def __init__(self, name, storage, byte_range=None, metadata=None, local_file=None,
+                 cache_key=None):
         self.name = name
         self._storage = storage
         self._file = None
+        self._response = None
+        self.byte_range = byte_range
+        self.metadata = None
+        self.local_file = local_file
+        self.cache_key = cache_key
+        if metadata is not None:
+            self._set_metadata(metadata)
 
-    def _get_file(self):
-        if self._file is None:
-            self._file = SpooledTemporaryFile()
+    def _get_response(self):
+        """Start the download, leaving its body unread on the connection."""
+        if self._response is None:
+            client = self._storage.client
+            expected_status = 200
+            if self.byte_range is not None:
+                # The content endpoint honors standard HTTP ranges
+                start, end = self.byte_range
+                client = client.clone(headers={
+                    'Range': 'bytes={}-{}'.format(
+                        start, '' if end is None else end)
+                })
+                expected_status = 206
             # As dropbox==9.3.0, the client returns a tuple
             # (dropbox.files.FileMetadata, requests.models.Response)
-            file_metadata, response = \
-                self._storage.client.files_download(self.name)
-            if response.status_code == 200:
-                with BytesIO(response.content) as file_content:
-                    copyfileobj(file_content, self._file)
-            else:
+            metadata, response = client.files_download(self.name)
+            if response.status_code != expected_status:
+                response.close()
                 # JIC the exception isn't catched by the dropbox client
                 raise DropBoxStorageException(
                     "Dropbox server returned a {} response when accessing {}"
                     .format(response.status_code, self.name)
                 )
-            self._file.seek(0)
+            self._response = response
+            self._set_metadata(metadata)
+        return self._response
+
+    def _set_metadata(self, metadata):
+        self.metadata = metadata
+        self.size = metadata.size
+        if self.byte_range is not None:
+            start, end = self.byte_range
+            if end is None or end >= metadata.size:
+                end = metadata.size - 1
+            self.size = end - start + 1
+
+    def prefetch(self):
+        """
+        Start the download in advance, e.g. from another thread.
+
+        The file is later read from the pending response; call ``close()``
+        if it will not be read.
+        """
+        self._get_response()
+        return self
+
+    def _iter_response(self, response, chunk_size, limit=None):
+        received = 0
+        try:
+            with closing(response):
+                for chunk in response.iter_content(chunk_size):
+                    if limit is not None and received + len(chunk) >= limit:
+                        chunk = chunk[:limit - received]
+                        received += len(chunk)
+                        yield chunk
+                        break
+                    received += len(chunk)
+                    yield chunk
+        finally:
+            record_transfer('files/download', received=received)
+
+    def _iter_parts(self, response, parts, chunk_size):
+        """
+        Stream the first of ``parts`` from ``response``, while the next ones
+        are downloaded by worker threads, and yield them in order.
+
+        All the parts are read from the same revision. At most
+        ``download_workers`` parts are downloaded at once, and held until
+        their turn comes.
+        """
+        workers = self._storage.download_workers
+        path = 'rev:' + self.metadata.rev
+        executor = ThreadPoolExecutor(workers)
+        pending = deque()
+        remaining = iter(parts[1:])
+
+        def submit():
+            part = next(remaining, None)
+            if part is not None:
+                pending.append(executor.submit(self._download_part, path, part))
+        try:
+            for i in range(workers - 1):
+                submit()
+            start, end = parts[0]
+            yield from self._iter_response(response, chunk_size, end - start + 1)
+            submit()
+            while pending:
+                data = pending.popleft().result()
+                submit()
+                for offset in range(0, len(data), chunk_size):
+                    yield data[offset:offset + chunk_size]
+        finally:
+            response.close()
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _download_part(self, path, part):
+        """Return the bytes in the ``part`` (start, end) range of a file."""
+        start, end = part
+        client = self._storage.client.clone(headers={
+            'Range': 'bytes={}-{}'.format(start, end)
+        })
+        metadata, response = client.files_download(path)
+        with closing(response):
+            data = response.content if response.status_code == 206 else b''
+        record_transfer('files/download', received=len(data))
+        if len(data) != end - start + 1:
+            raise DropBoxStorageException(
+                "Dropbox server returned a {} response with {} bytes when "
+                "accessing bytes {}-{} of {}"
+                .format(response.status_code, len(data), start, end, self.name)
+            )
+        return data
+
+    def _iter_local_file(self, chunk_size):
+        with self.local_file:
+            if self.byte_range is not None:
+                self.local_file.seek(self.byte_range[0])
+            remaining = self.size
+            while remaining > 0:
+                data = self.local_file.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+    def chunks(self, chunk_size=None):
+        """
+        Stream the file in chunks of ``chunk_size`` bytes.
+
+        Unless the file was already read, the chunks are passed straight from
+        the Dropbox response, so the whole file is never held in memory. The
+        download starts right away, which makes ``size`` and ``metadata``
+        available before the first chunk is consumed. Files opened from the
+        local content cache are read from it instead, and files with a
+        ``cache_key`` are stored in it as they are streamed.
+
+        Files of at least ``parallel_download_min_size`` bytes are downloaded
+        in parts, over several connections at once (see
+        ``DropBoxStorage.download_parts()``).
+        """
+        if self._file is not None:
+            return super().chunks(chunk_size)
+        if self.local_file is not None:
+            return self._iter_local_file(
+                chunk_size or self._storage.STREAM_CHUNK_SIZE)
+        response = self._get_response()
+        self._response = None
+        chunk_size = chunk_size or self._storage.STREAM_CHUNK_SIZE
+        start = self.byte_range[0] if self.byte_range is not None else 0
+        parts = self._storage.download_parts(start, self.size)
+        if parts is not None:
+            chunks = self._iter_parts(response, parts, chunk_size)
+        else:
+            chunks = self._iter_response(response, chunk_size)
+        if self.cache_key is not None:
+            chunks = self._storage.content_cache.tee(self.cache_key, chunks, self.size)
+        return chunks
+
+    def _get_file(self):
+        if self._file is None and self.local_file is not None and self.byte_range is None:
+            self._file = self.local_file
+        if self._file is None:
+            content = SpooledTemporaryFile()
+            for chunk in self.chunks():
+                content.write(chunk)
+            content.seek(0)
+            self._file = content
         return self._file
 
     def _set_file(self, value):
@@ -84,6 +488,149 @@ class DropBoxFile(File):
 
     file = property(_get_file, _set_file)
 
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+        if self._file is not None:
+            self._file.close()
+        if self.local_file is not None:
+            self.local_file.close()
+
+
+class DropBoxUploadSession:
+    """
+    Send a file to Dropbox as a sequence of chunks.
+
+    Chunks must be appended in order and, except for the last one, have a
+    size multiple of 4 MB. They are sent in parallel by the storage's
+    ``upload_workers`` threads through a concurrent upload session, and a
+    chunk that fails is sent again by the client's scheduler, without
+    affecting the others. A chunk whose retry finds it already received is
+    taken as sent. At most two chunks per worker are held in memory.
+    A file given as a single last chunk is sent with a single request when
+    the session is finished, unless it is flushed before.
+    """
+    def __init__(self, storage):
+        self._storage = storage
+        self._executor = None
+        self._pending = set()
+        self._head = None
+        self._flushed = None
+        self.session_id = None
+        self.offset = 0
+
+    def append(self, data, last=False):
+        if self.session_id is None:
+            if last:
+                self._head = data
+                self.offset = len(data)
+                return
+            upload_session = self._storage.client.files_upload_session_start(
+                b'', session_type=UploadSessionType.concurrent
+            )
+            self.session_id = upload_session.session_id
+            self._executor = ThreadPoolExecutor(self._storage.upload_workers)
+        self._pending.add(self._executor.submit(
+            self._append_chunk, data, self.offset, last
+        ))
+        self.offset += len(data)
+        if len(self._pending) >= 2 * self._storage.upload_workers:
+            done, self._pending = wait(self._pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+    def _append_chunk(self, data, offset, last):
+        cursor = UploadSessionCursor(session_id=self.session_id, offset=offset)
+        try:
+            self._storage.client.files_upload_session_append_v2(
+                data, cursor, close=last
+            )
+        except ApiError as e:
+            # A retry of a chunk whose first attempt was received, though
+            # its answer was lost
+            if _correct_offset(e) != offset + len(data):
+                raise
+
+    def flush(self, executor):
+        """
+        Send a file given as a single last chunk to a closed session, with
+        ``executor``, so that its content is not held in memory until the
+        session is finished, which must then be done by a batch (see
+        ``finish_arg``). Return the future of the call.
+        """
+        data, self._head = self._head or b'', None
+        self._flushed = executor.submit(self._start_closed, data)
+        return self._flushed
+
+    def _start_closed(self, data):
+        upload_session = self._storage.client.files_upload_session_start(
+            data, close=True
+        )
+        self.session_id = upload_session.session_id
+
+    def _wait(self):
+        try:
+            for future in self._pending:
+                future.result()
+        finally:
+            self._executor.shutdown()
+
+    def finish(self, dest_path):
+        """Wait for the chunks to be sent, and save them as ``dest_path``."""
+        mode = WriteMode(self._storage.write_mode)
+        if self.session_id is None:
+            return self._storage.client.files_upload(
+                self._head or b'', dest_path, mode=mode
+            )
+        self._wait()
+        cursor = UploadSessionCursor(session_id=self.session_id, offset=self.offset)
+        commit = CommitInfo(path=dest_path, mode=mode)
+        return self._storage.client.files_upload_session_finish(b'', cursor, commit)
+
+    def finish_arg(self, commit):
+        """
+        Wait for the chunks to be sent, and return the argument that saves
+        them, according to ``commit``, in ``files_upload_session_finish_batch``.
+        """
+        if self._flushed is not None:
+            self._flushed.result()
+        elif self.session_id is None:
+            # Batches can only finish closed upload sessions
+            self._start_closed(self._head or b'')
+            self._head = None
+        else:
+            self._wait()
+        cursor = UploadSessionCursor(session_id=self.session_id, offset=self.offset)
+        return UploadSessionFinishArg(cursor=cursor, commit=commit)
+
+    def abort(self):
+        """Stop sending chunks; Dropbox discards unfinished sessions."""
+        self._head = None
+        if self._executor is not None:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown(wait=False)
+
+
+class DropBoxUploadedFile(UploadedFile):
+    """
+    An uploaded file whose content was sent to a ``DropBoxUploadSession``.
+
+    Saving it to a ``DropBoxStorage`` finishes the session, instead of
+    sending the content again.
+    """
+    def __init__(self, upload_session, name, content_type, size, charset,
+                 content_type_extra=None):
+        super().__init__(None, name, content_type, size, charset, content_type_extra)
+        self.upload_session = upload_session
+
+    def open(self, mode=None):
+        return self
+
+    def close(self):
+        pass
+
 
 @deconstructible
 class DropBoxStorage(Storage):
@@ -92,18 +639,65 @@ class DropBoxStorage(Storage):
     oauth2_access_token = setting('DROPBOX_OAUTH2_TOKEN')
     timeout = setting('DROPBOX_TIMEOUT', _DEFAULT_TIMEOUT)
     write_mode = setting('DROPBOX_WRITE_MODE', _DEFAULT_MODE)
+    upload_workers = setting('DROPBOX_UPLOAD_WORKERS', _DEFAULT_UPLOAD_WORKERS)
+    upload_chunk_size = setting('DROPBOX_UPLOAD_CHUNK_SIZE', _DEFAULT_UPLOAD_CHUNK_SIZE)
+    content_cache_dir = setting('DROPBOX_CONTENT_CACHE_DIR')
+    content_cache_size = setting('DROPBOX_CONTENT_CACHE_SIZE', _DEFAULT_CONTENT_CACHE_SIZE)
+    content_cache_max_file = setting('DROPBOX_CONTENT_CACHE_MAX_FILE',
+                                     _DEFAULT_CONTENT_CACHE_MAX_FILE)
+    content_cache_wait = setting('DROPBOX_CONTENT_CACHE_WAIT', _DEFAULT_CONTENT_CACHE_WAIT)
+    stat_ttl = setting('DROPBOX_STAT_TTL', _DEFAULT_STAT_TTL)
+    rate_limit = setting('DROPBOX_RATE_LIMIT', _DEFAULT_RATE_LIMIT)
+    rate_burst = setting('DROPBOX_RATE_BURST', _DEFAULT_RATE_BURST)
+    retries = setting('DROPBOX_RETRIES', _DEFAULT_RETRIES)
+    breaker_threshold = setting('DROPBOX_BREAKER_THRESHOLD', _DEFAULT_BREAKER_THRESHOLD)
+    breaker_reset = setting('DROPBOX_BREAKER_RESET', _DEFAULT_BREAKER_RESET)
+    download_workers = setting('DROPBOX_DOWNLOAD_WORKERS', _DEFAULT_DOWNLOAD_WORKERS)
+    download_part_size = setting('DROPBOX_DOWNLOAD_PART_SIZE', _DEFAULT_DOWNLOAD_PART_SIZE)
+    parallel_download_min_size = setting('DROPBOX_PARALLEL_DOWNLOAD_MIN_SIZE',
+                                         _DEFAULT_PARALLEL_DOWNLOAD_MIN_SIZE)
+    batch_timeout = setting('DROPBOX_BATCH_TIMEOUT', _DEFAULT_BATCH_TIMEOUT)
 
     CHUNK_SIZE = 4 * 1024 * 1024
+    STREAM_CHUNK_SIZE = 64 * 1024
+    BATCH_SIZE = 1000
+    STAT_CACHE_SIZE = 10000
 
     def __init__(self, oauth2_access_token=oauth2_access_token, root_path=location, timeout=timeout,
-                 write_mode=write_mode):
+                 write_mode=write_mode, session=None, upload_workers=upload_workers,
+                 upload_chunk_size=upload_chunk_size, content_cache_dir=content_cache_dir):
         if oauth2_access_token is None:
             raise ImproperlyConfigured("You must configure an auth token at"
                                        "'settings.DROPBOX_OAUTH2_TOKEN'.")
+        if upload_chunk_size % self.CHUNK_SIZE:
+            # Required by concurrent upload sessions
+            raise ImproperlyConfigured("'settings.DROPBOX_UPLOAD_CHUNK_SIZE' must be "
+                                       "a multiple of 4 MB.")
 
         self.root_path = root_path
         self.write_mode = write_mode
-        self.client = Dropbox(oauth2_access_token, timeout=timeout)
+        self.upload_workers = upload_workers
+        self.upload_chunk_size = upload_chunk_size
+        self.content_cache = None
+        if content_cache_dir is not None:
+            self.content_cache = get_content_cache(str(content_cache_dir),
+                                                   self.content_cache_size)
+        # Calls are retried, rate limited to rate_limit per second and
+        # account, and stopped while Dropbox keeps failing, by the scheduler
+        bucket = None
+        if self.rate_limit:
+            bucket = TokenBucket(self.rate_limit, self.rate_burst)
+        self.scheduler = CallScheduler(
+            bucket, get_circuit_breaker(self.breaker_threshold, self.breaker_reset),
+            self.retries
+        )
+        # Clients given the same requests session share its connection pool
+        self.client = ScheduledDropbox(oauth2_access_token, timeout=timeout, session=session,
+                                       max_retries_on_error=0, max_retries_on_rate_limit=0)
+        self.client.scheduler = self.scheduler
+        self._stats = OrderedDict()
+        self._listed = OrderedDict()
+        self._stats_lock = Lock()
 
     def _full_path(self, name):
         if name == '/':
@@ -112,39 +706,151 @@ class DropBoxStorage(Storage):
 
     def delete(self, name):
         self.client.files_delete(self._full_path(name))
+        self.clear_stat(name)
 
     def exists(self, name):
         try:
-            return bool(self.client.files_get_metadata(self._full_path(name)))
+            return bool(self._stat(name))
         except ApiError:
             return False
 
-    def listdir(self, path):
-        directories, files = [], []
-        full_path = self._full_path(path)
+    def _stat(self, name):
+        """
+        Return the metadata of ``name``, or raise the ``ApiError`` of a
+        missing path.
+
+        Results, including missing paths, are cached for ``stat_ttl``
+        seconds. Paths inside a folder listed within that time are known
+        without any call.
+        """
+        full_path = self._full_path(name)
+        key = full_path.lower().rstrip('/')
+        now = time.monotonic()
+        with self._stats_lock:
+            cached = self._stats.get(key)
+            if cached is None or cached[0] <= now:
+                # Paths missing from a recent listing do not exist
+                listed = self._listed.get(key.rpartition('/')[0])
+                cached = (listed, None) if listed is not None and listed > now else None
+        if cached is not None:
+            if cached[1] is None:
+                raise ApiError(None, GetMetadataError.path(PathLookupError.not_found),
+                               None, None)
+            return cached[1]
+        try:
+            metadata = self.client.files_get_metadata(full_path)
+        except ApiError as e:
+            if e.error.is_path() and e.error.get_path().is_not_found():
+                self._set_stats({key: None})
+            raise
+        self._set_stats({key: metadata})
+        return metadata
+
+    def _set_stats(self, stats, listed=None):
+        """
+        Cache the metadata (or None, for missing paths) of many lower-case
+        paths, and optionally the path of a folder listed completely.
+        """
+        expires = time.monotonic() + self.stat_ttl
+        with self._stats_lock:
+            for key, metadata in stats.items():
+                self._stats[key] = (expires, metadata)
+                self._stats.move_to_end(key)
+            if listed is not None:
+                self._listed[listed] = expires
+                self._listed.move_to_end(listed)
+            while len(self._stats) > self.STAT_CACHE_SIZE:
+                key, _ = self._stats.popitem(last=False)
+                # Paths missing from the folder are no longer known
+                self._listed.pop(key.rpartition('/')[0], None)
+            while len(self._listed) > self.STAT_CACHE_SIZE:
+                self._listed.popitem(last=False)
+
+    def clear_stat(self, name):
+        """Forget the cached metadata of ``name``, and of any path inside it."""
+        self.clear_stats([name])
+
+    def clear_stats(self, names):
+        """Forget the cached metadata of many names, in a single pass."""
+        keys = {self._full_path(name).lower().rstrip('/') for name in names}
+        with self._stats_lock:
+            for cache in (self._stats, self._listed):
+                for path in [path for path in cache
+                             if self._below(path, keys)]:
+                    del cache[path]
+            for key in keys:
+                self._listed.pop(key.rpartition('/')[0], None)
+
+    @staticmethod
+    def _below(path, keys):
+        """Whether a lower-case path is one of ``keys``, or inside one."""
+        while path:
+            if path in keys:
+                return True
+            path = path.rpartition('/')[0]
+        # The root holds every path
+        return '' in keys
+
+    def list_pages(self, path, cursor=None, recursive=False):
+        """
+        Yield the result pages of a folder listing.
 
-        if full_path == '/':
-            full_path = ''
+        Pages are fetched lazily, following the listing cursor until Dropbox
+        reports there are no more entries. If a cursor from a previous
+        listing is given, only the changes made since then are listed. A
+        ``recursive`` listing also includes the contents of all subfolders.
+        """
+        if cursor is None:
+            full_path = self._full_path(path)
 
-        metadata = self.client.files_list_folder(full_path)
-        for entry in metadata.entries:
+            if full_path == '/':
+                full_path = ''
+
+            result = self.client.files_list_folder(full_path, recursive=recursive)
+        else:
+            result = self.client.files_list_folder_continue(cursor)
+        yield result
+        while result.has_more:
+            result = self.client.files_list_folder_continue(result.cursor)
+            yield result
+
+    def scandir(self, path):
+        """
+        Yield the metadata of every entry in a folder, caching their stats.
+
+        The folder is marked as listed only if all its entries fit in the
+        stat cache, since paths missing from it are then reported as
+        missing.
+        """
+        count = 0
+        for result in self.list_pages(path):
+            self._set_stats({metadata.path_lower: metadata
+                             for metadata in result.entries})
+            count += len(result.entries)
+            yield from result.entries
+        if count <= self.STAT_CACHE_SIZE:
+            self._set_stats({}, listed=self._full_path(path).lower().rstrip('/'))
+
+    def listdir(self, path):
+        directories, files = [], []
+        for entry in self.scandir(path):
             if isinstance(entry, FolderMetadata):
                 directories.append(entry.name)
             else:
                 files.append(entry.name)
         return directories, files
 
+    def get_metadata(self, name):
+        return self._stat(name)
+
     def size(self, name):
-        metadata = self.client.files_get_metadata(self._full_path(name))
-        return metadata.size
+        return self._stat(name).size
 
     def modified_time(self, name):
-        metadata = self.client.files_get_metadata(self._full_path(name))
-        return metadata.server_modified
+        return self._stat(name).server_modified
 
     def accessed_time(self, name):
-        metadata = self.client.files_get_metadata(self._full_path(name))
-        return metadata.client_modified
+        return self._stat(name).client_modified
 
     def url(self, name):
         media = self.client.files_get_temporary_link(self._full_path(name))
@@ -154,41 +860,246 @@ class DropBoxStorage(Storage):
         remote_file = DropBoxFile(self._full_path(name), self)
         return remote_file
 
+    def open_range(self, name, start, end=None):
+        """Open only the bytes from ``start`` to ``end`` (inclusive)."""
+        return DropBoxFile(self._full_path(name), self, byte_range=(start, end))
+
+    def download_parts(self, start, size):
+        """
+        Split the ``size`` bytes from ``start`` into the (start, end) ranges
+        downloaded in parallel, or return None if they are too few for it.
+
+        A single connection is limited by its latency, so large files are
+        fetched in parts of ``download_part_size`` bytes, by up to
+        ``download_workers`` connections at once.
+        """
+        if self.download_workers < 2 or size < self.parallel_download_min_size:
+            return None
+        end = start + size
+        return [(offset, min(offset + self.download_part_size, end) - 1)
+                for offset in range(start, end, self.download_part_size)]
+
+    def open_cached(self, name, metadata, byte_range=None):
+        """
+        Open a file through the local content cache.
+
+        ``metadata`` is the file's current metadata. If a copy with the same
+        content hash is in the cache, it is read from there. Otherwise the
+        revision it names is downloaded, and stored in the cache while its
+        chunks are streamed; ranges are downloaded as usual, without storing
+        them. Files larger than ``content_cache_max_file`` are not cached.
+
+        While another request stores the same file, it is waited for, up to
+        ``content_cache_wait`` seconds, so that it is downloaded only once;
+        if it is still not stored, it is downloaded again.
+        """
+        full_path = self._full_path(name)
+        if self.content_cache is None or metadata.size > self.content_cache_max_file:
+            return DropBoxFile(full_path, self, byte_range)
+        key = metadata.content_hash
+        local_file = self.content_cache.open(key)
+        if local_file is None and self.content_cache.wait(key, self.content_cache_wait):
+            local_file = self.content_cache.open(key)
+        if local_file is not None:
+            return DropBoxFile(full_path, self, byte_range, metadata, local_file)
+        if byte_range is not None:
+            return DropBoxFile(full_path, self, byte_range)
+        return DropBoxFile('rev:' + metadata.rev, self, metadata=metadata, cache_key=key)
+
     def _save(self, name, content):
-        content.open()
-        if content.size <= self.CHUNK_SIZE:
-            self.client.files_upload(content.read(), self._full_path(name), mode=WriteMode(self.write_mode))
+        if isinstance(content, DropBoxUploadedFile):
+            metadata = content.upload_session.finish(self._full_path(name))
         else:
-            self._chunked_upload(content, self._full_path(name))
-        content.close()
+            content.open()
+            if content.size <= self.CHUNK_SIZE:
+                metadata = self.client.files_upload(content.read(), self._full_path(name), mode=WriteMode(self.write_mode))
+            else:
+                metadata = self._chunked_upload(content, self._full_path(name))
+            content.close()
+        self._set_stats({metadata.path_lower: metadata})
         return name
 
     def _chunked_upload(self, content, dest_path):
-        upload_session = self.client.files_upload_session_start(
-            content.read(self.CHUNK_SIZE)
-        )
-        cursor = UploadSessionCursor(
-            session_id=upload_session.session_id,
-            offset=content.tell()
-        )
-        commit = CommitInfo(path=dest_path, mode=WriteMode(self.write_mode))
+        return self._upload_session(content).finish(dest_path)
 
+    def _upload_session(self, content):
+        upload_session = DropBoxUploadSession(self)
         while content.tell() < content.size:
-            if (content.size - content.tell()) <= self.CHUNK_SIZE:
-                self.client.files_upload_session_finish(
-                    content.read(self.CHUNK_SIZE), cursor, commit
+            data = content.read(self.upload_chunk_size)
+            if not data:
+                break
+            upload_session.append(data, last=content.tell() >= content.size)
+        return upload_session
+
+    def save_batch(self, files):
+        """
+        Save many files, committing them together.
+
+        ``files`` is a sequence of (name, content) pairs. The contents are
+        sent in parallel, and then committed by a single call for every
+        ``BATCH_SIZE`` files, which avoids the contention of many separate
+        writes. In 'add' mode, names already in use are renamed by Dropbox.
+        Return the names of the saved files.
+        """
+        mode = WriteMode(self.write_mode)
+
+        def prepare(item):
+            name, content = item
+            commit = CommitInfo(path=self._full_path(name), mode=mode,
+                                autorename=self.write_mode == 'add')
+            if isinstance(content, DropBoxUploadedFile):
+                return content.upload_session.finish_arg(commit)
+            content.open()
+            try:
+                return self._upload_session(content).finish_arg(commit)
+            finally:
+                content.close()
+
+        with ThreadPoolExecutor(self.upload_workers) as executor:
+            entries = list(executor.map(prepare, files))
+
+        names = []
+        for start in range(0, len(entries), self.BATCH_SIZE):
+            batch = entries[start:start + self.BATCH_SIZE]
+            for entry, result in zip(batch, self._finish_batch(batch)):
+                if result.is_failure():
+                    raise DropBoxStorageException(
+                        "Dropbox could not save {}: {}"
+                        .format(entry.commit.path, result.get_failure())
+                    )
+                metadata = result.get_success()
+                self._set_stats({metadata.path_lower: metadata})
+                names.append(metadata.path_display)
+        return names
+
+    def _finish_batch(self, entries):
+        return self._run_batch(
+            self.client.files_upload_session_finish_batch(entries),
+            self.client.files_upload_session_finish_batch_check
+        )
+
+    def _run_batch(self, launch, check):
+        """
+        Return the result entries of a batch, given the result of its launch.
+        Batches that run as asynchronous jobs are polled with ``check`` until
+        they complete, for up to ``batch_timeout`` seconds.
+        """
+        if launch.is_complete():
+            return launch.get_complete().entries
+        if not launch.is_async_job_id():
+            raise DropBoxStorageException(
+                "Unexpected response to a batch: {}".format(launch)
+            )
+        deadline = time.monotonic() + self.batch_timeout
+        delay = 0.2
+        while True:
+            if time.monotonic() + delay > deadline:
+                raise DropBoxStorageException(
+                    "Dropbox did not finish a batch in {} seconds; its entries "
+                    "may still be processed".format(self.batch_timeout)
                 )
-            else:
-                self.client.files_upload_session_append_v2(
-                    content.read(self.CHUNK_SIZE), cursor
+            time.sleep(delay)
+            status = check(launch.get_async_job_id())
+            if status.is_complete():
+                return status.get_complete().entries
+            if getattr(status, 'is_failed', bool)():
+                raise DropBoxStorageException(
+                    "Dropbox could not run a batch: {}".format(status.get_failed())
                 )
-                cursor.offset = content.tell()
+            delay = min(2 * delay, 5)
+
+    def _batch(self, args, launch, check, progress=None):
+        """
+        Run an operation on many entries, with a single call (and the polls
+        of its job) for every ``BATCH_SIZE`` of them, one batch at a time,
+        since Dropbox serializes the writes to an account anyway.
+
+        ``args`` are the arguments of each entry, sent in lists to ``launch``,
+        whose jobs are polled with ``check``. ``progress``, if given, is
+        called with the number of entries done after each batch. Return a
+        (metadata, error) pair for each entry: the metadata of its result, or
+        None and the description of its failure.
+        """
+        results = []
+        for start in range(0, len(args), self.BATCH_SIZE):
+            batch = args[start:start + self.BATCH_SIZE]
+            for entry in self._run_batch(launch(batch), check):
+                if entry.is_success():
+                    # Some routes wrap the metadata of each entry
+                    success = entry.get_success()
+                    results.append((getattr(success, 'metadata', success), None))
+                elif entry.is_failure():
+                    results.append((None, _error_summary(entry.get_failure())))
+                else:
+                    results.append((None, 'other'))
+            if progress is not None:
+                progress(len(results))
+        return results
+
+    def copy_batch(self, pairs, progress=None):
+        """
+        Copy many files or folders, given (name, new_name) pairs. In 'add'
+        mode, new names already in use are renamed by Dropbox. See ``_batch``
+        for the results.
+        """
+        results = self._batch(
+            [RelocationPath(self._full_path(name), self._full_path(new_name))
+             for name, new_name in pairs],
+            lambda batch: self.client.files_copy_batch_v2(
+                batch, autorename=self.write_mode == 'add'),
+            self.client.files_copy_batch_check_v2, progress
+        )
+        self._set_stats({metadata.path_lower: metadata
+                         for metadata, error in results if metadata is not None})
+        return results
+
+    def move_batch(self, pairs, progress=None):
+        """
+        Move many files or folders, given (name, new_name) pairs; see
+        ``copy_batch``.
+        """
+        results = self._batch(
+            [RelocationPath(self._full_path(name), self._full_path(new_name))
+             for name, new_name in pairs],
+            lambda batch: self.client.files_move_batch_v2(
+                batch, autorename=self.write_mode == 'add'),
+            self.client.files_move_batch_check_v2, progress
+        )
+        self.clear_stats([name for (name, new_name), (metadata, error)
+                          in zip(pairs, results) if metadata is not None])
+        self._set_stats({metadata.path_lower: metadata
+                         for metadata, error in results if metadata is not None})
+        return results
+
+    def delete_batch(self, names, progress=None):
+        """Delete many files or folders; see ``_batch`` for the results."""
+        results = self._batch(
+            [DeleteArg(self._full_path(name)) for name in names],
+            self.client.files_delete_batch, self.client.files_delete_batch_check,
+            progress
+        )
+        self.clear_stats(names)
+        return results
+
+    def create_folder_batch(self, names, progress=None):
+        """Create many folders; see ``_batch`` for the results."""
+        results = self._batch(
+            [self._full_path(name) for name in names],
+            self.client.files_create_folder_batch,
+            self.client.files_create_folder_batch_check, progress
+        )
+        self.clear_stats(names)
+        return results
 
     def get_available_name(self, name, max_length=None):
         """Overwrite existing file with the same name."""
         name = self._full_path(name)
         if self.write_mode == 'overwrite':
             return get_available_overwrite_name(name, max_length)
+        # Each candidate costs a single metadata call at most, and none in a
+        # folder listed recently. Listing the folder instead would cost a
+        # call per page of its entries, while alternative names carry a
+        # random suffix, and are seldom taken.
         return super().get_available_name(name, max_length)
 
 
@@ -0,0 +1,693 @@
+import base64
+import json
+import time
+from datetime import datetime
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+from uuid import uuid4
+
+import httpx
+from dropbox import common, files, users, users_common
+from dropbox.session import API_CONTENT_HOST, API_HOST, API_NOTIFICATION_HOST
+from dropbox.stone_serializers import json_compat_obj_decode, json_encode
+from requests.adapters import HTTPAdapter
+
+from .scheduler import DropboxUnavailable, TokenBucket
+
+# Downloads repeat these bytes, so large files need no memory
+_PATTERN = bytes(range(256)) * 256
+
+_ROUTES = {
+    'users/get_current_account': ('rpc', users.get_current_account),
+    'files/list_folder': ('rpc', files.list_folder),
+    'files/list_folder/continue': ('rpc', files.list_folder_continue),
+    'files/list_folder/get_latest_cursor': ('rpc',
+            files.list_folder_get_latest_cursor),
+    'files/list_folder/longpoll': ('rpc', files.list_folder_longpoll),
+    'files/get_metadata': ('rpc', files.get_metadata),
+    'files/get_temporary_link': ('rpc', files.get_temporary_link),
+    'files/get_thumbnail_batch': ('rpc', files.get_thumbnail_batch),
+    'files/create_folder': ('rpc', files.create_folder),
+    'files/create_folder_v2': ('rpc', files.create_folder_v2),
+    'files/delete': ('rpc', files.delete),
+    'files/delete_v2': ('rpc', files.delete_v2),
+    'files/copy_batch_v2': ('rpc', files.copy_batch_v2),
+    'files/copy_batch/check_v2': ('rpc', files.copy_batch_check_v2),
+    'files/move_batch_v2': ('rpc', files.move_batch_v2),
+    'files/move_batch/check_v2': ('rpc', files.move_batch_check_v2),
+    'files/delete_batch': ('rpc', files.delete_batch),
+    'files/delete_batch/check': ('rpc', files.delete_batch_check),
+    'files/create_folder_batch': ('rpc', files.create_folder_batch),
+    'files/create_folder_batch/check': ('rpc',
+            files.create_folder_batch_check),
+    'files/upload_session/finish_batch': ('rpc',
+            files.upload_session_finish_batch),
+    'files/upload_session/finish_batch/check': ('rpc',
+            files.upload_session_finish_batch_check),
+    'files/download': ('download', files.download),
+    'files/upload': ('upload', files.upload),
+    'files/upload_session/start': ('upload', files.upload_session_start),
+    'files/upload_session/append_v2': ('upload',
+            files.upload_session_append_v2),
+    'files/upload_session/finish': ('upload', files.upload_session_finish),
+}
+
+
+# ----------------------------------------------------------------------------
+class FakeDropboxError(Exception):
+    '''The error of a route, answered with status 409.'''
+
+    # ........................................................................
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+
+# ----------------------------------------------------------------------------
+class FakeDropbox:
+    '''A local stand-in for the Dropbox API, serving a simulated account.
+
+    It answers the routes used by the viewer over plain HTTP, from a
+    thread, so it can be called by the real clients. Files only have a
+    size: their content is a repeating pattern, and uploaded bytes are
+    counted and discarded, so huge files cost no memory.
+
+    The service can be made to behave like a real one across a network:
+    each request waits latency seconds, content flows at bandwidth bytes
+    per second, listings are split in pages of page_size entries, and
+    requests over rate_limit per second are answered with 429 (Too Many
+    Requests).
+
+    Attributes:
+    requests : the number of requests received, by route
+    address  : the (host, port) served, once started
+    ranges   : whether Range headers are honored; if False, downloads
+               send whole files, as some servers do
+    '''
+
+    # ........................................................................
+    def __init__(self, latency=0, bandwidth=None, page_size=2000,
+                 rate_limit=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.page_size = page_size
+        self.bucket = None
+        if rate_limit:
+            self.bucket = TokenBucket(rate_limit, rate_limit)
+        self.requests = {}
+        self.address = None
+        self.ranges = True
+        self._entries = {'': None}
+        self._children = {'': {}}
+        self._sessions = {}
+        self._jobs = {}
+        self._ids = count(1)
+        self._lock = Lock()
+        self._server = None
+
+    # ........................................................................
+    def add_folder(self, path):
+        '''Create a folder, and the folders above it.'''
+        key = path.lower().rstrip('/')
+        if key.rpartition('/')[0] not in self._children:
+            self.add_folder(path.rstrip('/').rpartition('/')[0])
+        with self._lock:
+            if key not in self._entries:
+                self._add(files.FolderMetadata(name=path.rpartition('/')[2],
+                        id=f'id:{next(self._ids)}', path_lower=key,
+                        path_display=path.rstrip('/')))
+        return self._entries[key]
+
+    # ........................................................................
+    def add_file(self, path, size):
+        '''Create a file of the given size, and the folders above it.'''
+        folder = path.rpartition('/')[0]
+        if folder:
+            self.add_folder(folder)
+        key = path.lower()
+        now = datetime.utcnow().replace(microsecond=0)
+        metadata = files.FileMetadata(name=path.rpartition('/')[2],
+                id=f'id:{next(self._ids)}', path_lower=key,
+                path_display=path, size=size,
+                rev=f'{next(self._ids):015x}',
+                content_hash=sha256(f'{key}:{size}'.encode()).hexdigest(),
+                client_modified=now, server_modified=now)
+        with self._lock:
+            self._add(metadata)
+        return metadata
+
+    # ........................................................................
+    def add_files(self, folder, number, size):
+        '''Create many files of the same size in a folder.'''
+        for i in range(number):
+            self.add_file(f'{folder}/file{i:07d}.bin', size)
+
+    # ........................................................................
+    def _add(self, metadata):
+        '''Store an entry; the lock must be held.'''
+        key = metadata.path_lower
+        if key not in self._entries:
+            self._children[key.rpartition('/')[0]][key] = True
+        if isinstance(metadata, files.FolderMetadata):
+            self._children.setdefault(key, {})
+        self._entries[key] = metadata
+
+    # ........................................................................
+    def _remove(self, key):
+        '''Remove an entry and all its contents; the lock must be held.'''
+        metadata = self._entries.pop(key)
+        self._children.get(key.rpartition('/')[0], {}).pop(key, None)
+        for child in list(self._children.pop(key, ())):
+            self._remove(child)
+        return metadata
+
+    # ........................................................................
+    def start(self):
+        '''Serve the API from a thread, on a free local port.'''
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self.address = self._server.server_address
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    # ........................................................................
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # ........................................................................
+    def mount(self, session, pool_size=64):
+        '''Send the Dropbox API calls of a requests.Session to this server.
+
+        The Dropbox SDK always calls HTTPS URLs, which are rewritten to the
+        plain HTTP of the server.
+        '''
+        adapter = _LocalAdapter(f'http://{self.address[0]}:{self.address[1]}',
+                pool_connections=pool_size, pool_maxsize=pool_size)
+        for host in (API_HOST, API_CONTENT_HOST, API_NOTIFICATION_HOST):
+            session.mount(f'https://{host}/', adapter)
+        return session
+
+    # ........................................................................
+    def async_client(self):
+        '''Return an httpx.AsyncClient that sends the Dropbox API calls
+        to this server, e.g. for an AsyncDropbox.'''
+        return httpx.AsyncClient(transport=_LocalTransport(self.address))
+
+    # ........................................................................
+    def call(self, name, arg, body):
+        '''Run a route, returning its result; downloads return the file's
+        metadata. Route errors raise FakeDropboxError.'''
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+        return getattr(self, 'route_' + name.replace('/', '_'))(arg, body)
+
+    # ........................................................................
+    def _get(self, path):
+        key = path.lower().rstrip('/')
+        if key.startswith('rev:'):
+            for metadata in self._entries.values():
+                if getattr(metadata, 'rev', None) == key[4:]:
+                    return metadata
+            key = None
+        if key not in self._entries:
+            raise FakeDropboxError(files.LookupError.not_found)
+        # The root folder has no metadata
+        return self._entries[key]
+
+    # ........................................................................
+    def route_users_get_current_account(self, arg, body):
+        return users.FullAccount(account_id='dbid:' + 'A' * 35,
+                name=users.Name('Fake', 'Account', 'Fake', 'Fake Account',
+                                'FA'),
+                email='fake@example.com', email_verified=True,
+                disabled=False, locale='en',
+                referral_link='https://www.dropbox.com/referrals/fake',
+                is_paired=False, account_type=users_common.AccountType.basic,
+                root_info=common.UserRootInfo('1', '1'))
+
+    # ........................................................................
+    def route_files_list_folder(self, arg, body):
+        try:
+            self._get(arg.path)
+        except FakeDropboxError as e:
+            raise FakeDropboxError(files.ListFolderError.path(e.error))
+        return self._page({'path': arg.path.lower().rstrip('/'), 'offset': 0,
+                           'recursive': arg.recursive})
+
+    # ........................................................................
+    def route_files_list_folder_continue(self, arg, body):
+        return self._page(json.loads(base64.b64decode(arg.cursor)))
+
+    # ........................................................................
+    def route_files_list_folder_get_latest_cursor(self, arg, body):
+        self.route_files_list_folder(arg, body)
+        key = arg.path.lower().rstrip('/')
+        with self._lock:
+            offset = len(self._listing(key, arg.recursive))
+        cursor = {'path': key, 'offset': offset, 'recursive': arg.recursive}
+        return files.ListFolderGetLatestCursorResult(
+                base64.b64encode(json.dumps(cursor).encode()).decode())
+
+    # ........................................................................
+    def route_files_list_folder_longpoll(self, arg, body):
+        '''Wait until entries are added after a cursor; since cursors are
+        offsets, removed entries are not reported.'''
+        cursor = json.loads(base64.b64decode(arg.cursor))
+        deadline = time.monotonic() + arg.timeout
+        while True:
+            with self._lock:
+                changes = len(self._listing(cursor['path'],
+                        cursor['recursive'])) > cursor['offset']
+            if changes or time.monotonic() >= deadline:
+                return files.ListFolderLongpollResult(changes=changes)
+            time.sleep(0.1)
+
+    # ........................................................................
+    def _page(self, cursor):
+        with self._lock:
+            keys = self._listing(cursor['path'], cursor['recursive'])
+            start = cursor['offset']
+            entries = [self._entries[key]
+                       for key in keys[start:start + self.page_size]]
+        cursor['offset'] = start + len(entries)
+        return files.ListFolderResult(entries=entries,
+                cursor=base64.b64encode(json.dumps(cursor).encode()).decode(),
+                has_more=cursor['offset'] < len(keys))
+
+    # ........................................................................
+    def _listing(self, key, recursive):
+        keys = list(self._children.get(key, ()))
+        if recursive:
+            for child in list(keys):
+                if child in self._children:
+                    keys.extend(self._listing(child, True))
+        return keys
+
+    # ........................................................................
+    def route_files_get_metadata(self, arg, body):
+        try:
+            return self._get(arg.path)
+        except FakeDropboxError as e:
+            raise FakeDropboxError(files.GetMetadataError.path(e.error))
+
+    # ........................................................................
+    def route_files_get_temporary_link(self, arg, body):
+        metadata = self.route_files_get_metadata(arg, body)
+        return files.GetTemporaryLinkResult(metadata,
+                f'http://{self.address[0]}:{self.address[1]}/link'
+                f'{metadata.path_lower}')
+
+    # ........................................................................
+    def route_files_get_thumbnail_batch(self, arg, body):
+        # Thumbnails name their file and size, instead of being images
+        entries = []
+        for entry in arg.entries:
+            try:
+                metadata = self._get(entry.path)
+            except FakeDropboxError as e:
+                entries.append(files.GetThumbnailBatchResultEntry.failure(
+                        files.ThumbnailError.path(e.error)))
+                continue
+            thumbnail = f'{metadata.path_lower}:{entry.size._tag}'.encode()
+            entries.append(files.GetThumbnailBatchResultEntry.success(
+                    files.GetThumbnailBatchResultData(metadata,
+                            base64.b64encode(thumbnail).decode())))
+        return files.GetThumbnailBatchResult(entries)
+
+    # ........................................................................
+    def route_files_create_folder_v2(self, arg, body):
+        if arg.path.lower() in self._entries:
+            raise FakeDropboxError(files.CreateFolderError.path(
+                    files.WriteError.conflict(files.WriteConflictError.folder)))
+        return files.CreateFolderResult(self.add_folder(arg.path))
+
+    # ........................................................................
+    def route_files_create_folder(self, arg, body):
+        return self.route_files_create_folder_v2(arg, body).metadata
+
+    # ........................................................................
+    def route_files_delete(self, arg, body):
+        with self._lock:
+            try:
+                return self._remove(arg.path.lower())
+            except KeyError:
+                raise FakeDropboxError(files.DeleteError.path_lookup(
+                        files.LookupError.not_found))
+
+    # ........................................................................
+    def route_files_delete_v2(self, arg, body):
+        return files.DeleteResult(self.route_files_delete(arg, body))
+
+    # ........................................................................
+    def route_files_copy_batch_v2(self, arg, body):
+        return self._launch(files.RelocationBatchV2Launch,
+                files.RelocationBatchV2Result(
+                    [self._relocate(entry, False) for entry in arg.entries]))
+
+    # ........................................................................
+    def route_files_copy_batch_check_v2(self, arg, body):
+        return files.RelocationBatchV2JobStatus.complete(self._result(arg))
+
+    # ........................................................................
+    def route_files_move_batch_v2(self, arg, body):
+        return self._launch(files.RelocationBatchV2Launch,
+                files.RelocationBatchV2Result(
+                    [self._relocate(entry, True) for entry in arg.entries]))
+
+    # ........................................................................
+    def route_files_move_batch_check_v2(self, arg, body):
+        return files.RelocationBatchV2JobStatus.complete(self._result(arg))
+
+    # ........................................................................
+    def _relocate(self, entry, move):
+        '''Copy or move an entry, with all its contents; new names in use
+        are failures, even with autorename.'''
+        key = entry.from_path.lower().rstrip('/')
+        new_key = entry.to_path.lower().rstrip('/')
+        with self._lock:
+            if key not in self._entries or not key:
+                error = files.RelocationError.from_lookup(
+                        files.LookupError.not_found)
+            elif new_key in self._entries:
+                error = files.RelocationError.to(files.WriteError.conflict(
+                        files.WriteConflictError.file))
+            elif new_key.startswith(key + '/'):
+                error = files.RelocationError.cant_move_folder_into_itself
+            elif new_key.rpartition('/')[0] not in self._children:
+                error = files.RelocationError.to(files.WriteError.conflict(
+                        files.WriteConflictError.folder))
+            else:
+                start = len(key)
+                prefix = entry.to_path.rstrip('/')
+                for old in [key] + self._listing(key, True):
+                    metadata = self._entries[old]
+                    copied = type(metadata)(**{name: getattr(metadata, name)
+                            for name in metadata._all_field_names_
+                            if getattr(metadata, name) is not None})
+                    copied.path_lower = new_key + old[start:]
+                    copied.path_display = prefix + \
+                            metadata.path_display[start:]
+                    copied.name = copied.path_display.rpartition('/')[2]
+                    copied.id = f'id:{next(self._ids)}'
+                    self._add(copied)
+                if move:
+                    self._remove(key)
+                return files.RelocationBatchResultEntry.success(
+                        self._entries[new_key])
+        return files.RelocationBatchResultEntry.failure(
+                files.RelocationBatchErrorEntry.relocation_error(error))
+
+    # ........................................................................
+    def route_files_delete_batch(self, arg, body):
+        entries = []
+        for entry in arg.entries:
+            try:
+                entries.append(files.DeleteBatchResultEntry.success(
+                        files.DeleteBatchResultData(
+                            self.route_files_delete(entry, body))))
+            except FakeDropboxError as e:
+                entries.append(files.DeleteBatchResultEntry.failure(e.error))
+        return self._launch(files.DeleteBatchLaunch,
+                files.DeleteBatchResult(entries))
+
+    # ........................................................................
+    def route_files_delete_batch_check(self, arg, body):
+        return files.DeleteBatchJobStatus.complete(self._result(arg))
+
+    # ........................................................................
+    def route_files_create_folder_batch(self, arg, body):
+        entries = []
+        for path in arg.paths:
+            try:
+                metadata = self.route_files_create_folder_v2(
+                        files.CreateFolderArg(path), body).metadata
+                entries.append(files.CreateFolderBatchResultEntry.success(
+                        files.CreateFolderEntryResult(metadata)))
+            except FakeDropboxError:
+                entries.append(files.CreateFolderBatchResultEntry.failure(
+                        files.CreateFolderEntryError.path(
+                            files.WriteError.conflict(
+                                files.WriteConflictError.folder))))
+        result = files.CreateFolderBatchResult(entries)
+        if not arg.force_async:
+            return files.CreateFolderBatchLaunch.complete(result)
+        return self._launch(files.CreateFolderBatchLaunch, result)
+
+    # ........................................................................
+    def route_files_create_folder_batch_check(self, arg, body):
+        return files.CreateFolderBatchJobStatus.complete(self._result(arg))
+
+    # ........................................................................
+    def _launch(self, launch_type, result):
+        '''Answer a batch, done already, as an asynchronous job, so that
+        clients poll it like the jobs of Dropbox.'''
+        job_id = f'dbjid:{next(self._ids)}'
+        with self._lock:
+            self._jobs[job_id] = result
+        return launch_type.async_job_id(job_id)
+
+    # ........................................................................
+    def _result(self, arg):
+        with self._lock:
+            result = self._jobs.pop(arg.async_job_id, None)
+        if result is None:
+            raise FakeDropboxError(files.PollError.invalid_async_job_id)
+        return result
+
+    # ........................................................................
+    def route_files_download(self, arg, body):
+        try:
+            metadata = self._get(arg.path)
+        except FakeDropboxError as e:
+            raise FakeDropboxError(files.DownloadError.path(e.error))
+        return metadata
+
+    # ........................................................................
+    def route_files_upload(self, arg, body):
+        return self._commit(arg, len(body))
+
+    # ........................................................................
+    def _commit(self, commit, size):
+        path = commit.path
+        if commit.mode.is_add() and path.lower() in self._entries:
+            root, dot, extension = path.rpartition('.')
+            if not dot or '/' in extension:
+                root, extension = path, ''
+            else:
+                extension = '.' + extension
+            number = 1
+            while f'{root} ({number}){extension}'.lower() in self._entries:
+                number += 1
+            path = f'{root} ({number}){extension}'
+        return self.add_file(path, size)
+
+    # ........................................................................
+    def route_files_upload_session_start(self, arg, body):
+        session_id = uuid4().hex
+        with self._lock:
+            self._sessions[session_id] = len(body)
+        return files.UploadSessionStartResult(session_id)
+
+    # ........................................................................
+    def route_files_upload_session_append_v2(self, arg, body):
+        self._append(arg.cursor, body)
+
+    # ........................................................................
+    def _append(self, cursor, body):
+        with self._lock:
+            size = self._sessions.get(cursor.session_id)
+            if size is None:
+                raise FakeDropboxError(files.UploadSessionLookupError.not_found)
+            # Concurrent sessions may receive chunks out of order
+            self._sessions[cursor.session_id] = max(size,
+                    cursor.offset + len(body))
+
+    # ........................................................................
+    def route_files_upload_session_finish(self, arg, body):
+        self._append(arg.cursor, body)
+        with self._lock:
+            size = self._sessions.pop(arg.cursor.session_id)
+        return self._commit(arg.commit, size)
+
+    # ........................................................................
+    def route_files_upload_session_finish_batch(self, arg, body):
+        entries = []
+        for entry in arg.entries:
+            with self._lock:
+                size = self._sessions.pop(entry.cursor.session_id)
+            entries.append(files.UploadSessionFinishBatchResultEntry.success(
+                    self._commit(entry.commit, size)))
+        return files.UploadSessionFinishBatchLaunch.complete(
+                files.UploadSessionFinishBatchResult(entries))
+
+    # ........................................................................
+    def route_files_upload_session_finish_batch_check(self, arg, body):
+        raise FakeDropboxError(files.PollError.invalid_async_job_id)
+
+
+# ----------------------------------------------------------------------------
+class _LocalAdapter(HTTPAdapter):
+    '''Send requests for HTTPS URLs to a local plain HTTP server.'''
+
+    # ........................................................................
+    def __init__(self, origin, **kwargs):
+        super().__init__(**kwargs)
+        self.origin = origin
+
+    # ........................................................................
+    def send(self, request, **kwargs):
+        request.url = self.origin + '/' + request.url.split('/', 3)[3]
+        return super().send(request, **kwargs)
+
+
+# ----------------------------------------------------------------------------
+class _LocalTransport(httpx.AsyncHTTPTransport):
+    '''Send asynchronous requests for HTTPS URLs to a local plain HTTP
+    server.'''
+
+    # ........................................................................
+    def __init__(self, address):
+        super().__init__()
+        self.address = address
+
+    # ........................................................................
+    async def handle_async_request(self, method, url, *args, **kwargs):
+        host, port = self.address
+        url = (b'http', host.encode(), port, url[3])
+        return await super().handle_async_request(method, url, *args,
+                                                  **kwargs)
+
+
+# ----------------------------------------------------------------------------
+class _Handler(BaseHTTPRequestHandler):
+    '''Answer the HTTP requests of a FakeDropbox.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    # ........................................................................
+    def log_message(self, format, *args):
+        pass
+
+    # ........................................................................
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionError:
+            # Clients may drop a connection at any time, e.g. while a
+            # download is being sent
+            pass
+
+    # ........................................................................
+    def do_GET(self):
+        '''Serve the temporary links of files.'''
+        fake = self.server.fake
+        time.sleep(fake.latency)
+        metadata = fake._entries.get(self.path[len('/link'):].lower())
+        if not self.path.startswith('/link/') or metadata is None:
+            return self._send_json(404, None, text='Not found')
+        self._send_content(fake, None, metadata)
+
+    # ........................................................................
+    def do_POST(self):
+        fake = self.server.fake
+        body = self._read_body(fake)
+        time.sleep(fake.latency)
+        if fake.bucket is not None:
+            try:
+                fake.bucket.reserve(0)
+            except DropboxUnavailable:
+                return self._send_json(429, {
+                        'error_summary': 'too_many_requests/',
+                        'error': {'reason': {'.tag': 'too_many_requests'},
+                                  'retry_after': 1}},
+                        {'Retry-After': '1'})
+        name = self.path[len('/2/'):]
+        if name not in _ROUTES:
+            return self._send_json(400, None, text=f'Unknown route {name}')
+        style, route = _ROUTES[name]
+        if style == 'rpc':
+            raw_arg = body or b'null'
+        else:
+            raw_arg = self.headers['Dropbox-API-Arg']
+        try:
+            arg = json_compat_obj_decode(route.arg_type, json.loads(raw_arg))
+            result = fake.call(name, arg, body)
+        except FakeDropboxError as e:
+            return self._send_json(409, {
+                    'error_summary': str(e.error),
+                    'error': json.loads(json_encode(route.error_type,
+                                                    e.error))})
+        except Exception as e:
+            return self._send_json(500, None, text=repr(e))
+        if style == 'download':
+            return self._send_content(fake, route, result)
+        self._send_json(200, json.loads(json_encode(route.result_type,
+                                                    result)))
+
+    # ........................................................................
+    def _read_body(self, fake):
+        '''Read the request body, at the simulated bandwidth.'''
+        remaining = int(self.headers.get('Content-Length') or 0)
+        parts = []
+        while remaining > 0:
+            part = self.rfile.read(min(remaining, len(_PATTERN)))
+            if not part:
+                break
+            parts.append(part)
+            remaining -= len(part)
+            if fake.bandwidth:
+                time.sleep(len(part) / fake.bandwidth)
+        return b''.join(parts)
+
+    # ........................................................................
+    def _send_json(self, status, content, headers=None, text=None):
+        data = (json.dumps(content) if text is None else text).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json' if text is None
+                         else 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    # ........................................................................
+    def _send_content(self, fake, route, metadata):
+        '''Send the content of a file, honoring Range headers, as the
+        result of a download route, if given.'''
+        start, end = 0, metadata.size - 1
+        status = 200
+        byte_range = self.headers.get('Range')
+        if byte_range and fake.ranges:
+            first, last = byte_range[len('bytes='):].split('-')
+            start = int(first)
+            end = min(end, int(last)) if last else end
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(max(0, end - start + 1)))
+        if route is not None:
+            self.send_header('Dropbox-API-Result',
+                             json_encode(route.result_type, metadata))
+        if status == 206:
+            self.send_header('Content-Range',
+                             f'bytes {start}-{end}/{metadata.size}')
+        self.end_headers()
+        position = start
+        while position <= end:
+            offset = position % 256
+            part = _PATTERN[offset:offset + min(len(_PATTERN) - offset,
+                                                end - position + 1)]
+            try:
+                self.wfile.write(part)
+            except ConnectionError:
+                # Clients may stop reading a download, e.g. after a part
+                self.close_connection = True
+                return
+            position += len(part)
+            if fake.bandwidth:
+                time.sleep(len(part) / fake.bandwidth)
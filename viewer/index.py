@@ -0,0 +1,320 @@
+import logging
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from threading import Lock, Thread
+
+from dropbox.exceptions import ApiError, AuthError
+from dropbox.files import FileMetadata, FolderMetadata
+
+from .scheduler import TRANSIENT_ERRORS, DropboxUnavailable
+
+logger = logging.getLogger(__name__)
+
+
+# ----------------------------------------------------------------------------
+class FolderSizes:
+    '''The total size and number of files under each folder of an account.
+
+    Only the size of each file and the totals of each folder are kept, both
+    keyed by lower-case path, so the index stays compact. The totals of a
+    folder include all its subfolders.
+
+    Attributes:
+    files   : dict of file sizes, in bytes
+    folders : dict of [size, count] lists; the root folder is ''
+    '''
+
+    # ........................................................................
+    def __init__(self):
+        self.files = {}
+        self.folders = {'': [0, 0]}
+        self._files_range = _PathRange(self.files)
+        self._folders_range = _PathRange(self.folders)
+
+    # ........................................................................
+    def get(self, path):
+        '''Return the (size, count) of the files under a folder, or None if
+        the folder is unknown.'''
+        totals = self.folders.get(path.rstrip('/').lower())
+        return None if totals is None else tuple(totals)
+
+    # ........................................................................
+    def apply(self, entries):
+        '''Update the totals with the entries of a recursive listing.
+
+        Parameter:
+        entries : iterable of Dropbox metadata, from the pages of
+                  files_list_folder or files_list_folder_continue
+        '''
+        for metadata in entries:
+            path = metadata.path_lower
+            if isinstance(metadata, FileMetadata):
+                self._remove_folder(path)
+                old = self.files.get(path)
+                if old is None:
+                    self._files_range.added()
+                self.files[path] = metadata.size
+                self._add(path, metadata.size - (old or 0),
+                          0 if old is not None else 1)
+            elif isinstance(metadata, FolderMetadata):
+                self._remove_file(path)
+                self._folder(path)
+            else:
+                # A deleted entry may have been a file or a folder
+                self._remove_file(path)
+                self._remove_folder(path)
+
+    # ........................................................................
+    def _add(self, path, size, count):
+        '''Add to the totals of every folder above path.'''
+        folder = path
+        while folder:
+            folder = folder.rpartition('/')[0]
+            totals = self._folder(folder)
+            totals[0] += size
+            totals[1] += count
+
+    # ........................................................................
+    def _folder(self, path):
+        '''Return the totals of a folder, added if missing.'''
+        totals = self.folders.get(path)
+        if totals is None:
+            totals = self.folders[path] = [0, 0]
+            self._folders_range.added()
+        return totals
+
+    # ........................................................................
+    def _remove_file(self, path):
+        size = self.files.pop(path, None)
+        if size is not None:
+            self._add(path, -size, -1)
+
+    # ........................................................................
+    def _remove_folder(self, path):
+        totals = self.folders.pop(path, None)
+        if totals is None:
+            return
+        self._add(path, -totals[0], -totals[1])
+        # Dropbox only reports the deletion of the folder itself
+        self._files_range.remove_below(path)
+        self._folders_range.remove_below(path)
+
+
+# ----------------------------------------------------------------------------
+class _PathRange:
+    '''Remove the entries below a folder from a dict keyed by lower-case
+    path, without scanning the whole dict.
+
+    The keys below a folder are a range of the sorted keys, found by
+    bisection. The keys are only sorted again after new ones were added,
+    which must be told by calling added(); keys removed from the dict
+    otherwise are simply skipped.
+    '''
+
+    # ........................................................................
+    def __init__(self, paths):
+        self.paths = paths
+        self._sorted = []
+        self._stale = True
+
+    # ........................................................................
+    def added(self):
+        self._stale = True
+
+    # ........................................................................
+    def remove_below(self, path):
+        if self._stale:
+            self._sorted = sorted(self.paths)
+            self._stale = False
+        start = bisect_left(self._sorted, path + '/')
+        # No path below the folder reaches the next character after '/'
+        end = bisect_left(self._sorted, path + '0', start)
+        for key in self._sorted[start:end]:
+            self.paths.pop(key, None)
+        del self._sorted[start:end]
+
+
+# ----------------------------------------------------------------------------
+class NameIndex:
+    '''The names of all files and folders of an account, for fast search.
+
+    The display path of each entry is kept, keyed by lower-case path, with
+    a trailing '/' for folders. Searches use a snapshot made by build(): the
+    paths sorted by name, for prefix lookups, and a single string with all
+    the names, where substrings are found at the speed of str.find().
+
+    Attributes:
+    entries : dict of display paths
+    '''
+
+    # ........................................................................
+    def __init__(self):
+        self.entries = {}
+        self._snapshot = ([], [], '', array('q'))
+        self._range = _PathRange(self.entries)
+
+    # ........................................................................
+    def apply(self, entries):
+        '''Update the index with the entries of a recursive listing; call
+        build() afterwards to make the changes searchable.
+
+        Parameter:
+        entries : iterable of Dropbox metadata, from the pages of
+                  files_list_folder or files_list_folder_continue
+        '''
+        for metadata in entries:
+            path = metadata.path_lower
+            if isinstance(metadata, (FileMetadata, FolderMetadata)):
+                if path not in self.entries:
+                    self._range.added()
+                self.entries[path] = metadata.path_display + (
+                        '/' if isinstance(metadata, FolderMetadata) else '')
+            elif self.entries.pop(path, '').endswith('/'):
+                # Dropbox only reports the deletion of the folder itself
+                self._range.remove_below(path)
+
+    # ........................................................................
+    def build(self):
+        '''Make a new snapshot of the entries for searches.'''
+        paths = list(self.entries.values())
+        names = [_name_key(path) for path in paths]
+        order = sorted(range(len(names)), key=names.__getitem__)
+        paths = [paths[i] for i in order]
+        names = [names[i] for i in order]
+        offsets = array('q', [0])
+        offsets.extend(accumulate(len(name) + 1 for name in names))
+        self._snapshot = (paths, names, '\n'.join(names), offsets)
+
+    # ........................................................................
+    def search(self, query, limit):
+        '''Return the display paths of the entries whose names contain a
+        string, ignoring case; folders end with '/'.
+
+        Names that start with the string come first, in alphabetical order.
+
+        Parameters:
+        query : the string searched
+        limit : the maximum number of paths returned
+        '''
+        query = query.lower()
+        if not query or '\n' in query:
+            return []
+        paths, names, text, offsets = self._snapshot
+        found = []
+        prefixed = set()
+        i = bisect_left(names, query)
+        while i < len(names) and names[i].startswith(query) and \
+                len(found) < limit:
+            found.append(paths[i])
+            prefixed.add(i)
+            i += 1
+        position = text.find(query)
+        while position >= 0 and len(found) < limit:
+            i = bisect_right(offsets, position) - 1
+            if i not in prefixed:
+                found.append(paths[i])
+            position = text.find(query, offsets[i + 1])
+        return found
+
+
+def _name_key(path):
+    '''The lower-case name of a NameIndex entry.'''
+    return path.rstrip('/').rpartition('/')[2].lower()
+
+
+# ----------------------------------------------------------------------------
+class AccountIndex:
+    '''An index of a whole Dropbox account, kept current in the background.
+
+    It is built from a recursive listing of the storage's root, applied
+    page by page as it arrives, so the listing itself is never held in
+    memory. Afterwards, only the changes listed by its cursor are applied.
+    Updates run in a thread, started by refresh() at most once every
+    refresh seconds, so readers never wait for Dropbox.
+
+    Attributes:
+    sizes   : the FolderSizes of the account, or None until first built
+    names   : the NameIndex of the account, or None until first built
+    cursor  : the cursor that lists the changes made after the last update
+    checked : the time when the index was last brought up to date
+    version : a number increased after each update that changed the index
+    '''
+
+    # ........................................................................
+    def __init__(self, storage, refresh):
+        self.storage = storage
+        self.refresh_interval = refresh
+        self.sizes = None
+        self.names = None
+        self.cursor = None
+        self.checked = 0
+        self.version = 0
+        self._lock = Lock()
+        self._thread = None
+
+    # ........................................................................
+    def refresh(self):
+        '''Start updating the index, unless it is recent or being updated.'''
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if time.time() - self.checked < self.refresh_interval:
+                return
+            self._thread = Thread(target=self._update, daemon=True)
+            self._thread.start()
+
+    # ........................................................................
+    def expire(self):
+        '''Make the next refresh() check for changes.'''
+        self.checked = 0
+
+    # ........................................................................
+    def _update(self):
+        '''Apply the recent changes, or build the index from scratch.'''
+        checked = time.time()
+        changes = []
+        try:
+            if self.cursor is not None:
+                try:
+                    self.cursor = self._apply(self.sizes, self.names,
+                            self.storage.list_pages('', self.cursor), changes)
+                except ApiError as e:
+                    # Dropbox may reset a cursor, requiring a new listing
+                    if not e.error.is_reset():
+                        raise
+                    self.cursor = None
+            if self.cursor is None:
+                sizes = FolderSizes()
+                names = NameIndex()
+                cursor = self._apply(sizes, names,
+                        self.storage.list_pages('', recursive=True), changes)
+                self.sizes, self.names, self.cursor = sizes, names, cursor
+        except (ApiError, AuthError, DropboxUnavailable) + TRANSIENT_ERRORS:
+            # The index is kept as it was, and retried on the next refresh
+            logger.exception('Updating the index of %s failed',
+                             self.storage.root_path)
+        finally:
+            if changes:
+                self.version += 1
+            self.checked = checked
+
+    # ........................................................................
+    def _apply(self, sizes, names, pages, changes):
+        '''Apply the pages of a listing, returning its last cursor. The
+        entries applied are counted in the changes list, and the names are
+        only made searchable again if there were any.'''
+        cursor = None
+        applied = len(changes)
+        try:
+            for result in pages:
+                if result.entries:
+                    changes.append(len(result.entries))
+                sizes.apply(result.entries)
+                names.apply(result.entries)
+                cursor = result.cursor
+        finally:
+            if len(changes) > applied:
+                names.build()
+        return cursor
@@ -0,0 +1,148 @@
+import logging
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from threading import Lock
+from uuid import uuid4
+
+from dropbox.exceptions import ApiError, AuthError
+
+from .dropbox import DropBoxStorageException, setting
+from .scheduler import TRANSIENT_ERRORS, DropboxUnavailable
+
+_DEFAULT_JOB_WORKERS = 2
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------------------------------------------------------
+@lru_cache(maxsize=None)
+def get_job_executor():
+    '''Return the threads that run bulk jobs, shared by all accounts.
+
+    Their number is given by settings.DROPBOX_JOB_WORKERS. Each job waits
+    for Dropbox most of the time, so a few threads serve many accounts.
+    '''
+    return ThreadPoolExecutor(setting('DROPBOX_JOB_WORKERS',
+            _DEFAULT_JOB_WORKERS))
+
+
+# ----------------------------------------------------------------------------
+class BulkJob:
+    '''An operation on many Dropbox entries, run in the background.
+
+    Attributes:
+    id        : a random identifier, which cannot be guessed
+    operation : the operation's name, e.g. 'move'
+    paths     : the absolute paths of the entries
+    done      : the number of entries processed so far
+    failures  : list of (path, reason) pairs, for the entries that failed
+    finished  : whether the job has ended
+    error     : the reason why the whole job failed, or None
+    '''
+
+    # ........................................................................
+    def __init__(self, operation, paths):
+        self.id = uuid4().hex
+        self.operation = operation
+        self.paths = paths
+        self.done = 0
+        self.failures = []
+        self.finished = False
+        self.error = None
+
+    # ........................................................................
+    def progress(self, done):
+        self.done = done
+
+    # ........................................................................
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'operation': self.operation,
+            'total': len(self.paths),
+            'done': self.done,
+            'failures': [{'path': path, 'reason': reason}
+                         for path, reason in self.failures],
+            'finished': self.finished,
+            'error': self.error,
+        }
+
+
+# ----------------------------------------------------------------------------
+class JobList:
+    '''The bulk jobs of a Dropbox account.
+
+    Jobs are run by the threads of get_job_executor(), and kept until
+    MAX_JOBS newer ones were started, so that their progress can be asked.
+    The threads are shared by all accounts, so an account runs at most
+    MAX_RUNNING jobs at once; the others wait in turn, and are not counted
+    as done until they start.
+    '''
+
+    MAX_JOBS = 32
+    MAX_RUNNING = 1
+
+    # ........................................................................
+    def __init__(self):
+        self._jobs = OrderedDict()
+        self._waiting = deque()
+        self._running = 0
+        self._lock = Lock()
+
+    # ........................................................................
+    def start(self, operation, paths, run):
+        '''Start a job in the background, and return its BulkJob.
+
+        Parameters:
+        operation : the operation's name
+        paths     : the absolute paths of the entries
+        run       : a function that processes all the entries, given a
+                    function to call with the number of entries done; it
+                    returns a (metadata, error) pair for each entry
+        '''
+        job = BulkJob(operation, paths)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.MAX_JOBS:
+                self._jobs.popitem(last=False)
+            if self._running >= self.MAX_RUNNING:
+                self._waiting.append((job, run))
+                return job
+            self._running += 1
+        get_job_executor().submit(self._run, job, run)
+        return job
+
+    # ........................................................................
+    def get(self, job_id):
+        '''Return the BulkJob with an id, or None if it is unknown.'''
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    # ........................................................................
+    def unfinished(self):
+        '''Whether any job is running or waiting to run.'''
+        with self._lock:
+            return self._running > 0
+
+    # ........................................................................
+    def _run(self, job, run):
+        try:
+            results = run(job.progress)
+            job.failures = [(path, error) for path, (metadata, error)
+                            in zip(job.paths, results) if error is not None]
+        except AuthError:
+            job.error = 'The access to Dropbox was revoked'
+        except (ApiError, DropBoxStorageException, DropboxUnavailable) + \
+                TRANSIENT_ERRORS as e:
+            job.error = str(e)
+        except Exception as e:
+            logger.exception('Bulk %s failed', job.operation)
+            job.error = repr(e)
+        finally:
+            job.finished = True
+            with self._lock:
+                following = self._waiting.popleft() if self._waiting else None
+                if following is None:
+                    self._running -= 1
+            if following is not None:
+                get_job_executor().submit(self._run, *following)
@@ -0,0 +1,305 @@
+import resource
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from tempfile import TemporaryFile
+from types import SimpleNamespace
+
+from django.core.files.base import File
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from dropbox.files import FileMetadata, FolderMetadata, ListFolderResult
+
+from viewer import views
+from viewer.fakedropbox import FakeDropbox
+
+MB = 1024 * 1024
+
+
+# ----------------------------------------------------------------------------
+class SlowClient:
+    '''A stand-in for the Dropbox client that answers after a fixed delay.
+
+    It counts the API calls made, and serves a small folder for listing.
+    '''
+
+    # ........................................................................
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    # ........................................................................
+    def _call(self):
+        self.calls += 1
+        time.sleep(self.latency)
+
+    # ........................................................................
+    def users_get_current_account(self):
+        self._call()
+        return SimpleNamespace(account_id='dbid:benchmark')
+
+    # ........................................................................
+    def files_list_folder(self, path, recursive=False):
+        self._call()
+        entries = [FolderMetadata(name='folder', id='id:0',
+                                  path_lower='/folder',
+                                  path_display='/folder')]
+        for i in range(1, 20):
+            entries.append(FileMetadata(name=f'file{i}.txt', id=f'id:{i}',
+                    path_lower=f'/file{i}.txt',
+                    path_display=f'/file{i}.txt', size=1024 * i,
+                    rev='0123456789abcdef', content_hash='0' * 64,
+                    client_modified=datetime(2021, 1, 1),
+                    server_modified=datetime(2021, 1, 1)))
+        return ListFolderResult(entries=entries, cursor='cursor',
+                                has_more=False)
+
+
+# ----------------------------------------------------------------------------
+class Command(BaseCommand):
+    help = 'Measure the time spent by the viewer to handle requests.'
+
+    # ........................................................................
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=['access', 'listfolder',
+                'download', 'upload', 'load'],
+                help='access: per-request cost of the access check; '
+                     'listfolder: listing a huge folder; '
+                     'download: relaying a large file; '
+                     'upload: sending a large file in chunks; '
+                     'load: many users browsing at once')
+        parser.add_argument('--requests', type=int, default=20,
+                help='number of requests in each measurement, or by each '
+                     'user')
+        parser.add_argument('--latency', type=float, default=0.1,
+                help='simulated Dropbox round trip, in seconds')
+        parser.add_argument('--bandwidth', type=float, default=None,
+                help='simulated Dropbox bandwidth, in MB/s (default: '
+                     'unlimited)')
+        parser.add_argument('--page-size', type=int, default=2000,
+                help='entries in each page of a Dropbox listing')
+        parser.add_argument('--rate-limit', type=float, default=None,
+                help='requests per second accepted by Dropbox (default: '
+                     'unlimited)')
+        parser.add_argument('--files', type=int, default=20000,
+                help='files in the folder listed')
+        parser.add_argument('--size', type=int, default=256,
+                help='size of the file downloaded or uploaded, in MB')
+        parser.add_argument('--users', type=int, default=20,
+                help='concurrent users')
+        parser.add_argument('--download-workers', type=int, default=None,
+                help='connections that download a large file at once '
+                     '(default: settings.DROPBOX_DOWNLOAD_WORKERS)')
+
+    # ........................................................................
+    def handle(self, *args, **options):
+        getattr(self, 'bench_' + options['scenario'])(options)
+
+    # ........................................................................
+    def report(self, label, elapsed, requests, calls):
+        self.stdout.write(f'{label:<24} {1000 * elapsed / requests:8.1f} ms'
+                          f'/request {calls / requests:6.2f} calls/request')
+
+    # ........................................................................
+    def bench_access(self, options):
+        '''Compare verifying the account on every request with the cached
+        account, when listing a folder whose listing is already cached.'''
+        client = SlowClient(options['latency'])
+        dropbox = views.registry.new()
+        dropbox.connect('benchmark')
+        dropbox.storage.client = client
+        dropbox.has_access()
+        request = RequestFactory().get('/viewer/')
+        request.session = {}
+        views.registry.register(request.session, dropbox)
+        requests = options['requests']
+
+        for label, verify in (('verify every request', True),
+                              ('cached account', False)):
+            dropbox.account = None
+            views.listfolder(request)
+            client.calls = 0
+            start = time.perf_counter()
+            for i in range(requests):
+                if verify:
+                    dropbox.account = None
+                views.listfolder(request)
+            elapsed = time.perf_counter() - start
+            self.report(label, elapsed, requests, client.calls)
+
+    # ........................................................................
+    def start_fake(self, options):
+        '''Start a FakeDropbox with the simulated network conditions.'''
+        bandwidth = options['bandwidth']
+        return FakeDropbox(latency=options['latency'],
+                bandwidth=bandwidth * MB if bandwidth else None,
+                page_size=options['page_size'],
+                rate_limit=options['rate_limit']).start()
+
+    # ........................................................................
+    def connect(self, fake):
+        '''Return a request whose session is connected to the account of
+        a FakeDropbox, through the real Dropbox clients.
+
+        Background work that would skew the measures (the account index,
+        the content cache and the thumbnails) is disabled.
+        '''
+        fake.mount(views.registry.http_session)
+        dropbox = views.registry.new()
+        dropbox.connect('benchmark')
+        dropbox.index = None
+        dropbox.thumbnail_size = None
+        dropbox.download_mode = 'proxy'
+        dropbox.storage.content_cache = None
+        dropbox.has_access()
+        request = RequestFactory().get('/viewer/')
+        request.session = {}
+        views.registry.register(request.session, dropbox)
+        return request
+
+    # ........................................................................
+    def calls(self, fake):
+        return sum(fake.requests.values())
+
+    # ........................................................................
+    def bench_listfolder(self, options):
+        '''Measure the first page of a huge folder, listed in full from
+        Dropbox, updated with its changes, from the listing cache, and
+        revalidated by a browser that has it.'''
+        fake = self.start_fake(options)
+        fake.add_files('/huge', options['files'], 1024)
+        request = self.connect(fake)
+        dropbox = views.registry.get(request.session)
+        requests = options['requests']
+
+        key = dropbox._listing_key('/huge')
+        for label, renew in (
+                ('full listing', lambda: dropbox.listings.delete(key)),
+                ('listed changes', lambda: dropbox._expire_listing('/huge')),
+                ('cached listing', lambda: None)):
+            views.listfolder(request, url='huge')
+            calls = self.calls(fake)
+            start = time.perf_counter()
+            for i in range(requests):
+                renew()
+                views.listfolder(request, url='huge')
+            elapsed = time.perf_counter() - start
+            self.report(label, elapsed, requests, self.calls(fake) - calls)
+
+        # As sent by a browser with the page and its CSRF cookie
+        request.META['CSRF_COOKIE'] = 'benchmark'
+        request.META['HTTP_IF_NONE_MATCH'] = \
+                views.listfolder(request, url='huge')['ETag']
+        calls = self.calls(fake)
+        start = time.perf_counter()
+        for i in range(requests):
+            views.listfolder(request, url='huge')
+        elapsed = time.perf_counter() - start
+        self.report('not modified', elapsed, requests, self.calls(fake) - calls)
+        fake.stop()
+
+    # ........................................................................
+    def bench_download(self, options):
+        '''Measure relaying a large file: the time to its first byte, the
+        throughput and the memory held.'''
+        fake = self.start_fake(options)
+        size = options['size'] * MB
+        fake.add_file('/large.bin', size)
+        request = self.connect(fake)
+        if options['download_workers'] is not None:
+            views.registry.get(request.session).storage.download_workers = \
+                    options['download_workers']
+        rss = _peak_rss()
+        calls = self.calls(fake)
+
+        start = time.perf_counter()
+        response = views.download(request, name='large.bin')
+        first_byte = None
+        received = 0
+        for chunk in response.streaming_content:
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            received += len(chunk)
+        response.close()
+        elapsed = time.perf_counter() - start
+        fake.stop()
+
+        self.report('download', elapsed, 1, self.calls(fake) - calls)
+        self.stdout.write(f'{"time to first byte":<24} '
+                          f'{1000 * (first_byte or elapsed):8.1f} ms')
+        self.stdout.write(f'{"throughput":<24} '
+                          f'{received / MB / elapsed:8.1f} MB/s')
+        self.stdout.write(f'{"peak memory growth":<24} '
+                          f'{(_peak_rss() - rss) / MB:8.1f} MB')
+
+    # ........................................................................
+    def bench_upload(self, options):
+        '''Measure the throughput of a large file uploaded in chunks.'''
+        fake = self.start_fake(options)
+        size = options['size'] * MB
+        request = self.connect(fake)
+        storage = views.registry.get(request.session).storage
+        calls = self.calls(fake)
+
+        with TemporaryFile() as content:
+            content.truncate(size)
+            start = time.perf_counter()
+            storage.save('/upload.bin', File(content))
+            elapsed = time.perf_counter() - start
+        fake.stop()
+
+        self.report('upload', elapsed, 1, self.calls(fake) - calls)
+        self.stdout.write(f'{"throughput":<24} {size / MB / elapsed:8.1f} MB/s')
+
+    # ........................................................................
+    def bench_load(self, options):
+        '''Measure many users browsing at once: each one lists a folder
+        and downloads a file from it, in turns.'''
+        fake = self.start_fake(options)
+        fake.add_files('/shared', 50, 64 * 1024)
+        request = self.connect(fake)
+        calls = self.calls(fake)
+
+        def browse(user):
+            latencies, statuses = [], Counter()
+            for i in range(options['requests']):
+                start = time.perf_counter()
+                if i % 2:
+                    response = views.download(request,
+                            name=f'shared/file{(user + i) % 50:07d}.bin')
+                    for chunk in response.streaming_content:
+                        pass
+                    response.close()
+                else:
+                    response = views.listfolder(request, url='shared')
+                latencies.append(time.perf_counter() - start)
+                statuses[response.status_code] += 1
+            return latencies, statuses
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options['users']) as executor:
+            results = list(executor.map(browse, range(options['users'])))
+        elapsed = time.perf_counter() - start
+        fake.stop()
+
+        latencies = sorted(latency for user, statuses in results
+                           for latency in user)
+        statuses = sum((statuses for user, statuses in results), Counter())
+        self.report('load', elapsed, len(latencies),
+                    self.calls(fake) - calls)
+        self.stdout.write(f'{"requests per second":<24} '
+                          f'{len(latencies) / elapsed:8.1f}')
+        for percentile in (50, 95, 99):
+            latency = latencies[min(len(latencies) - 1,
+                                    len(latencies) * percentile // 100)]
+            self.stdout.write(f'{f"p{percentile} latency":<24} '
+                              f'{1000 * latency:8.1f} ms')
+        self.stdout.write(f'{"statuses":<24} ' + ', '.join(
+                f'{status}: {number}'
+                for status, number in sorted(statuses.items())))
+
+
+def _peak_rss():
+    '''The peak memory used by this process, in bytes.'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,370 @@
+import asyncio
+import json
+import logging
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+
+from django.conf import settings
+from dropbox.exceptions import ApiError
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:
+    # asgiref < 3.6, as used by Django 3.1, which checks the marker of
+    # asyncio.iscoroutinefunction
+    from asyncio import iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+logger = logging.getLogger('viewer.requests')
+
+# The upper bounds of the latency histograms, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# The RequestMetrics of the request being handled, if any
+_current = ContextVar('viewer_request_metrics', default=None)
+
+
+# ----------------------------------------------------------------------------
+class Histogram:
+    '''Count observed values in the ranges given by BUCKETS.'''
+
+    # ........................................................................
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0
+        self.count = 0
+
+    # ........................................................................
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# ----------------------------------------------------------------------------
+class Metrics:
+    '''The counters of this process, in the Prometheus text format.
+
+    Dropbox calls are counted by endpoint (e.g., 'files/list_folder') and
+    result: 'ok', 'api_error' for the errors of the route (e.g., a path not
+    found), or the name of the exception raised. Requests are counted by
+    view name and status.
+    '''
+
+    # ........................................................................
+    def __init__(self):
+        self.calls = {}
+        self.call_seconds = {}
+        self.retries = {}
+        self.sent = {}
+        self.received = {}
+        self.requests = {}
+        self.request_seconds = {}
+        self._lock = Lock()
+
+    # ........................................................................
+    def call(self, endpoint, seconds, result):
+        with self._lock:
+            key = (endpoint, result)
+            self.calls[key] = self.calls.get(key, 0) + 1
+            histogram = self.call_seconds.get(endpoint)
+            if histogram is None:
+                histogram = self.call_seconds[endpoint] = Histogram()
+            histogram.observe(seconds)
+
+    # ........................................................................
+    def retry(self, endpoint):
+        with self._lock:
+            self.retries[endpoint] = self.retries.get(endpoint, 0) + 1
+
+    # ........................................................................
+    def transfer(self, endpoint, sent, received):
+        with self._lock:
+            if sent:
+                self.sent[endpoint] = self.sent.get(endpoint, 0) + sent
+            if received:
+                self.received[endpoint] = \
+                        self.received.get(endpoint, 0) + received
+
+    # ........................................................................
+    def request(self, view, status, seconds):
+        with self._lock:
+            key = (view, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.request_seconds.get(view)
+            if histogram is None:
+                histogram = self.request_seconds[view] = Histogram()
+            histogram.observe(seconds)
+
+    # ........................................................................
+    def render(self):
+        '''Return all the counters, in the Prometheus text format.'''
+        lines = []
+        with self._lock:
+            self._counter(lines, 'dropbox_calls_total',
+                    'Calls to the Dropbox API.', ('endpoint', 'result'),
+                    self.calls)
+            self._histogram(lines, 'dropbox_call_seconds',
+                    'Latency of the calls to the Dropbox API.', 'endpoint',
+                    self.call_seconds)
+            self._counter(lines, 'dropbox_retries_total',
+                    'Calls to the Dropbox API sent again after a failure.',
+                    ('endpoint',), self.retries)
+            self._counter(lines, 'dropbox_sent_bytes_total',
+                    'Bytes uploaded to Dropbox.', ('endpoint',), self.sent)
+            self._counter(lines, 'dropbox_received_bytes_total',
+                    'Bytes downloaded from Dropbox.', ('endpoint',),
+                    self.received)
+            self._counter(lines, 'viewer_requests_total',
+                    'Requests handled by the viewer.', ('view', 'status'),
+                    self.requests)
+            self._histogram(lines, 'viewer_request_seconds',
+                    'Time spent handling requests, until fully sent.',
+                    'view', self.request_seconds)
+        return ''.join(line + '\n' for line in lines)
+
+    # ........................................................................
+    def _counter(self, lines, name, help, labels, values):
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} counter')
+        for key, value in sorted(values.items()):
+            if not isinstance(key, tuple):
+                key = (key,)
+            lines.append(f'{name}{_labels(zip(labels, key))} {value}')
+
+    # ........................................................................
+    def _histogram(self, lines, name, help, label, histograms):
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} histogram')
+        for key, histogram in sorted(histograms.items()):
+            total = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                total += count
+                lines.append(f'{name}_bucket'
+                        f'{_labels([(label, key), ("le", str(bound))])} '
+                        f'{total}')
+            lines.append(f'{name}_sum{_labels([(label, key)])} '
+                         f'{histogram.sum:.6f}')
+            lines.append(f'{name}_count{_labels([(label, key)])} '
+                         f'{histogram.count}')
+
+
+def _labels(pairs):
+    '''Format the labels of a sample.'''
+    escaped = (f'{name}="' + str(value).replace('\\', '\\\\')
+               .replace('"', '\\"').replace('\n', '\\n') + '"'
+               for name, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+# The counters of this process
+metrics = Metrics()
+
+
+# ----------------------------------------------------------------------------
+class RequestMetrics:
+    '''The Dropbox calls made while handling a single request.
+
+    Calls made by worker threads (e.g., to upload or zip files) are only
+    counted by the process metrics.
+
+    Attributes:
+    started   : the time when the request arrived, from time.perf_counter()
+    endpoints : dict of [calls, seconds] lists, by endpoint
+    retries   : the calls sent again after a failure
+    sent      : the bytes uploaded to Dropbox
+    received  : the bytes downloaded from Dropbox
+    '''
+
+    # ........................................................................
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.endpoints = {}
+        self.retries = 0
+        self.sent = 0
+        self.received = 0
+
+    # ........................................................................
+    def server_timing(self, elapsed):
+        '''Return the value of a Server-Timing header, with the total and
+        the time spent in Dropbox calls, by endpoint.'''
+        calls = sum(calls for calls, seconds in self.endpoints.values())
+        seconds = sum(seconds for calls, seconds in self.endpoints.values())
+        timings = [f'total;dur={elapsed * 1000:.1f}',
+                   f'dropbox;dur={seconds * 1000:.1f};desc="{_calls(calls)}"']
+        for endpoint, (calls, seconds) in sorted(self.endpoints.items()):
+            timings.append(f'{endpoint.replace("/", ".")};'
+                           f'dur={seconds * 1000:.1f};desc="{_calls(calls)}"')
+        return ', '.join(timings)
+
+    # ........................................................................
+    def as_dict(self):
+        return {
+            'dropbox_calls': sum(calls for calls, seconds
+                                 in self.endpoints.values()),
+            'dropbox_seconds': round(sum(seconds for calls, seconds
+                                         in self.endpoints.values()), 6),
+            'retries': self.retries,
+            'bytes_sent': self.sent,
+            'bytes_received': self.received,
+            'endpoints': {endpoint: {'calls': calls,
+                                     'seconds': round(seconds, 6)}
+                          for endpoint, (calls, seconds)
+                          in sorted(self.endpoints.items())},
+        }
+
+
+def _calls(count):
+    return f'{count} call' if count == 1 else f'{count} calls'
+
+
+# ----------------------------------------------------------------------------
+def record_call(endpoint, seconds, result='ok', sent=0, received=0):
+    '''Count a single attempt of a Dropbox call.
+
+    Parameters:
+    endpoint : the route called, e.g. 'files/list_folder'
+    seconds  : the time until the answer arrived
+    result   : 'ok', 'api_error', or the name of the exception raised
+    sent     : the bytes uploaded
+    received : the bytes of the answer; see record_transfer()
+    '''
+    metrics.call(endpoint, seconds, result)
+    metrics.transfer(endpoint, sent, received)
+    current = _current.get()
+    if current is not None:
+        totals = current.endpoints.setdefault(endpoint, [0, 0])
+        totals[0] += 1
+        totals[1] += seconds
+        current.sent += sent
+        current.received += received
+
+
+# ----------------------------------------------------------------------------
+def record_retry(endpoint):
+    '''Count a Dropbox call sent again after a failure.'''
+    metrics.retry(endpoint)
+    current = _current.get()
+    if current is not None:
+        current.retries += 1
+
+
+# ----------------------------------------------------------------------------
+def record_transfer(endpoint, sent=0, received=0):
+    '''Count bytes streamed after a call returned, e.g. a download.'''
+    metrics.transfer(endpoint, sent, received)
+    current = _current.get()
+    if current is not None:
+        current.sent += sent
+        current.received += received
+
+
+# ----------------------------------------------------------------------------
+class CallTimer:
+    '''Time a single attempt of a Dropbox call, as a context manager.
+
+    Set result and received before leaving the block, if known; exceptions
+    are counted as results by their name.
+    '''
+
+    # ........................................................................
+    def __init__(self, endpoint, sent=0):
+        self.endpoint = endpoint
+        self.sent = sent
+        self.received = 0
+        self.result = 'ok'
+
+    # ........................................................................
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    # ........................................................................
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.result = 'api_error' if issubclass(exc_type, ApiError) \
+                    else exc_type.__name__
+        record_call(self.endpoint, time.perf_counter() - self.started,
+                    self.result, self.sent, self.received)
+
+
+# ----------------------------------------------------------------------------
+class MetricsMiddleware:
+    '''Measure each request, and the Dropbox calls made to handle it.
+
+    With settings.VIEWER_SERVER_TIMING, responses get a Server-Timing
+    header with the time spent in Dropbox calls so far; downloads are still
+    being relayed at that point. With settings.VIEWER_REQUEST_LOG, a JSON
+    line is logged to 'viewer.requests' once each response is sent.
+
+    It must come first in settings.MIDDLEWARE, so that its measures cover
+    the whole request, in both WSGI and ASGI.
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    # ........................................................................
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.server_timing = getattr(settings, 'VIEWER_SERVER_TIMING', False)
+        self.request_log = getattr(settings, 'VIEWER_REQUEST_LOG', False)
+        if iscoroutinefunction(get_response):
+            # Mark the middleware as async for Django
+            markcoroutinefunction(self)
+
+    # ........................................................................
+    def __call__(self, request):
+        if iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        # The context is kept while the response is sent, so that the
+        # bytes streamed are counted too
+        current = RequestMetrics()
+        _current.set(current)
+        return self._measured(request, self.get_response(request), current)
+
+    # ........................................................................
+    async def __acall__(self, request):
+        current = RequestMetrics()
+        _current.set(current)
+        return self._measured(request, await self.get_response(request),
+                              current)
+
+    # ........................................................................
+    def _measured(self, request, response, current):
+        if self.server_timing:
+            response['Server-Timing'] = current.server_timing(
+                    time.perf_counter() - current.started)
+        close = response.close
+
+        def close_and_record():
+            try:
+                close()
+            finally:
+                self._sent(request, response, current)
+        response.close = close_and_record
+        return response
+
+    # ........................................................................
+    def _sent(self, request, response, current):
+        '''Record a request once its response was sent.'''
+        seconds = time.perf_counter() - current.started
+        match = request.resolver_match
+        view = match.url_name if match is not None and match.url_name \
+                else 'unknown'
+        metrics.request(view, response.status_code, seconds)
+        if self.request_log:
+            record = {
+                'method': request.method,
+                'path': request.path,
+                'view': view,
+                'status': response.status_code,
+                'seconds': round(seconds, 6),
+            }
+            record.update(current.as_dict())
+            logger.info(json.dumps(record))
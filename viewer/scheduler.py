@@ -0,0 +1,233 @@
+import asyncio
+import random
+import time
+from functools import lru_cache
+from threading import Lock
+
+import httpx
+from dropbox.exceptions import (
+    DropboxException, InternalServerError, RateLimitError,
+)
+from requests.exceptions import ConnectionError, Timeout
+
+# The failures that are worth retrying: Dropbox being overloaded or
+# degraded, and connections that failed or timed out
+TRANSIENT_ERRORS = (InternalServerError, RateLimitError, ConnectionError,
+                    Timeout, httpx.TransportError)
+
+
+# ----------------------------------------------------------------------------
+class DropboxUnavailable(DropboxException):
+    '''Raised instead of calling Dropbox when it would not answer in time:
+    the circuit breaker is open, or the rate limit queue is full.
+
+    Attribute:
+    retry_after : the seconds to wait before calling Dropbox again
+    '''
+
+    # ........................................................................
+    def __init__(self, retry_after):
+        super().__init__(None, 'Dropbox is unavailable, retry in '
+                         f'{retry_after:.0f} seconds')
+        self.retry_after = retry_after
+
+
+# ----------------------------------------------------------------------------
+class TokenBucket:
+    '''Spread the calls to Dropbox to at most rate per second, with bursts
+    of up to burst calls.
+
+    Calls take a token each, and tokens are added back at a steady rate.
+    When the bucket is empty, calls are given the time to wait for their
+    token instead, so they go out in order.
+
+    Parameters:
+    rate  : the tokens added per second
+    burst : the size of the bucket
+    '''
+
+    # ........................................................................
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused = 0
+        self._lock = Lock()
+
+    # ........................................................................
+    def reserve(self, max_wait):
+        '''Take a token, and return the seconds to wait before using it.
+
+        Raise DropboxUnavailable, without taking a token, if the wait would
+        be longer than max_wait seconds.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                    self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            delay = max(self._paused - now, -self._tokens / self.rate, 0)
+            if delay > max_wait:
+                self._tokens += 1
+                raise DropboxUnavailable(delay)
+            return delay
+
+    # ........................................................................
+    def pause(self, seconds):
+        '''Hold all calls for some seconds, e.g., as told by Retry-After.'''
+        with self._lock:
+            self._paused = max(self._paused, time.monotonic() + seconds)
+
+
+# ----------------------------------------------------------------------------
+class CircuitBreaker:
+    '''Stop calling Dropbox for a while when it keeps failing.
+
+    After threshold consecutive failures, the breaker opens: calls fail
+    right away for reset seconds. Then a single call is let through; if it
+    succeeds, the breaker closes again, otherwise it stays open for another
+    reset seconds.
+
+    Parameters:
+    threshold : the consecutive failures that open the breaker
+    reset     : the seconds the breaker stays open
+    '''
+
+    # ........................................................................
+    def __init__(self, threshold, reset):
+        self.threshold = threshold
+        self.reset = reset
+        self._failures = 0
+        self._opened = None
+        self._lock = Lock()
+
+    # ........................................................................
+    def check(self):
+        '''Raise DropboxUnavailable if calls must not be sent.'''
+        with self._lock:
+            if self._opened is None:
+                return
+            remaining = self._opened + self.reset - time.monotonic()
+            if remaining > 0:
+                raise DropboxUnavailable(remaining)
+            # Let one call try, holding the others for another period
+            self._opened = time.monotonic()
+
+    # ........................................................................
+    def succeeded(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+
+    # ........................................................................
+    def failed(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                self._opened = time.monotonic()
+
+
+# ----------------------------------------------------------------------------
+@lru_cache(maxsize=None)
+def get_circuit_breaker(threshold, reset):
+    '''Return the circuit breaker shared by all accounts, since they are
+    served by the same Dropbox.'''
+    return CircuitBreaker(threshold, reset)
+
+
+# ----------------------------------------------------------------------------
+class CallScheduler:
+    '''Send the calls of a Dropbox account, retrying transient failures.
+
+    Each attempt waits for a token from the bucket, and for the circuit
+    breaker. Rate limited calls are retried after the delay asked by
+    Dropbox, which also holds the other calls of the account; other
+    failures are retried after an exponential backoff with full jitter, up
+    to retries times.
+
+    Parameters:
+    bucket  : the TokenBucket of the account, or None for no rate limit
+    breaker : the CircuitBreaker, or None
+    retries : the retries of a failed call
+    '''
+
+    BACKOFF = 0.5
+    MAX_BACKOFF = 30
+    # The longest that a call waits for its turn
+    MAX_WAIT = 30
+
+    # ........................................................................
+    def __init__(self, bucket=None, breaker=None, retries=4):
+        self.bucket = bucket
+        self.breaker = breaker
+        self.retries = retries
+
+    # ........................................................................
+    def call(self, function, *args, **kwargs):
+        '''Return function(*args, **kwargs), called when allowed.'''
+        attempt = 0
+        while True:
+            time.sleep(self._admit())
+            try:
+                result = function(*args, **kwargs)
+            except TRANSIENT_ERRORS as e:
+                delay = self._failed(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._succeeded()
+            return result
+
+    # ........................................................................
+    async def acall(self, function, *args, **kwargs):
+        '''Return await function(*args, **kwargs), called when allowed.'''
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._admit())
+            try:
+                result = await function(*args, **kwargs)
+            except TRANSIENT_ERRORS as e:
+                delay = self._failed(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._succeeded()
+            return result
+
+    # ........................................................................
+    def _admit(self):
+        '''Return the seconds to wait before an attempt.'''
+        if self.breaker is not None:
+            self.breaker.check()
+        if self.bucket is None:
+            return 0
+        return self.bucket.reserve(self.MAX_WAIT)
+
+    # ........................................................................
+    def _succeeded(self):
+        if self.breaker is not None:
+            self.breaker.succeeded()
+
+    # ........................................................................
+    def _failed(self, error, attempt):
+        '''Return the seconds to wait before retrying, or None to give up.'''
+        if isinstance(error, RateLimitError):
+            # Dropbox is fine, but the account makes too many calls
+            delay = error.backoff if error.backoff is not None else 5
+            if self.bucket is not None:
+                self.bucket.pause(delay)
+                delay = 0
+        else:
+            if self.breaker is not None:
+                self.breaker.failed()
+            delay = random.uniform(0, min(self.MAX_BACKOFF,
+                                          self.BACKOFF * 2 ** attempt))
+        if attempt >= self.retries or delay > self.MAX_WAIT:
+            return None
+        return delay
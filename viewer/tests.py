@@ -1,3 +1,981 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from threading import Event
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.exceptions import TooManyFieldsSent
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse, QueryDict
+from django.middleware.csrf import get_token
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.utils.http import urlencode
+from dropbox.exceptions import RateLimitError
+from dropbox.files import DeletedMetadata, FolderMetadata
+from requests.exceptions import ConnectionError
+
+from . import views
+from .aio import AsyncDropboxWrapper
+from .dropbox import (
+    DropBoxContentCache, DropBoxStorageException, DropBoxUploadSession,
+)
+from .fakedropbox import FakeDropbox
+from .index import AccountIndex, FolderSizes, NameIndex
+from .management.commands.benchmark import Command
+from .metrics import MetricsMiddleware
+from .scheduler import (
+    CallScheduler, CircuitBreaker, DropboxUnavailable, TokenBucket,
+)
+from .thumbnails import Thumbnailer
+from .watcher import FolderWatcher, _Watch
+from .wrapper import FolderListing, MemoryListingCache
+from .zipstream import stream_zip
+
+# The tests run the viewer against a FakeDropbox, through the real Dropbox
+# clients, and count the calls it receives.
+
+# ----------------------------------------------------------------------------
+class FakeDropboxTestCase(TestCase):
+    '''Connect a session to the account of a new FakeDropbox.
+
+    Attributes:
+    fake    : the FakeDropbox
+    request : a GET request, whose session is connected to the account
+    dropbox : the DropboxWrapper of the account
+    '''
+
+    # ........................................................................
+    def setUp(self):
+        self.fake = FakeDropbox().start()
+        self.addCleanup(self.fake.stop)
+        self.request = Command().connect(self.fake)
+        self.dropbox = views.registry.get(self.request.session)
+        # Every FakeDropbox serves the same account
+        self.dropbox.listings = MemoryListingCache()
+        caches[settings.VIEWER_FRAGMENT_CACHE].clear()
+
+    # ........................................................................
+    def calls(self, route):
+        '''The number of calls received by a route of the FakeDropbox.'''
+        return self.fake.requests.get(route, 0)
+
+    # ........................................................................
+    def post(self, view, data, csrf_token=True):
+        '''Send a multipart POST request to a view, as the same session,
+        with a valid CSRF token in its header, unless told otherwise.'''
+        request = RequestFactory().post('/viewer/', data)
+        request.session = self.request.session
+        if csrf_token:
+            request.META['HTTP_X_CSRFTOKEN'] = get_token(request)
+            request.COOKIES[settings.CSRF_COOKIE_NAME] = \
+                    request.META['CSRF_COOKIE']
+        return view(request)
+
+    # ........................................................................
+    def names(self, path):
+        '''The names of the entries in a folder, as listed by the viewer.'''
+        return [entry.name for entry in self.dropbox.listdir(path)]
+
+
+# ----------------------------------------------------------------------------
+class RegistryTests(FakeDropboxTestCase):
+
+    # ........................................................................
+    def test_forget_leaves_the_wrapper_usable(self):
+        self.fake.add_file('/a.txt', 10)
+        views.registry.forget(self.request.session)
+        self.assertIsNone(views.registry.get(self.request.session))
+        # E.g., a request of another session, still running
+        self.assertTrue(self.dropbox.has_access())
+        self.assertEqual(self.dropbox.get_metadata('/a.txt').size, 10)
+
+    # ........................................................................
+    def test_forget_keeps_a_newer_access(self):
+        session = dict(self.request.session)
+        old = dict(session[views.registry.SESSION_KEY], token='old')
+        views.registry.forget({views.registry.SESSION_KEY: old})
+        self.assertIs(views.registry.get(session), self.dropbox)
+
+
+    # ........................................................................
+    def slow_job(self):
+        '''Start a job that runs until the returned event is set.'''
+        release = Event()
+        self.addCleanup(release.set)
+        self.dropbox.create_folders = lambda paths, progress: \
+                release.wait(10) and []
+        return self.dropbox.start_job('create_folder', ['/new']), release
+
+    # ........................................................................
+    def test_jobs_outlive_the_access(self):
+        session = dict(self.request.session)
+        job, release = self.slow_job()
+        views.registry.forget(self.request.session)
+        dropbox = views.registry.get(session)
+        self.assertIsNot(dropbox, self.dropbox)
+        self.assertIs(dropbox.get_job(job.id), job)
+        release.set()
+
+    # ........................................................................
+    def test_accounts_running_jobs_are_not_evicted(self):
+        job, release = self.slow_job()
+        with patch.object(views.registry, 'idle_timeout', -1):
+            self.assertIs(views.registry.get(self.request.session),
+                          self.dropbox)
+            release.set()
+            while self.dropbox.jobs.unfinished():
+                time.sleep(0.01)
+            self.assertIsNot(views.registry.get(self.request.session),
+                             self.dropbox)
+
+    # ........................................................................
+    def test_index_outlives_the_wrapper(self):
+        session = dict(self.request.session)
+        with self.settings(DROPBOX_TREE_INDEX=True):
+            views.registry.forget(self.request.session)
+            index = views.registry.get(session).index
+            views.registry.forget(dict(session))
+            dropbox = views.registry.get(session)
+        self.assertIsNotNone(index)
+        self.assertIs(dropbox.index, index)
+        self.assertIs(index.storage, dropbox.storage)
+
+
+# ----------------------------------------------------------------------------
+class StatCacheTests(FakeDropboxTestCase):
+
+    # ........................................................................
+    def test_listed_folder_answers_without_calls(self):
+        self.fake.add_files('/few', 3, 10)
+        self.dropbox.storage.listdir('/few')
+        calls = self.calls('files/get_metadata')
+        self.assertTrue(self.dropbox.storage.exists('/few/file0000001.bin'))
+        self.assertFalse(self.dropbox.storage.exists('/few/missing.bin'))
+        self.assertEqual(self.calls('files/get_metadata'), calls)
+
+    # ........................................................................
+    def test_evicted_stats_are_not_reported_missing(self):
+        storage = self.dropbox.storage
+        storage.STAT_CACHE_SIZE = 20
+        self.fake.add_files('/many', 30, 10)
+        self.assertEqual(len(storage.listdir('/many')[1]), 30)
+        self.assertTrue(storage.exists('/many/file0000000.bin'))
+        self.assertNotEqual(
+                storage.get_available_name('/many/file0000000.bin'),
+                '/many/file0000000.bin')
+
+    # ........................................................................
+    def test_available_name_does_not_list_the_folder(self):
+        storage = self.dropbox.storage
+        storage.STAT_CACHE_SIZE = 20
+        self.fake.add_files('/many', 30, 10)
+        name = storage.get_available_name('/many/file0000000.bin')
+        self.assertTrue(name.startswith('/many/file0000000_'))
+        self.assertEqual(self.calls('files/list_folder'), 0)
+        self.assertEqual(self.calls('files/get_metadata'), 2)
+
+
+# ----------------------------------------------------------------------------
+class ListingTests(FakeDropboxTestCase):
+
+    # ........................................................................
+    def test_cached_listing_makes_no_calls(self):
+        self.fake.add_files('/docs', 5, 10)
+        self.assertEqual(len(self.names('/docs')), 5)
+        calls = sum(self.fake.requests.values())
+        self.assertEqual(len(self.names('/docs')), 5)
+        self.assertEqual(sum(self.fake.requests.values()), calls)
+
+    # ........................................................................
+    def test_changes_are_listed_from_the_cursor(self):
+        self.fake.add_files('/docs', 5, 10)
+        self.names('/docs')
+        self.fake.add_file('/docs/new.txt', 10)
+        self.dropbox._expire_listing('/docs')
+        self.assertIn('new.txt', self.names('/docs'))
+        self.assertEqual(self.calls('files/list_folder'), 1)
+        self.assertEqual(self.calls('files/list_folder/continue'), 1)
+
+    # ........................................................................
+    def test_version_changes_with_the_listing(self):
+        self.fake.add_files('/docs', 5, 10)
+        version = self.dropbox.folder_version('/docs')
+        self.assertEqual(self.dropbox.folder_version('/docs'), version)
+        self.dropbox.create_folder('docs', 'sub')
+        self.assertNotEqual(self.dropbox.folder_version('/docs'), version)
+        self.assertIn('sub', self.names('/docs'))
+
+    # ........................................................................
+    def test_upload_expires_the_listing(self):
+        self.fake.add_folder('/docs')
+        self.names('/docs')
+        self.dropbox.upload_file('docs', ContentFile(b'data', name='a.txt'))
+        self.assertIn('a.txt', self.names('/docs'))
+
+    # ........................................................................
+    def test_cache_is_bounded_by_entries(self):
+        listings = MemoryListingCache(max_entries=10)
+        for i in range(3):
+            entries = {f'/{i}/{j}': None for j in range(4)}
+            listings.set(i, FolderListing(entries, version='v'))
+        self.assertIsNone(listings.get(0))
+        self.assertIsNotNone(listings.get(1))
+        listings.set(3, FolderListing({f'/{j}': None for j in range(20)},
+                                      version='v'))
+        self.assertEqual(list(listings._listings), [3])
+        self.assertEqual(listings._size, 20)
+
+    # ........................................................................
+    def test_listings_inside_removed_folders_are_made_again(self):
+        self.fake.add_files('/a/b', 3, 10)
+        self.assertEqual(len(self.names('/a/b')), 3)
+        self.dropbox.delete(['/a'])
+        self.fake.add_file('/a/b/new.txt', 10)
+        self.assertEqual(self.names('/a/b'), ['new.txt'])
+
+    # ........................................................................
+    def test_pages_of_a_listing_are_followed(self):
+        self.fake.page_size = 2
+        self.fake.add_files('/docs', 5, 10)
+        self.assertEqual(len(self.names('/docs')), 5)
+        self.assertEqual(self.calls('files/list_folder'), 1)
+        self.assertEqual(self.calls('files/list_folder/continue'), 2)
+
+    # ........................................................................
+    def test_windows_of_sorted_entries(self):
+        for name in ('d.txt', 'b.txt', 'a.txt', 'c.txt'):
+            self.fake.add_file(f'/docs/{name}', 10)
+        self.fake.add_folder('/docs/z')
+        window = self.dropbox.listdir('/docs', offset=1, limit=2)
+        self.assertEqual([entry.name for entry in window], ['a.txt', 'b.txt'])
+        window = self.dropbox.listdir('/docs', offset=4, limit=2)
+        self.assertEqual([entry.name for entry in window], ['d.txt'])
+
+    # ........................................................................
+    def test_folder_pages(self):
+        self.fake.add_files('/docs', 5, 10)
+        with self.settings(VIEWER_PAGE_SIZE=2):
+            request = RequestFactory().get('/viewer/folder/docs/',
+                                           {'page': '3'})
+            request.session = self.request.session
+            response = views.listfolder(request, url='docs')
+        self.assertContains(response, 'file0000004.bin')
+        self.assertNotContains(response, 'file0000003.bin')
+
+    # ........................................................................
+    def test_fragments_are_not_shared_among_accounts(self):
+        self.fake.add_file('/docs/mine.txt', 10)
+        version = self.dropbox.folder_version('/docs')
+        # Another account's folder, at the same path and version
+        views._render_listing('dbid:other', 'docs', [], 1, version)
+        response = views.listfolder(self.request, url='docs')
+        self.assertContains(response, 'mine.txt')
+
+
+# ----------------------------------------------------------------------------
+class AccountIndexTests(FakeDropboxTestCase):
+
+    # ........................................................................
+    def test_index_is_built_and_updated(self):
+        self.fake.add_files('/a/b', 3, 10)
+        index = AccountIndex(self.dropbox.storage, 60)
+        index._update()
+        self.assertEqual(index.sizes.get('/A'), (30, 3))
+        # FakeDropbox only lists the entries added at the end of a listing
+        self.fake.add_file('/a/b/new.txt', 5)
+        index._update()
+        self.assertEqual(index.sizes.get('/a'), (35, 4))
+        self.assertEqual(index.names.search('new', 10), ['/a/b/new.txt'])
+        self.assertEqual(index.version, 2)
+
+    # ........................................................................
+    def test_names_are_only_rebuilt_after_changes(self):
+        self.fake.add_files('/a', 3, 10)
+        index = AccountIndex(self.dropbox.storage, 60)
+        index._update()
+        with patch.object(NameIndex, 'build') as build:
+            index._update()
+        build.assert_not_called()
+        self.assertEqual(index.version, 1)
+
+    # ........................................................................
+    def test_failures_are_logged_and_retried(self):
+        index = AccountIndex(self.dropbox.storage, 60)
+        with patch.object(self.dropbox.storage, 'list_pages',
+                          side_effect=ConnectionError), \
+                self.assertLogs('viewer.index', 'ERROR'):
+            index._update()
+        self.assertIsNone(index.cursor)
+        index.expire()
+        index._update()
+        self.assertIsNotNone(index.cursor)
+
+    # ........................................................................
+    def test_unexpected_errors_are_raised(self):
+        index = AccountIndex(self.dropbox.storage, 60)
+        with patch.object(self.dropbox.storage, 'list_pages',
+                          side_effect=TypeError):
+            self.assertRaises(TypeError, index._update)
+        self.assertNotEqual(index.checked, 0)
+
+
+# ----------------------------------------------------------------------------
+class FolderDeletionTests(SimpleTestCase):
+
+    # ........................................................................
+    def setUp(self):
+        self.fake = FakeDropbox()
+        self.entries = [self.fake.add_file(path, 10) for path in
+                        ('/a/x.txt', '/a/b/y.txt', '/a.txt', '/a0/z.txt')]
+        self.entries += [self.fake.add_folder(path) for path in
+                         ('/a', '/a/b', '/a0')]
+        self.deleted = [DeletedMetadata(name='a', path_lower='/a')]
+
+    # ........................................................................
+    def test_sizes(self):
+        sizes = FolderSizes()
+        sizes.apply(self.entries)
+        sizes.apply(self.deleted)
+        self.assertEqual(sorted(sizes.files), ['/a.txt', '/a0/z.txt'])
+        self.assertEqual(sorted(sizes.folders), ['', '/a0'])
+        self.assertEqual(sizes.get(''), (20, 2))
+
+    # ........................................................................
+    def test_names(self):
+        names = NameIndex()
+        names.apply(self.entries)
+        names.apply(self.deleted)
+        names.apply([FolderMetadata(name='A', id='id:0', path_lower='/a',
+                                    path_display='/A')])
+        names.build()
+        self.assertEqual(sorted(names.entries), ['/a', '/a.txt', '/a0',
+                                                 '/a0/z.txt'])
+        self.assertEqual(names.search('y.txt', 10), [])
+
+
+# ----------------------------------------------------------------------------
+class ThumbnailTests(FakeDropboxTestCase):
+
+    # ........................................................................
+    def setUp(self):
+        super().setUp()
+        folder = TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.cache = DropBoxContentCache(folder.name, 1024 * 1024)
+        self.dropbox.thumbnails.cache = self.cache
+        self.image = self.fake.add_file('/photos/a.jpg', 1000)
+
+    # ........................................................................
+    def test_thumbnails_are_cached(self):
+        thumbnail = self.dropbox.get_thumbnail(self.image.rev, 'w64h64')
+        self.assertEqual(thumbnail, b'/photos/a.jpg:w64h64')
+        self.assertEqual(
+                self.dropbox.get_thumbnail(self.image.rev, 'w64h64'),
+                thumbnail)
+        self.assertEqual(self.calls('files/get_thumbnail_batch'), 1)
+
+    # ........................................................................
+    def test_cache_is_not_shared_among_accounts(self):
+        self.dropbox.get_thumbnail(self.image.rev, 'w64h64')
+        other = Thumbnailer(self.dropbox.storage)
+        other.cache = self.cache
+        other.account = 'dbid:other'
+        other.get(self.image.rev, 'w64h64')
+        self.assertEqual(self.calls('files/get_thumbnail_batch'), 2)
+
+    # ........................................................................
+    def test_prefetched_thumbnails_are_kept_without_a_cache(self):
+        self.dropbox.thumbnails.cache = None
+        for future in self.dropbox.thumbnails.prefetch([self.image.rev],
+                                                       'w64h64'):
+            future.result()
+        self.assertEqual(self.dropbox.get_thumbnail(self.image.rev, 'w64h64'),
+                         b'/photos/a.jpg:w64h64')
+        self.assertEqual(self.calls('files/get_thumbnail_batch'), 1)
+
+
+# ----------------------------------------------------------------------------
+class ContentCacheTests(FakeDropboxTestCase):
+
+    # ........................................................................
+    def setUp(self):
+        super().setUp()
+        folder = TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.cache = DropBoxContentCache(folder.name, 1024 * 1024)
+        self.dropbox.storage.content_cache = self.cache
+        self.metadata = self.fake.add_file('/a.bin', 200 * 1024)
+
+    # ........................................................................
+    def test_first_copy_is_counted_once(self):
+        self.cache.store('key', b'x' * 10)
+        self.assertEqual(self.cache._size, 10)
+        self.cache.store('other', b'x' * 5)
+        self.assertEqual(self.cache._size, 15)
+
+    # ........................................................................
+    def test_complete_copy_is_kept(self):
+        chunks = [b'a' * 10, b'b' * 10]
+        self.assertEqual(list(self.cache.tee('key', chunks, 20)), chunks)
+        with self.cache.open('key') as local_file:
+            self.assertEqual(local_file.read(), b''.join(chunks))
+
+    # ........................................................................
+    def test_incomplete_copy_is_discarded(self):
+        with self.assertRaises(DropBoxStorageException):
+            list(self.cache.tee('key', [b'a' * 10], 20))
+        self.assertIsNone(self.cache.open('key'))
+        self.assertEqual(os.listdir(os.path.join(self.cache.location, 'ke')),
+                         [])
+
+    # ........................................................................
+    def test_abandoned_copy_is_discarded(self):
+        chunks = self.cache.tee('key', [b'a' * 10, b'b' * 10], 20)
+        next(chunks)
+        chunks.close()
+        self.assertIsNone(self.cache.open('key'))
+        self.assertEqual(os.listdir(os.path.join(self.cache.location, 'ke')),
+                         [])
+        # The key can be stored again
+        self.cache.store('key', b'data')
+        self.assertIsNotNone(self.cache.open('key'))
+
+    # ........................................................................
+    def test_downloaded_file_is_cached(self):
+        storage = self.dropbox.storage
+        data = b''.join(storage.open_cached('/a.bin', self.metadata).chunks())
+        cached = storage.open_cached('/a.bin', self.metadata)
+        self.assertIsNotNone(cached.local_file)
+        self.assertEqual(b''.join(cached.chunks()), data)
+        self.assertEqual(self.calls('files/download'), 1)
+
+    # ........................................................................
+    def test_copy_evicted_while_opened_is_read(self):
+        self.cache.store('key', b'data')
+        with patch('os.utime', side_effect=FileNotFoundError):
+            local_file = self.cache.open('key')
+        with local_file:
+            self.assertEqual(local_file.read(), b'data')
+
+    # ........................................................................
+    def test_simultaneous_downloads_fetch_the_file_once(self):
+        storage = self.dropbox.storage
+        first = storage.open_cached('/a.bin', self.metadata)
+        chunks = first.chunks()
+        data = [next(chunks)]
+        waiting = ThreadPoolExecutor(1).submit(storage.open_cached, '/a.bin',
+                                               self.metadata)
+        time.sleep(0.1)
+        self.assertFalse(waiting.done())
+        data.extend(chunks)
+        second = waiting.result(10)
+        self.assertIsNotNone(second.local_file)
+        self.assertEqual(b''.join(second.chunks()), b''.join(data))
+        self.assertEqual(self.calls('files/download'), 1)
+
+    # ........................................................................
+    def test_waiting_is_bounded(self):
+        storage = self.dropbox.storage
+        storage.content_cache_wait = 0.1
+        chunks = storage.open_cached('/a.bin', self.metadata).chunks()
+        next(chunks)
+        second = storage.open_cached('/a.bin', self.metadata)
+        self.assertIsNone(second.local_file)
+        chunks.close()
+
+
+# ----------------------------------------------------------------------------
+class ApiFolderTests(FakeDropboxTestCase):
+
+    # ........................................................................
+    def get(self, url='docs', **params):
+        headers = {key: params.pop(key) for key in list(params)
+                   if key.startswith('HTTP_')}
+        request = RequestFactory().get(f'/viewer/api/folder/{url}', params,
+                                       **headers)
+        request.session = self.request.session
+        return views.api_folder(request, url=url)
+
+    # ........................................................................
+    def test_pages_of_entries(self):
+        self.fake.add_files('/docs', 5, 10)
+        content = json.loads(self.get(offset=1, limit=2,
+                                      fields='name,size').content)
+        self.assertEqual(content['fields'], ['name', 'size'])
+        self.assertEqual(content['entries'], [['file0000001.bin', 10],
+                                              ['file0000002.bin', 10]])
+        self.assertEqual(content['next_offset'], 3)
+        content = json.loads(self.get(offset=3, limit=2).content)
+        self.assertEqual(content['fields'], ['name', 'is_dir', 'size',
+                                             'modified'])
+        self.assertEqual(len(content['entries']), 2)
+        self.assertIsNone(content['next_offset'])
+
+    # ........................................................................
+    def test_unchanged_pages_are_not_sent(self):
+        self.fake.add_files('/docs', 3, 10)
+        etag = self.get(limit=2)['ETag']
+        self.assertEqual(self.get(limit=2, HTTP_IF_NONE_MATCH=etag)
+                         .status_code, 304)
+        self.assertNotEqual(self.get(limit=1)['ETag'], etag)
+        self.fake.add_file('/docs/new.txt', 10)
+        self.dropbox._expire_listing('/docs')
+        self.assertEqual(self.get(limit=2, HTTP_IF_NONE_MATCH=etag)
+                         .status_code, 200)
+
+    # ........................................................................
+    def test_bad_requests(self):
+        self.fake.add_folder('/docs')
+        for params in ({'limit': '0'}, {'offset': '-1'}, {'fields': 'x'},
+                       {'limit': str(settings.VIEWER_API_MAX_LIMIT + 1)}):
+            self.assertEqual(self.get(**params).status_code, 400)
+        self.assertEqual(self.get('missing').status_code, 404)
+
+
+# ----------------------------------------------------------------------------
+class WatcherTests(FakeDropboxTestCase):
+
+    # ........................................................................
+    def test_changes_are_applied_to_the_cached_listing(self):
+        self.fake.add_files('/docs', 2, 10)
+        self.names('/docs')
+        key = self.dropbox._listing_key('/docs')
+        cursor = self.dropbox.listings.get(key).cursor
+        self.fake.add_file('/docs/new.txt', 10)
+        pages = list(self.dropbox.storage.list_pages('/docs', cursor))
+
+        async def apply():
+            await FolderWatcher()._apply(AsyncDropboxWrapper(self.dropbox),
+                                         key, pages)
+        async_to_sync(apply)()
+        listing = self.dropbox.listings.get(key)
+        self.assertIn('/docs/new.txt', listing.entries)
+        self.assertEqual(listing.cursor, pages[-1].cursor)
+
+    # ........................................................................
+    def test_watched_listings_are_current(self):
+        self.fake.add_files('/docs', 2, 10)
+        self.names('/docs')
+        key = self.dropbox._listing_key('/docs')
+        listing = self.dropbox.listings.get(key)
+        listing.checked = 1
+        self.assertFalse(self.dropbox.is_current(listing, key))
+        watcher = FolderWatcher()
+        watch = watcher._watches[key] = _Watch(key, '/docs')
+        watch.current = True
+        with patch.object(self.dropbox, 'watcher', watcher):
+            self.assertTrue(self.dropbox.is_current(listing, key))
+            watcher._drop(watch)
+            self.assertFalse(self.dropbox.is_current(listing, key))
+
+
+# ----------------------------------------------------------------------------
+class ZipTests(FakeDropboxTestCase):
+
+    # ........................................................................
+    def test_archive_is_streamed(self):
+        date = datetime(2020, 1, 2, 3, 4, 6)
+        chunks = list(stream_zip([('a/', None, None),
+                                  ('a/b.txt', date, [b'x' * 10, b'y' * 10]),
+                                  ('c.txt', None, iter([]))]))
+        self.assertGreater(len(chunks), 3)
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as archive:
+            self.assertEqual(archive.namelist(), ['a/', 'a/b.txt', 'c.txt'])
+            self.assertEqual(archive.read('a/b.txt'), b'x' * 10 + b'y' * 10)
+            self.assertEqual(archive.getinfo('a/b.txt').date_time,
+                             (2020, 1, 2, 3, 4, 6))
+            self.assertTrue(archive.getinfo('a/').is_dir())
+            self.assertEqual(archive.read('c.txt'), b'')
+
+    # ........................................................................
+    def test_folder_is_downloaded(self):
+        self.fake.add_files('/docs/sub', 3, 1000)
+        self.fake.add_file('/docs/top.txt', 10)
+        response = views.download_zip(self.request, url='docs')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename=docs.zip')
+        data = b''.join(response.streaming_content)
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertEqual(sorted(archive.namelist()),
+                    ['sub/', 'sub/file0000000.bin', 'sub/file0000001.bin',
+                     'sub/file0000002.bin', 'top.txt'])
+            self.assertEqual(archive.read('sub/file0000001.bin'),
+                             (bytes(range(256)) * 4)[:1000])
+        self.assertEqual(self.calls('files/download'), 4)
+
+
+# ----------------------------------------------------------------------------
+class SchedulerTests(SimpleTestCase):
+
+    # ........................................................................
+    def test_bucket_spreads_calls(self):
+        bucket = TokenBucket(10, 2)
+        self.assertEqual(bucket.reserve(1), 0)
+        self.assertEqual(bucket.reserve(1), 0)
+        self.assertAlmostEqual(bucket.reserve(1), 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(1), 0.2, places=2)
+        self.assertRaises(DropboxUnavailable, bucket.reserve, 0.1)
+        bucket.pause(5)
+        self.assertGreater(bucket.reserve(10), 4)
+
+    # ........................................................................
+    def test_breaker_opens_after_failures(self):
+        breaker = CircuitBreaker(2, 0.1)
+        breaker.failed()
+        breaker.check()
+        breaker.failed()
+        self.assertRaises(DropboxUnavailable, breaker.check)
+        time.sleep(0.1)
+        # A single call is let through
+        breaker.check()
+        self.assertRaises(DropboxUnavailable, breaker.check)
+        breaker.succeeded()
+        breaker.check()
+
+    # ........................................................................
+    def test_transient_failures_are_retried(self):
+        scheduler = CallScheduler(retries=2)
+        scheduler.BACKOFF = 0.01
+        results = [ConnectionError(), ConnectionError(), 'done']
+
+        def call():
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        self.assertEqual(scheduler.call(call), 'done')
+        results[:] = [ConnectionError()] * 3
+        self.assertRaises(ConnectionError, scheduler.call, call)
+        self.assertEqual(results, [])
+
+    # ........................................................................
+    def test_other_failures_are_raised(self):
+        breaker = CircuitBreaker(1, 30)
+        scheduler = CallScheduler(breaker=breaker)
+        calls = []
+
+        def call():
+            calls.append(None)
+            raise ValueError()
+        self.assertRaises(ValueError, scheduler.call, call)
+        self.assertEqual(len(calls), 1)
+        breaker.check()
+
+    # ........................................................................
+    def test_rate_limited_calls_pause_the_account(self):
+        bucket = TokenBucket(100, 100)
+        scheduler = CallScheduler(bucket)
+        results = [RateLimitError(None, backoff=0.2), 'done']
+
+        def call():
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        started = time.monotonic()
+        self.assertEqual(scheduler.call(call), 'done')
+        self.assertGreaterEqual(time.monotonic() - started, 0.19)
+
+    # ........................................................................
+    def test_open_breaker_stops_calls(self):
+        breaker = CircuitBreaker(1, 30)
+        breaker.failed()
+        with self.assertRaises(DropboxUnavailable):
+            CallScheduler(breaker=breaker).call(lambda: None)
+
+
+# ----------------------------------------------------------------------------
+class BulkJobTests(FakeDropboxTestCase):
+
+    # ........................................................................
+    def wait(self, job):
+        deadline = time.monotonic() + 10
+        while not job.finished and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(job.finished)
+        self.assertIsNone(job.error)
+        return job
+
+    # ........................................................................
+    def test_copy(self):
+        self.fake.add_files('/src', 3, 10)
+        self.fake.add_folder('/dest')
+        self.names('/dest')
+        paths = [f'/src/file{i:07d}.bin' for i in range(3)]
+        job = self.wait(self.dropbox.start_job('copy', paths, '/dest'))
+        self.assertEqual((job.done, job.failures), (3, []))
+        self.assertEqual(len(self.names('/dest')), 3)
+        self.assertEqual(self.calls('files/copy_batch_v2'), 1)
+        self.assertIs(self.dropbox.get_job(job.id), job)
+
+    # ........................................................................
+    def test_failures_are_reported_by_entry(self):
+        self.fake.add_file('/src/a.txt', 10)
+        job = self.wait(self.dropbox.start_job('delete',
+                ['/src/a.txt', '/src/missing.txt']))
+        self.assertEqual([path for path, reason in job.failures],
+                         ['/src/missing.txt'])
+        self.assertEqual(self.names('/src'), [])
+
+    # ........................................................................
+    def test_create_folders(self):
+        job = self.wait(self.dropbox.start_job('create_folder',
+                ['/new/a', '/new/b']))
+        self.assertEqual(job.failures, [])
+        self.assertEqual(sorted(self.names('/new')), ['a', 'b'])
+
+    # ........................................................................
+    def test_jobs_of_an_account_run_in_turn(self):
+        running = []
+        create_folders = self.dropbox.create_folders
+
+        def create_folders_slowly(paths, progress):
+            running.append(paths)
+            time.sleep(0.1)
+            self.assertEqual(running, [paths])
+            running.remove(paths)
+            return create_folders(paths, progress)
+        self.dropbox.create_folders = create_folders_slowly
+        jobs = [self.dropbox.start_job('create_folder', [f'/new/{i}'])
+                for i in range(3)]
+        for job in jobs:
+            self.wait(job)
+        self.assertEqual(sorted(self.names('/new')), ['0', '1', '2'])
+
+    # ........................................................................
+    def test_unfinished_batch_fails_the_job(self):
+        self.fake.add_file('/src/a.txt', 10)
+        self.dropbox.storage.batch_timeout = 0
+        job = self.dropbox.start_job('delete', ['/src/a.txt'])
+        deadline = time.monotonic() + 10
+        while not job.finished and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIn('did not finish', job.error)
+
+
+# ----------------------------------------------------------------------------
+class UploadTests(FakeDropboxTestCase):
+
+    # ........................................................................
+    def test_large_file_is_sent_in_chunks(self):
+        storage = self.dropbox.storage
+        size = 2 * storage.upload_chunk_size + 1000
+        upfile = SimpleUploadedFile('big.bin', b'x' * size)
+        response = self.post(views.upload,
+                {'folder_path': 'up', 'input_file': upfile})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, '/viewer/folder/up/?uploaded=%2Fup%2Fbig.bin')
+        self.assertEqual(self.calls('files/upload_session/append_v2'), 3)
+        self.assertEqual(self.dropbox.get_metadata('/up/big.bin').size, size)
+
+    # ........................................................................
+    def test_batch_is_committed_at_once(self):
+        upfiles = [SimpleUploadedFile(f'{i}.txt', b'data') for i in range(5)]
+        names = [f'folder/{i}.txt' for i in range(5)]
+        response = self.post(views.upload_batch,
+                {'folder_path': 'up', 'input_files': upfiles,
+                 'relative_paths': json.dumps(names)})
+        self.assertEqual(response.url, '/viewer/folder/up/?uploaded=5+files')
+        self.assertEqual(self.calls('files/upload_session/finish_batch'), 1)
+        self.assertEqual(sorted(self.names('/up/folder')),
+                         [f'{i}.txt' for i in range(5)])
+
+    # ........................................................................
+    def test_csrf_is_checked_before_sending_files(self):
+        for csrf_token in (False, True):
+            upfile = SimpleUploadedFile('a.txt', b'data')
+            response = self.post(views.upload,
+                    {'folder_path': 'up', 'input_file': upfile}, csrf_token)
+            self.assertEqual(response.status_code, 302 if csrf_token else 403)
+            self.assertEqual(self.calls('files/upload'), int(csrf_token))
+
+    # ........................................................................
+    def test_csrf_token_may_come_in_the_query_string(self):
+        upfile = SimpleUploadedFile('a.txt', b'data')
+        request = RequestFactory().post('/viewer/upload/',
+                {'folder_path': '', 'input_file': upfile})
+        request.session = self.request.session
+        token = get_token(request)
+        request.COOKIES[settings.CSRF_COOKIE_NAME] = request.META['CSRF_COOKIE']
+        request.GET = QueryDict(urlencode({'csrfmiddlewaretoken': token}))
+        response = views.upload(request)
+        self.assertEqual(response.url, '/viewer/?uploaded=%2Fa.txt')
+
+    # ........................................................................
+    def test_upload_is_notified_after_the_redirect(self):
+        request = RequestFactory().get('/viewer/', {'uploaded': 'a.txt'})
+        request.session = self.request.session
+        response = views.listfolder(request)
+        self.assertContains(response, 'Uploaded:')
+        self.assertNotIn('ETag', response)
+
+    # ........................................................................
+    def test_interrupted_upload_is_abandoned(self):
+        size = self.dropbox.storage.upload_chunk_size + 1000
+        upfile = SimpleUploadedFile('big.bin', b'x' * size)
+        with self.settings(DATA_UPLOAD_MAX_NUMBER_FIELDS=1), \
+                patch.object(DropBoxUploadSession, 'abort', autospec=True,
+                             side_effect=DropBoxUploadSession.abort) as abort:
+            with self.assertRaises(TooManyFieldsSent):
+                self.post(views.upload, {'input_file': upfile,
+                                         'folder_path': 'up', 'more': 'x'})
+        abort.assert_called_once()
+        # Let the chunk being sent finish
+        abort.call_args[0][0]._executor.shutdown()
+        self.assertEqual(self.calls('files/upload_session/finish'), 0)
+
+
+# ----------------------------------------------------------------------------
+class DownloadTests(FakeDropboxTestCase):
+
+    # ........................................................................
+    def setUp(self):
+        super().setUp()
+        self.metadata = self.fake.add_file('/a.bin', 300 * 1024)
+        self.content = (bytes(range(256)) * 1200)[:300 * 1024]
+
+    # ........................................................................
+    def get(self, **headers):
+        request = RequestFactory().get('/viewer/file/a.bin', **headers)
+        request.session = self.request.session
+        return views.download(request, name='a.bin')
+
+    # ........................................................................
+    def test_file_is_streamed(self):
+        response = self.get()
+        self.assertTrue(response.streaming)
+        chunks = list(response.streaming_content)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b''.join(chunks), self.content)
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    # ........................................................................
+    def test_range_is_downloaded(self):
+        response = self.get(HTTP_RANGE='bytes=1000-1999')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'],
+                         f'bytes 1000-1999/{len(self.content)}')
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.content[1000:2000])
+        response = self.get(HTTP_RANGE='bytes=-10')
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.content[-10:])
+
+    # ........................................................................
+    def test_unsatisfiable_range(self):
+        response = self.get(HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'],
+                         f'bytes */{len(self.content)}')
+        self.assertEqual(self.calls('files/download'), 0)
+
+    # ........................................................................
+    def test_conditional_requests(self):
+        etag = self.get()['ETag']
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.get(HTTP_IF_MATCH='"other"')
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(self.calls('files/download'), 1)
+        # A range of another version gets the whole file
+        response = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        response = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+
+    # ........................................................................
+    def test_parse_range(self):
+        self.assertEqual(views._parse_range('bytes=5-', 10), (5, 9))
+        self.assertEqual(views._parse_range('bytes=5-100', 10), (5, 9))
+        self.assertEqual(views._parse_range('bytes=-3', 10), (7, 9))
+        self.assertEqual(views._parse_range('bytes=-0', 10), (10, 9))
+        for header in ('bytes=5', 'bytes=0-1,3-4', 'items=0-1', 'bytes=5-2',
+                       'bytes=a-b'):
+            self.assertIsNone(views._parse_range(header, 10))
+
+    # ........................................................................
+    def test_parts_are_reassembled_in_order(self):
+        storage = self.dropbox.storage
+        storage.parallel_download_min_size = 1
+        storage.download_part_size = 50 * 1024
+        storage.download_workers = 3
+        self.fake.latency = 0.01
+        self.assertEqual(b''.join(self.get().streaming_content), self.content)
+        # The first part comes from the first request
+        self.assertEqual(self.calls('files/download'), 6)
+        response = self.get(HTTP_RANGE='bytes=1000-120000')
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.content[1000:120001])
+        self.assertEqual(storage.download_parts(1000, 119001),
+                         [(1000, 52199), (52200, 103399), (103400, 120000)])
+        self.assertIsNone(storage.download_parts(0, 0))
+
+
+# ----------------------------------------------------------------------------
+class AsyncDownloadTests(FakeDropboxTestCase):
+
+    # ........................................................................
+    def download(self, byte_range):
+        async def read():
+            dropbox = AsyncDropboxWrapper(self.dropbox)
+            async with self.fake.async_client() as http_client:
+                dropbox.client.http_client = http_client
+                remote_file = await dropbox.get_file('/a.bin', byte_range)
+                return b''.join([data async for data in remote_file.chunks()])
+        return async_to_sync(read)()
+
+    # ........................................................................
+    def test_range_is_downloaded(self):
+        self.fake.add_file('/a.bin', 1000)
+        self.assertEqual(self.download((10, 19)), bytes(range(10, 20)))
+
+    # ........................................................................
+    def test_ignored_range_is_an_error(self):
+        self.fake.add_file('/a.bin', 1000)
+        self.fake.ranges = False
+        self.assertRaises(DropBoxStorageException, self.download, (10, 19))
+        self.assertEqual(len(self.download(None)), 1000)
+
+
+# ----------------------------------------------------------------------------
+class MetricsTests(SimpleTestCase):
+
+    # ........................................................................
+    def test_metrics_are_off_by_default(self):
+        self.assertEqual(self.client.get('/viewer/metrics').status_code, 404)
+
+    # ........................................................................
+    def test_metrics_are_only_served_to_internal_ips(self):
+        with self.settings(VIEWER_METRICS=True):
+            self.assertEqual(self.client.get('/viewer/metrics',
+                    REMOTE_ADDR='10.0.0.1').status_code, 404)
+            self.client.get('/viewer/metrics')
+            response = self.client.get('/viewer/metrics')
+        self.assertEqual(response.status_code, 200)
+        # The first request was recorded once sent
+        self.assertContains(response,
+                'viewer_requests_total{view="metrics",status="200"}')
+
+    # ........................................................................
+    def test_middleware_follows_the_mode_of_the_view(self):
+        async def get_response(request):
+            return HttpResponse()
+        middleware = MetricsMiddleware(get_response)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = async_to_sync(middleware)(RequestFactory().get('/'))
+        with patch.object(MetricsMiddleware, '_sent') as sent:
+            response.close()
+        sent.assert_called_once()
+        self.assertFalse(asyncio.iscoroutinefunction(
+                MetricsMiddleware(lambda request: HttpResponse())))
@@ -0,0 +1,202 @@
+import base64
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from hashlib import sha1
+from threading import Lock
+
+from dropbox.files import (
+    ThumbnailArg, ThumbnailFormat, ThumbnailMode, ThumbnailSize,
+)
+
+from .dropbox import DropBoxStorageException, setting
+
+_DEFAULT_THUMBNAIL_WORKERS = 4
+
+# The image types that Dropbox makes thumbnails of, up to 20 MB
+EXTENSIONS = {'.jpg', '.jpeg', '.png', '.tiff', '.tif', '.gif', '.webp',
+              '.ppm', '.bmp'}
+MAX_IMAGE_SIZE = 20 * 1024 * 1024
+
+# The sizes accepted by Dropbox, as width x height tags
+SIZES = {name for name in dir(ThumbnailSize) if name.startswith('w')}
+
+# ----------------------------------------------------------------------------
+def has_thumbnail(name, size):
+    '''Whether Dropbox can make a thumbnail of a file.
+
+    Parameters:
+    name : the file's name
+    size : the file's size, in bytes
+    '''
+    extension = name[name.rfind('.'):].lower() if '.' in name else ''
+    return extension in EXTENSIONS and size <= MAX_IMAGE_SIZE
+
+
+# ----------------------------------------------------------------------------
+@lru_cache(maxsize=None)
+def get_thumbnail_executor():
+    '''Return the threads that fetch thumbnails, shared by all accounts.
+
+    Their number is given by settings.DROPBOX_THUMBNAIL_WORKERS.
+    '''
+    return ThreadPoolExecutor(setting('DROPBOX_THUMBNAIL_WORKERS',
+            _DEFAULT_THUMBNAIL_WORKERS))
+
+
+# ----------------------------------------------------------------------------
+class Thumbnailer:
+    '''Fetch JPEG thumbnails of the images of a Dropbox account.
+
+    Thumbnails are requested with files_get_thumbnail_batch, up to
+    BATCH_SIZE at once. Requests wait in a queue while MAX_BATCHES batches
+    are being fetched, so that a page full of images costs a few calls.
+    Thumbnails are identified by the revision of the image, and kept in the
+    storage's content cache, if any, once the account is known. The cache
+    is shared by all accounts, so its keys include the account's id, and a
+    revision given by a client only finds the thumbnails of its account.
+    The last MEMORY_SIZE thumbnails fetched are also kept in memory, so
+    that prefetched thumbnails are not fetched again without a cache.
+
+    Attributes:
+    account : the id of the Dropbox account, or None while unknown
+    '''
+
+    BATCH_SIZE = 25
+    MAX_BATCHES = 2
+    MEMORY_SIZE = 256
+
+    # ........................................................................
+    def __init__(self, storage):
+        self.storage = storage
+        self.cache = storage.content_cache
+        self.account = None
+        self._futures = {}
+        self._recent = OrderedDict()
+        self._queue = []
+        self._running = 0
+        self._lock = Lock()
+
+    # ........................................................................
+    def _key(self, rev, size):
+        namespace = sha1(self.account.encode()).hexdigest()[:16]
+        return f'{namespace}.{rev}.{size}.jpeg'
+
+    # ........................................................................
+    def _cache(self):
+        '''The content cache, or None if disabled or the account is not
+        known yet.'''
+        return self.cache if self.account is not None else None
+
+    # ........................................................................
+    def prefetch(self, revs, size):
+        '''Start fetching the thumbnails of many revisions, unless cached.
+
+        Return the futures of the thumbnails being fetched.
+
+        Parameters:
+        revs : the revisions of the images
+        size : one of SIZES
+        '''
+        futures = []
+        cache = self._cache()
+        with self._lock:
+            for rev in revs:
+                key = (rev, size)
+                future = self._futures.get(key)
+                if future is None:
+                    if key in self._recent:
+                        continue
+                    if cache is not None and \
+                            self._cached(cache.open(self._key(rev, size))):
+                        continue
+                    future = Future()
+                    self._futures[key] = future
+                    self._queue.append((key, rev, size))
+                futures.append(future)
+            self._flush()
+        return futures
+
+    # ........................................................................
+    def _cached(self, local_file):
+        if local_file is None:
+            return False
+        local_file.close()
+        return True
+
+    # ........................................................................
+    def get(self, rev, size):
+        '''Return the thumbnail of a revision, as bytes.
+
+        The thumbnail is read from memory or the cache, or joins the next
+        batch.
+        '''
+        with self._lock:
+            data = self._recent.get((rev, size))
+            if data is not None:
+                self._recent.move_to_end((rev, size))
+                return data
+        cache = self._cache()
+        if cache is not None:
+            local_file = cache.open(self._key(rev, size))
+            if local_file is not None:
+                with local_file:
+                    return local_file.read()
+        futures = self.prefetch([rev], size)
+        if not futures:
+            # Stored since it was looked up
+            return self.get(rev, size)
+        return futures[0].result()
+
+    # ........................................................................
+    def _flush(self):
+        '''Send the queued requests that fit; the lock must be held.'''
+        while self._queue and self._running < self.MAX_BATCHES:
+            batch = self._queue[:self.BATCH_SIZE]
+            del self._queue[:self.BATCH_SIZE]
+            self._running += 1
+            get_thumbnail_executor().submit(self._fetch, batch)
+
+    # ........................................................................
+    def _fetch(self, batch):
+        '''Fetch a batch of thumbnails, and resolve their futures.'''
+        try:
+            result = self.storage.client.files_get_thumbnail_batch([
+                    ThumbnailArg('rev:' + rev, ThumbnailFormat.jpeg,
+                                 getattr(ThumbnailSize, size),
+                                 ThumbnailMode.bestfit)
+                    for key, rev, size in batch])
+            for (key, rev, size), entry in zip(batch, result.entries):
+                if entry.is_success():
+                    data = base64.b64decode(entry.get_success().thumbnail)
+                    cache = self._cache()
+                    if cache is not None:
+                        cache.store(self._key(rev, size), data)
+                    self._resolve(key, data)
+                else:
+                    self._resolve(key, error=DropBoxStorageException(
+                            "Dropbox has no thumbnail for rev:{}: {}"
+                            .format(rev, entry.get_failure())))
+        except Exception as e:
+            for key, rev, size in batch:
+                self._resolve(key, error=e)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._flush()
+
+    # ........................................................................
+    def _resolve(self, key, data=None, error=None):
+        with self._lock:
+            future = self._futures.pop(key, None)
+            if data is not None:
+                self._recent[key] = data
+                self._recent.move_to_end(key)
+                while len(self._recent) > self.MEMORY_SIZE:
+                    self._recent.popitem(last=False)
+        if future is None or future.done():
+            return
+        if error is None:
+            future.set_result(data)
+        else:
+            future.set_exception(error)
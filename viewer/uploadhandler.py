@@ -0,0 +1,109 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.core.files.uploadhandler import FileUploadHandler
+
+from .dropbox import DropBoxUploadedFile, DropBoxUploadSession
+
+# ----------------------------------------------------------------------------
+class DropboxUploadHandler(FileUploadHandler):
+    '''Upload handler that sends files to Dropbox while they are received.
+
+    Each file is forwarded to a Dropbox upload session as its data arrives,
+    so the transfer to Dropbox overlaps the one from the client, and the
+    file is neither kept in memory nor written to disk. The handler produces
+    DropBoxUploadedFile objects, which are committed to their final path by
+    saving them to the storage (e.g., with DropboxWrapper.upload_file()).
+
+    It must be installed by views decorated with requires_access, before
+    request.POST or request.FILES are accessed, and after the request's
+    CSRF token was checked, since data is sent to Dropbox while the form
+    is read.
+
+    Small files fit in a single chunk, which is normally sent when the
+    file is saved. For batches, each of them is sent as soon as it is
+    received instead, by the storage's upload_workers threads, so that a
+    folder of many files is never held in memory. If the upload is
+    interrupted, the files are no longer sent; Dropbox discards their
+    unfinished sessions.
+
+    Parameters:
+    request : the request whose files are uploaded
+    batch   : whether the files are saved by DropBoxStorage.save_batch()
+    '''
+
+    # ........................................................................
+    def __init__(self, request, batch=False):
+        super().__init__(request)
+        self.storage = request.dropbox.storage
+        self.batch = batch
+        self._executor = None
+        self._flushes = set()
+        self._sessions = []
+        self.buffer = None
+
+    # ........................................................................
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.upload_session = DropBoxUploadSession(self.storage)
+        self._sessions.append(self.upload_session)
+        self.buffer = bytearray()
+
+    # ........................................................................
+    def receive_data_chunk(self, raw_data, start):
+        self.buffer += raw_data
+        # A full chunk is only sent once more data arrives, since the last
+        # chunk of the session must be flagged as such
+        chunk_size = self.storage.upload_chunk_size
+        while len(self.buffer) > chunk_size:
+            self.upload_session.append(bytes(self.buffer[:chunk_size]))
+            del self.buffer[:chunk_size]
+        return None
+
+    # ........................................................................
+    def file_complete(self, file_size):
+        if self.buffer:
+            self.upload_session.append(bytes(self.buffer), last=True)
+        self.buffer = None
+        if self.batch and self.upload_session.session_id is None:
+            self._flush()
+        return DropBoxUploadedFile(self.upload_session, self.file_name,
+                self.content_type, file_size, self.charset,
+                self.content_type_extra)
+
+    # ........................................................................
+    def upload_complete(self):
+        if self._executor is not None:
+            # The sessions still being flushed are awaited when saved
+            self._executor.shutdown(wait=False)
+        return None
+
+    # ........................................................................
+    def upload_interrupted(self):
+        '''Stop sending the files received so far, and drop their data.
+
+        Views call it when reading the form fails, e.g. because the client
+        went away; Django 3.2 and later also call it themselves, so it may
+        be called more than once.
+        '''
+        self.buffer = None
+        for future in self._flushes:
+            future.cancel()
+        self._flushes = set()
+        for upload_session in self._sessions:
+            upload_session.abort()
+        self._sessions = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    # ........................................................................
+    def _flush(self):
+        '''Send the small file just received, holding at most two files per
+        worker in memory.'''
+        workers = self.storage.upload_workers
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(workers)
+        self._flushes.add(self.upload_session.flush(self._executor))
+        if len(self._flushes) >= 2 * workers:
+            # Failures are raised when the sessions are finished
+            done, self._flushes = wait(self._flushes,
+                                       return_when=FIRST_COMPLETED)
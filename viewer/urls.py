@@ -1,13 +1,31 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
+if settings.VIEWER_ASYNC_VIEWS:
+    from . import asyncviews as main_views
+else:
+    main_views = views
+
 urlpatterns = [
-    path('', views.listfolder, name='index'),
-    path('folder/<path:url>/', views.listfolder, name='folder'),
-    path('file/<path:name>', views.download, name='file'),
-    path('upload/', views.upload, name='upload'),
-    path('newfolder/', views.newfolder, name='newfolder'),
+    path('', main_views.listfolder, name='index'),
+    path('zip', views.download_zip, name='zip'),
+    path('folder/<path:url>/zip', views.download_zip, name='folder_zip'),
+    path('folder/<path:url>/', main_views.listfolder, name='folder'),
+    path('file/<path:name>', main_views.download, name='file'),
+    path('thumb/<path:name>', views.thumbnail, name='thumb'),
+    path('upload/', main_views.upload, name='upload'),
+    path('uploadbatch/', views.upload_batch, name='upload_batch'),
+    path('search/', views.search, name='search'),
+    path('events/', main_views.watch_folder, name='events'),
+    path('events/<path:url>', main_views.watch_folder, name='folder_events'),
+    path('api/folder/', main_views.api_folder, name='api_root'),
+    path('api/folder/<path:url>', main_views.api_folder, name='api_folder'),
+    path('newfolder/', main_views.newfolder, name='newfolder'),
+    path('bulk/', views.bulk, name='bulk'),
+    path('bulk/<str:job_id>', views.bulk_job, name='bulk_job'),
     path('auth/', views.request_access, name='auth'),
     path('confirm/', views.confirm_access, name='confirm'),
+    path('metrics', views.metrics, name='metrics'),
 ]
@@ -1,14 +1,109 @@
+import json
+import logging
+from calendar import timegm
+from copy import copy
+from functools import wraps
+from hashlib import sha1
+
+from django.core.cache import caches
 from django.shortcuts import render
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import (FileResponse, Http404, HttpResponse,
+                         HttpResponseRedirect, QueryDict,
+                         StreamingHttpResponse)
 from django.conf import settings
+from django.middleware.csrf import CsrfViewMiddleware
+from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.datastructures import MultiValueDict
+from django.utils.http import (
+    http_date, parse_http_date_safe, quote_etag, urlencode,
+)
+from django.utils.safestring import mark_safe
+from django.views.decorators.csrf import csrf_exempt
 from django.views.defaults import server_error
+from dropbox.exceptions import ApiError, AuthError
+from dropbox.files import DeletedMetadata
+
+from .dropbox import DropBoxStorageException
+from .metrics import metrics as process_metrics
+from .scheduler import TRANSIENT_ERRORS, DropboxUnavailable
+from .thumbnails import SIZES
+from .uploadhandler import DropboxUploadHandler
+from .watcher import watcher
+from .wrapper import BULK_OPERATIONS, DropboxMetaFile, DropboxRegistry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+registry = DropboxRegistry(settings.DROPBOX_APP_KEY, watcher)
+logger = logging.getLogger(__name__)
+
+# The fields of the entries sent by api_folder, taken from DropboxMetaFile
+API_FIELDS = {
+    'name': lambda entry: entry.name,
+    'path': lambda entry: entry.path,
+    'is_dir': lambda entry: entry.is_dir,
+    'size': lambda entry: entry.bytes,
+    'count': lambda entry: entry.count,
+    'modified': lambda entry: entry.date.isoformat() + 'Z'
+                              if entry.date is not None else None,
+    'rev': lambda entry: entry.rev,
+    'thumbnail': lambda entry: entry.thumbnail,
+}
+_DEFAULT_API_FIELDS = ('name', 'is_dir', 'size', 'modified')
+_DEFAULT_API_MAX_LIMIT = 10000
+
+# The seconds between comments sent to keep an idle event stream open, and
+# before browsers reconnect a closed one, in milliseconds
+_EVENTS_KEEPALIVE = 15
+_EVENTS_RETRY = 5000
+
+# ----------------------------------------------------------------------------
+def requires_access(view):
+    '''Decorate a view that redirects to the authorization page if there is
+    no access to a Dropbox account.
 
-from .wrapper import DropboxWrapper
+    The wrapper for the session's account is set as request.dropbox. The
+    access is checked locally. If Dropbox rejects the token while the view
+    runs, the access is discarded and the user is also redirected. If
+    Dropbox cannot be reached, even after retries, the view answers 503
+    (Service Unavailable).
+    '''
+    @wraps(view)
+    def checked_view(request, *args, **kwargs):
+        dropbox = registry.get(request.session)
+        try:
+            if dropbox is None or not dropbox.has_access():
+                return HttpResponseRedirect(reverse('auth'))
+            request.dropbox = dropbox
+            return view(request, *args, **kwargs)
+        except AuthError:
+            registry.forget(request.session)
+            return HttpResponseRedirect(reverse('auth'))
+        except (DropboxUnavailable,) + TRANSIENT_ERRORS as e:
+            return _unavailable(e)
+    return checked_view
+
+# ----------------------------------------------------------------------------
+def _unavailable(error):
+    '''Return the 503 response for a failure to reach Dropbox.
 
-dropbox = DropboxWrapper(settings.DROPBOX_APP_KEY)
+    Clients are told when to retry, by the circuit breaker or the rate
+    limit, if known.
+    '''
+    response = HttpResponse('Dropbox is not available, please try again '
+                            'later.', status=503, content_type='text/plain')
+    retry_after = getattr(error, 'retry_after', None) or \
+            getattr(error, 'backoff', None)
+    if retry_after:
+        response['Retry-After'] = str(max(1, round(retry_after)))
+    return response
 
 # ----------------------------------------------------------------------------
+@requires_access
 def listfolder(request, url='', uploaded=None, created=None):
     '''List all contents from a Dropbox folder.
 
@@ -17,16 +112,113 @@ def listfolder(request, url='', uploaded=None, created=None):
     If there is no access to a Dropbox account, it redirects to the
     authorization page.
 
+    Large folders are split in pages of settings.VIEWER_PAGE_SIZE entries,
+    selected by the "page" query parameter. The thumbnails of the images in
+    a page start being fetched before it is sent.
+
+    Pages carry an ETag derived from the version of the folder (see
+    DropboxWrapper.folder_version), so reloading an unchanged folder is
+    answered with 304 (Not Modified). The listing of each version of a page
+    is rendered once, and kept in the cache named by
+    settings.VIEWER_FRAGMENT_CACHE.
+
     Parameters:
     url      : the current Dropbox folder being displayed
-    uploaded : the name of the last file uploaded, to be notified
+    uploaded : the name of the last file uploaded, to be notified; by
+               default, the "uploaded" query parameter
     created  : the name of the last folder created, to be notified
     '''
-    if not dropbox.has_access():
-        return HttpResponseRedirect(reverse('auth'))
+    uploaded = uploaded or request.GET.get('uploaded')
+    page = _page_number(request)
+    page_size = settings.VIEWER_PAGE_SIZE
+    path = '' if len(url) == 0 else ('/' + url)
+
+    version = request.dropbox.folder_version(path)
+    etag = _listing_etag(request, page, version, uploaded, created)
+    if etag is not None:
+        response = get_conditional_response(request, etag=etag)
+        if response is not None:
+            return _listing_headers(response, etag)
 
-    files = dropbox.listdir('' if len(url) == 0 else ('/' + url))
+    account = request.dropbox.account.account_id
+    listing = _cached_listing(account, url, page, version)
+    if listing is None:
+        # One extra entry tells whether there is a next page
+        files = request.dropbox.listdir(path,
+                offset=(page - 1) * page_size, limit=page_size + 1)
+        request.dropbox.prefetch_thumbnails(files[:page_size])
+        listing = _render_listing(account, url, files, page, version)
+    return _render_folder(request, url, listing, uploaded, created, etag)
 
+def _uploaded_redirect(path, uploaded):
+    '''Redirect to the page of a folder, notifying an upload.'''
+    url = reverse('folder', args=[path]) if path else reverse('index')
+    return HttpResponseRedirect(url + '?' + urlencode({'uploaded': uploaded}))
+
+def _page_number(request):
+    '''The page of a folder listing asked by the "page" query parameter.'''
+    if request.GET.get('page', '').isdigit():
+        return max(int(request.GET['page']), 1)
+    return 1
+
+def _listing_etag(request, page, version, uploaded, created):
+    '''Return the ETag of a page of a folder listing, or None if the page
+    cannot be reused.
+
+    Pages with notifications are never reused. Pages hold the client's
+    CSRF token, so they are only reused while its secret is the same.
+    '''
+    secret = request.META.get('CSRF_COOKIE')
+    if version is None or secret is None or uploaded or created:
+        return None
+    key = f'{version}:{page}:{settings.VIEWER_PAGE_SIZE}:{secret}'
+    return quote_etag(sha1(key.encode()).hexdigest())
+
+def _listing_headers(response, etag):
+    '''Set the headers that make browsers validate a listing page.'''
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+def _fragment_cache():
+    '''The cache of rendered listings, or None if disabled.'''
+    alias = getattr(settings, 'VIEWER_FRAGMENT_CACHE', None)
+    return caches[alias] if alias is not None else None
+
+def _fragment_key(account, url, page, version):
+    # Versions are not unique among accounts
+    key = f'{account}:{url}:{page}:{settings.VIEWER_PAGE_SIZE}:{version}'
+    return 'viewer-listing:' + sha1(key.encode()).hexdigest()
+
+def _cached_listing(account, url, page, version):
+    '''Return the rendered listing of a version of a folder page of an
+    account, given its id, or None if it is not in the cache.'''
+    cache = _fragment_cache()
+    if cache is None or version is None:
+        return None
+    listing = cache.get(_fragment_key(account, url, page, version))
+    return mark_safe(listing) if listing is not None else None
+
+def _render_listing(account, url, files, page, version):
+    '''Render the table of a page of a folder listing, given up to one
+    entry more than settings.VIEWER_PAGE_SIZE, and cache it under the
+    folder's version, if any.'''
+    page_size = settings.VIEWER_PAGE_SIZE
+    context = {'files': files[:page_size],
+               'page': page,
+               'page_url': reverse('folder', args=[url]) if url else
+                           reverse('index'),
+               'has_next': len(files) > page_size,
+              }
+    listing = render_to_string('viewer/listing.html', context)
+    cache = _fragment_cache()
+    if cache is not None and version is not None:
+        cache.set(_fragment_key(account, url, page, version), listing)
+    return listing
+
+def _render_folder(request, url, listing, uploaded, created, etag=None):
+    '''Render a folder page around its rendered listing; see
+    listfolder().'''
     # The hierarchy of folders, for easy navigation
     levels = [{'url': '', 'name': ''}]
     if url != '':
@@ -38,71 +230,566 @@ def listfolder(request, url='', uploaded=None, created=None):
 
     context = {'url': url, 
                'levels': levels,
-               'files': files,
+               'listing': listing,
                'current': levels[-1]['name'],
                'uploaded': uploaded,
                'created': created,
+               'live_updates': settings.VIEWER_LIVE_UPDATES,
               }
-    return render(request, 'viewer/index.html', context)
+    response = render(request, 'viewer/index.html', context)
+    if etag is not None:
+        _listing_headers(response, etag)
+    return response
 
 # ----------------------------------------------------------------------------
+@requires_access
+def api_folder(request, url=''):
+    '''List a page of the contents of a Dropbox folder, as JSON.
+
+    Entries are sorted as in listfolder, and selected by the "offset" and
+    "limit" query parameters (by default, settings.VIEWER_PAGE_SIZE, and at
+    most settings.VIEWER_API_MAX_LIMIT). The "fields" parameter is a comma
+    separated list of API_FIELDS. Each entry is an array of those fields,
+    in the same order; e.g.:
+
+        {"path": "/photos", "fields": ["name", "size"], "offset": 0,
+         "entries": [["a.jpg", 1024], ["b.jpg", 2048]], "next_offset": null}
+
+    The next page, if any, starts at next_offset. Like listfolder, pages
+    carry an ETag, and unchanged ones are answered with 304. If there is no
+    access to a Dropbox account, it redirects to the authorization page.
+    '''
+    try:
+        offset, limit, fields = _api_params(request)
+    except ValueError as e:
+        return _api_error(str(e), 400)
+    path = '' if len(url) == 0 else ('/' + url)
+    try:
+        etag = _api_etag(request.dropbox.folder_version(path), offset, limit,
+                fields)
+        if etag is not None:
+            response = get_conditional_response(request, etag=etag)
+            if response is not None:
+                return _listing_headers(response, etag)
+        # One extra entry tells whether there is a next page
+        entries = request.dropbox.listdir(path, offset=offset,
+                limit=limit + 1)
+    except ApiError:
+        return _api_error('Folder not found', 404)
+    return _api_listing(path, offset, limit, fields, entries, etag)
+
+def _api_params(request):
+    '''Return the (offset, limit, fields) of an API request, or raise
+    ValueError with the problem.'''
+    max_limit = getattr(settings, 'VIEWER_API_MAX_LIMIT',
+                        _DEFAULT_API_MAX_LIMIT)
+    offset = request.GET.get('offset', '0')
+    limit = request.GET.get('limit', str(settings.VIEWER_PAGE_SIZE))
+    if not offset.isdigit() or not limit.isdigit() or \
+            not 0 < int(limit) <= max_limit:
+        raise ValueError(f'offset must be a number, and limit a number '
+                         f'from 1 to {max_limit}')
+    fields = tuple(request.GET['fields'].split(',')) if \
+            request.GET.get('fields') else _DEFAULT_API_FIELDS
+    unknown = [field for field in fields if field not in API_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return int(offset), int(limit), fields
+
+def _api_etag(version, offset, limit, fields):
+    '''Return the ETag of a page of the API, or None.'''
+    if version is None:
+        return None
+    key = f"api:{version}:{offset}:{limit}:{','.join(fields)}"
+    return quote_etag(sha1(key.encode()).hexdigest())
+
+def _api_listing(path, offset, limit, fields, entries, etag):
+    '''Build the response with a page of entries, given up to one entry
+    more than limit; see api_folder().'''
+    getters = [API_FIELDS[field] for field in fields]
+    content = {
+        'path': path or '/',
+        'fields': fields,
+        'offset': offset,
+        'entries': [[getter(entry) for getter in getters]
+                    for entry in entries[:limit]],
+        'next_offset': offset + limit if len(entries) > limit else None,
+    }
+    response = HttpResponse(_dump_json(content),
+            content_type='application/json')
+    if etag is not None:
+        _listing_headers(response, etag)
+    return response
+
+def _api_error(message, status):
+    return HttpResponse(_dump_json({'error': message}), status=status,
+            content_type='application/json')
+
+def _dump_json(content):
+    '''Serialize to compact JSON, with orjson if it is installed.'''
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, separators=(',', ':')).encode()
+
+# ----------------------------------------------------------------------------
+@requires_access
+def watch_folder(request, url=''):
+    '''Stream the changes made to a Dropbox folder, as Server-Sent Events.
+
+    While a folder page is open, the browser listens to this stream and
+    updates the listing in place. Each "changes" event carries JSON with
+    the entries added or modified, as they are shown in listings, and the
+    lower-case paths of those deleted:
+
+        {"changed": [{"path": "/photos/a.jpg", "name": "a.jpg",
+                      "is_dir": false, "url": "/viewer/file/photos/a.jpg",
+                      "size": "2 MB", "date": "2021-01-31 12:00"}],
+         "deleted": ["/photos/b.jpg"]}
+
+    A "reset" event means the changes could not be followed, and the page
+    must be reloaded. All the streams of a folder share a single longpoll
+    to Dropbox; see FolderWatcher. Each open stream holds a thread of WSGI
+    servers, but not of the ASGI one (see asyncviews.watch_folder), so
+    streams are only served if settings.VIEWER_LIVE_UPDATES is True.
+    '''
+    if not settings.VIEWER_LIVE_UPDATES:
+        raise Http404
+    path = '' if len(url) == 0 else ('/' + url)
+
+    def stream():
+        # Subscribed only once sent, since unstarted streams are not closed
+        subscription = watcher.subscribe(request.dropbox, path)
+        try:
+            yield f'retry: {_EVENTS_RETRY}\n\n'
+            while True:
+                event = subscription.get(_EVENTS_KEEPALIVE)
+                yield _sse(event) if event is not None else ': keepalive\n\n'
+        finally:
+            watcher.unsubscribe(subscription)
+
+    return _event_stream(StreamingHttpResponse(stream()))
+
+def _event_stream(response):
+    '''Set the headers of a stream of Server-Sent Events.'''
+    response['Content-Type'] = 'text/event-stream'
+    response['Cache-Control'] = 'no-cache'
+    # Proxies such as nginx must not hold events in their buffers
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def _sse(event):
+    '''Format an event of a Subscription as a Server-Sent Event.'''
+    kind, changes = event
+    if kind != 'changes':
+        return f'event: {kind}\ndata: {{}}\n\n'
+    changed = []
+    deleted = []
+    for metadata in changes:
+        if isinstance(metadata, DeletedMetadata):
+            deleted.append(metadata.path_lower)
+            continue
+        entry = DropboxMetaFile(metadata)
+        changed.append({
+            'path': entry.path.lower(),
+            'name': entry.name,
+            'is_dir': entry.is_dir,
+            'url': reverse('folder' if entry.is_dir else 'file',
+                           args=[entry.url]),
+            'size': entry.size or '',
+            'date': entry.date.strftime('%Y-%m-%d %H:%M')
+                    if entry.date is not None else '',
+        })
+    data = json.dumps({'changed': changed, 'deleted': deleted})
+    return f'event: changes\ndata: {data}\n\n'
+
+# ----------------------------------------------------------------------------
+def _validators(metadata):
+    '''Return the ETag and Last-Modified timestamp of a Dropbox file.'''
+    etag = quote_etag(metadata.content_hash or metadata.rev)
+    last_modified = timegm(metadata.server_modified.utctimetuple())
+    return etag, last_modified
+
+# ----------------------------------------------------------------------------
+def _parse_range(header, size):
+    '''Parse a "bytes=" Range header into a (start, end) tuple.
+
+    Both positions are inclusive. Only single ranges are supported; if the
+    header is malformed or asks for several ranges, return None so that the
+    whole file is sent instead. The returned range may be unsatisfiable
+    (start >= size), which the caller must check.
+    '''
+    units, _, spec = header.partition('=')
+    if units.strip() != 'bytes' or ',' in spec:
+        return None
+    first, dash, last = spec.strip().partition('-')
+    if not dash:
+        return None
+    try:
+        if first == '':
+            # Suffix range: the last N bytes
+            length = int(last)
+            start = max(size - length, 0) if length > 0 else size
+            end = size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+    except ValueError:
+        return None
+    return start, end
+
+# ----------------------------------------------------------------------------
+@requires_access
 def download(request, name):
     '''Download the named file from Dropbox.
 
     If there is no access to a Dropbox account, it redirects to the
-    authorization page.
+    authorization page. The file is streamed from Dropbox in chunks, so it
+    is never held entirely in memory.
+
+    The response carries ETag and Last-Modified validators taken from the
+    Dropbox metadata. Conditional requests are answered with 304 (or 412),
+    and a single Range is answered with 206 after a ranged download from
+    Dropbox, so resumed downloads only transfer the missing bytes.
+
+    With a local content cache, files already in it are sent from disk,
+    and other files are stored in it while they are sent.
+    In 'redirect' download mode, the client may be redirected to download
+    the file straight from Dropbox instead (see DropboxWrapper.redirects).
     '''
-    if not dropbox.has_access():
-        return HttpResponseRedirect(reverse('auth'))
+    if request.dropbox.redirects(name):
+        metadata, link = request.dropbox.get_temporary_link(name)
+        if request.dropbox.redirects(name, metadata):
+            return _redirect(request, metadata, link)
 
-    fd = dropbox.get_file(name)
+    byte_range = None
+    metadata = None
+    if _needs_metadata(request) or request.dropbox.caches_content():
+        # A metadata call is much cheaper than a download that may be
+        # discarded, so check the validators before fetching any content
+        metadata = request.dropbox.get_metadata(name)
+        response, byte_range = _preconditions(request, metadata)
+        if response is not None:
+            return response
+
+    fd = request.dropbox.get_file(name, byte_range, metadata)
+    if fd.local_file is not None and byte_range is None:
+        # Lets the server use sendfile, if available
+        response = FileResponse(fd.local_file,
+                content_type="application/octet-stream")
+    else:
+        response = StreamingHttpResponse(fd.chunks(),
+                content_type="application/octet-stream",
+                status=200 if byte_range is None else 206)
+    return _file_headers(response, name, fd.metadata, fd.size, byte_range)
+
+def _redirect(request, metadata, link):
+    '''Redirect a download request to a temporary link, unless it is
+    answered by its conditional headers.'''
+    etag, last_modified = _validators(metadata)
+    response = get_conditional_response(request, etag=etag,
+            last_modified=last_modified)
+    if response is None:
+        response = HttpResponseRedirect(link)
+        # The link expires, so the redirection must not be reused
+        response['Cache-Control'] = 'private, no-cache'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+def _needs_metadata(request):
+    '''Whether a download request is conditional or asks for a range.'''
+    return any(header in request.META for header in (
+            'HTTP_RANGE', 'HTTP_IF_MATCH', 'HTTP_IF_NONE_MATCH',
+            'HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_UNMODIFIED_SINCE'))
+
+def _preconditions(request, metadata):
+    '''Evaluate the conditional and Range headers of a download request.
+
+    Return a (response, byte_range) tuple. The response (304, 412 or 416)
+    is None if the file must be sent; byte_range is None if all of it must.
+    '''
+    etag, last_modified = _validators(metadata)
+    response = get_conditional_response(request, etag=etag,
+            last_modified=last_modified)
+    if response is not None:
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        return response, None
+    byte_range = None
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if range_header and (if_range is None or if_range == etag or
+            parse_http_date_safe(if_range) == last_modified):
+        byte_range = _parse_range(range_header, metadata.size)
+    if byte_range is not None and byte_range[0] >= metadata.size:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{metadata.size}'
+        return response, None
+    return None, byte_range
+
+def _file_headers(response, name, metadata, size, byte_range):
+    '''Set the headers of a response that sends a file, or part of it.'''
     nice_name = name.split('/')[-1]
-    response = HttpResponse(fd.read(), content_type="application/octet-stream")
+    etag, last_modified = _validators(metadata)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Length'] = size
+    if byte_range is not None:
+        start = byte_range[0]
+        end = start + size - 1
+        response['Content-Range'] = f'bytes {start}-{end}/{metadata.size}'
     response['Content-Disposition'] = f'inline; filename={nice_name}'
     return response
-    
+
 # ----------------------------------------------------------------------------
+@requires_access
+def thumbnail(request, name):
+    '''Send a JPEG thumbnail of the named image.
+
+    If there is no access to a Dropbox account, it redirects to the
+    authorization page. The "size" query parameter chooses one of Dropbox's
+    sizes (e.g., w1024h768 for a preview). Given the image's revision in the
+    "rev" query parameter, no metadata is requested, and the browser may
+    keep the thumbnail for a year, since the URL changes with the image.
+    '''
+    size = request.GET.get('size', request.dropbox.thumbnail_size)
+    rev = request.GET.get('rev')
+    if size not in SIZES or rev is not None and not _is_rev(rev):
+        raise Http404
+    if rev is None:
+        try:
+            rev = request.dropbox.get_metadata(name).rev
+        except ApiError:
+            raise Http404
+    etag = quote_etag(f'{rev}.{size}')
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        try:
+            response = HttpResponse(request.dropbox.get_thumbnail(rev, size),
+                    content_type='image/jpeg')
+        except (ApiError, DropBoxStorageException):
+            raise Http404
+    response['ETag'] = etag
+    if 'rev' in request.GET:
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    else:
+        response['Cache-Control'] = 'private, no-cache'
+    return response
+
+def _is_rev(rev):
+    '''Whether a string is a valid Dropbox revision.'''
+    return len(rev) >= 9 and all(c in '0123456789abcdef' for c in rev)
+
+# ----------------------------------------------------------------------------
+@requires_access
+def download_zip(request, url=''):
+    '''Download a Dropbox folder, with all its contents, as a ZIP archive.
+
+    The archive is streamed while it is built, so its first bytes are sent
+    right away. If there is no access to a Dropbox account, it redirects to
+    the authorization page.
+    '''
+    nice_name = (url.split('/')[-1] or 'Dropbox') + '.zip'
+    response = StreamingHttpResponse(
+            request.dropbox.zip_folder('' if len(url) == 0 else ('/' + url)),
+            content_type="application/zip")
+    response['Content-Disposition'] = f'attachment; filename={nice_name}'
+    return response
+
+# ----------------------------------------------------------------------------
+@csrf_exempt
+@requires_access
 def upload(request):
     '''Upload the file sent by POST to Dropbox.
 
-    Redirect to listfolder afterwards. If there is no access to a Dropbox 
-    account, it redirects to the authorization page.
-    '''
-    if not dropbox.has_access():
-        return HttpResponseRedirect(reverse('auth'))
+    Redirect to the folder's page afterwards. If there is no access to a
+    Dropbox account, it redirects to the authorization page.
 
-    if request.method == 'POST' and request.FILES['input_file']:
+    The file is forwarded to Dropbox while it is received, by a
+    DropboxUploadHandler, so the CSRF token is checked beforehand, from a
+    header or the query string; see _receive_files().
+    '''
+    if request.method != 'POST':
+        return HttpResponseRedirect(reverse('index'))
+    rejected = _receive_files(request, DropboxUploadHandler(request))
+    if rejected is not None:
+        return rejected
+    if request.FILES['input_file']:
         path = request.POST['folder_path']
-        name = dropbox.upload_file(path=path,
+        name = request.dropbox.upload_file(path=path,
                 upfile=request.FILES['input_file'])
-        return listfolder(None, url=path, uploaded=name)
+        return _uploaded_redirect(path, name)
     return HttpResponseRedirect(reverse('index'))
 
 # ----------------------------------------------------------------------------
+@csrf_exempt
+@requires_access
+def upload_batch(request):
+    '''Upload many files, or a whole folder, sent by POST to Dropbox.
+
+    The relative paths of the files (e.g., inside an uploaded folder) are
+    sent as a JSON list in the "relative_paths" field, in the same order as
+    the files, since each field counts against
+    settings.DATA_UPLOAD_MAX_NUMBER_FIELDS. All files are committed
+    together, at the end. Redirect to the folder's page afterwards. If
+    there is no access to a Dropbox account, it redirects to the
+    authorization page. The CSRF token is checked as in upload().
+    '''
+    if request.method != 'POST':
+        return HttpResponseRedirect(reverse('index'))
+    rejected = _receive_files(request, DropboxUploadHandler(request,
+                                                            batch=True))
+    if rejected is not None:
+        return rejected
+    if request.FILES.getlist('input_files'):
+        path = request.POST['folder_path']
+        upfiles = request.FILES.getlist('input_files')
+        try:
+            names = json.loads(request.POST.get('relative_paths', ''))
+        except ValueError:
+            names = None
+        if not isinstance(names, list) or len(names) != len(upfiles) or \
+                not all(isinstance(name, str) for name in names):
+            names = None
+        saved = request.dropbox.upload_files(path=path, upfiles=upfiles,
+                names=names)
+        uploaded = saved[0] if len(saved) == 1 else f'{len(saved)} files'
+        return _uploaded_redirect(path, uploaded)
+    return HttpResponseRedirect(reverse('index'))
+
+def _receive_files(request, handler):
+    '''Read the form of an upload with a DropboxUploadHandler, once its CSRF
+    token was checked; return the response that rejects it, or None.
+
+    The token must come in the X-CSRFToken header (see
+    settings.CSRF_HEADER_NAME), or, for clients without JavaScript, in the
+    "csrfmiddlewaretoken" query parameter, since the files sent before a
+    form field would reach Dropbox before it is read. If reading the form
+    fails, the files already sent are abandoned.
+    '''
+    check = copy(request)
+    # With only the token of the query string as form fields, the check
+    # does not read the request's body
+    check._post = QueryDict(mutable=True)
+    if 'csrfmiddlewaretoken' in request.GET:
+        check._post['csrfmiddlewaretoken'] = request.GET['csrfmiddlewaretoken']
+    check._files = MultiValueDict()
+    rejected = CsrfViewMiddleware().process_view(check, None, (), {})
+    if rejected is not None:
+        return rejected
+    request.upload_handlers.insert(0, handler)
+    try:
+        request.FILES
+    except BaseException:
+        handler.upload_interrupted()
+        raise
+    return None
+
+# ----------------------------------------------------------------------------
+@requires_access
 def newfolder(request):
     '''Create the folder sent by POST in Dropbox.
     
     Redirect to listfolder afterwards. If there is no access to a Dropbox 
     account, it redirects to the authorization page.
     '''
-    if not dropbox.has_access():
-        return HttpResponseRedirect(reverse('auth'))
-
     if request.method == 'POST':
         path = request.POST['folder_path']
         name = request.POST['folder_name']
         if len(name) == '':
-            return listfolder(None, url=path)
-        dropbox.create_folder(path=path, name=name)
-        return listfolder(None, url=path, created=name)
+            return listfolder(request, url=path)
+        request.dropbox.create_folder(path=path, name=name)
+        return listfolder(request, url=path, created=name)
     return HttpResponseRedirect(reverse('index'))
 
+# ----------------------------------------------------------------------------
+@requires_access
+def bulk(request):
+    '''Start copying, moving or deleting many entries, or creating many
+    folders, in the background.
+
+    The operation is sent by POST, as JSON, with the paths of the entries
+    (or of the new folders) relative to the root, and the folder to copy or
+    move them into; e.g.:
+
+        {"operation": "move", "paths": ["photos/a.jpg", "photos/b.jpg"],
+         "destination": "archive"}
+
+    The operation is one of wrapper.BULK_OPERATIONS. It is answered with
+    202 (Accepted), and the job's progress (see bulk_job), whose URL is
+    given by the Location header. If there is no access to a Dropbox
+    account, it redirects to the authorization page.
+    '''
+    if request.method != 'POST':
+        return _api_error('Bulk operations must be sent by POST', 405)
+    try:
+        content = json.loads(request.body)
+        operation = content['operation']
+        if not isinstance(content['paths'], list):
+            raise TypeError
+        paths = ['/' + path.strip('/') for path in content['paths']]
+        destination = '/' + content.get('destination', '').strip('/')
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return _api_error('The operation must be sent as JSON, with its '
+                          'paths', 400)
+    if operation not in BULK_OPERATIONS:
+        return _api_error(f"The operation must be one of "
+                          f"{', '.join(BULK_OPERATIONS)}", 400)
+    if not paths or '/' in paths:
+        return _api_error('The root folder cannot be changed', 400)
+    job = request.dropbox.start_job(operation, paths, destination)
+    response = HttpResponse(_dump_json(job.as_dict()), status=202,
+            content_type='application/json')
+    response['Location'] = reverse('bulk_job', args=[job.id])
+    return response
+
+@requires_access
+def bulk_job(request, job_id):
+    '''Report the progress of a job started by bulk, as JSON; e.g.:
+
+        {"id": "...", "operation": "move", "total": 2, "done": 2,
+         "failures": [{"path": "/photos/b.jpg", "reason": "..."}],
+         "finished": true, "error": null}
+
+    Jobs of other accounts, or too old, are not found. If there is no
+    access to a Dropbox account, it redirects to the authorization page.
+    '''
+    job = request.dropbox.get_job(job_id)
+    if job is None:
+        return _api_error('Job not found', 404)
+    response = HttpResponse(_dump_json(job.as_dict()),
+            content_type='application/json')
+    response['Cache-Control'] = 'no-store'
+    return response
+
+# ----------------------------------------------------------------------------
+@requires_access
+def search(request):
+    '''Find the files and folders whose names contain the "q" query
+    parameter.
+
+    At most settings.VIEWER_PAGE_SIZE matches are displayed. If there is no
+    access to a Dropbox account, it redirects to the authorization page.
+    '''
+    query = request.GET.get('q', '').strip()
+    matches = []
+    if query:
+        matches = request.dropbox.search(query,
+                limit=settings.VIEWER_PAGE_SIZE)
+    context = {'query': query,
+               'matches': matches,
+              }
+    return render(request, 'viewer/search.html', context)
+
 # ----------------------------------------------------------------------------
 def request_access(request):
     '''Display the authorization request page.'''
     redirect = request.build_absolute_uri(reverse('confirm'))
-    print(f"REDIRECT={redirect}")
-    url = dropbox.request_access(request.session, redirect)
+    logger.debug('Authorization redirects to %s', redirect)
+    url = registry.request_access(request.session, redirect)
     context = {'url': url}
     return render(request, 'viewer/access.html', context)
 
@@ -112,6 +799,31 @@ def confirm_access(request):
 
     This page is a redirection from the authorization request page.
     '''
-    if dropbox.conclude_access(request.GET):
+    redirect = request.build_absolute_uri(reverse('confirm'))
+    try:
+        granted = registry.conclude_access(request.session, redirect,
+                request.GET)
+    except (DropboxUnavailable,) + TRANSIENT_ERRORS as e:
+        return _unavailable(e)
+    if granted:
         return HttpResponseRedirect(reverse('index'))
     return server_error(request)
+
+# ----------------------------------------------------------------------------
+def metrics(request):
+    '''Display the counters of this process, for Prometheus.
+
+    They include the calls made to Dropbox, with their latency, retries
+    and bytes transferred, by endpoint, and the requests handled, by view.
+    Each process has its own counters. Disabled unless
+    settings.VIEWER_METRICS is True, and then only served to the addresses
+    in settings.INTERNAL_IPS and to staff users.
+    '''
+    if not settings.VIEWER_METRICS:
+        raise Http404()
+    user = getattr(request, 'user', None)
+    if request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS and \
+            not (user is not None and user.is_staff):
+        raise Http404()
+    return HttpResponse(process_metrics.render(),
+            content_type='text/plain; version=0.0.4; charset=utf-8')
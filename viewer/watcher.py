@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import queue
+from threading import Lock, Thread
+
+from dropbox.exceptions import ApiError, AuthError
+
+from .aio import AsyncDropbox, AsyncDropboxWrapper, get_http_client
+from .scheduler import TRANSIENT_ERRORS, CallScheduler, DropboxUnavailable
+
+logger = logging.getLogger(__name__)
+
+# The seconds Dropbox holds a longpoll without changes
+LONGPOLL_TIMEOUT = 30
+# The longest wait after failures, before watching a folder again
+MAX_BACKOFF = 60
+
+
+# ----------------------------------------------------------------------------
+class Subscription:
+    '''The changes of a watched folder, pushed to a single client.
+
+    Events are (kind, data) tuples: ('changes', list of Dropbox metadata,
+    including DeletedMetadata), or ('reset', None) when the folder could
+    not be followed and must be listed again.
+
+    Parameters:
+    key  : the folder's listing key
+    path : the folder's Dropbox path
+    loop : the event loop of an async client, which reads the events with
+           aget(); sync clients use get()
+    '''
+
+    # ........................................................................
+    def __init__(self, key, path, loop=None):
+        self.key = key
+        self.path = path
+        self._loop = loop
+        self._queue = asyncio.Queue() if loop is not None else queue.Queue()
+
+    # ........................................................................
+    def put(self, event):
+        '''Push an event, from any thread.'''
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+        else:
+            self._queue.put(event)
+
+    # ........................................................................
+    def get(self, timeout):
+        '''Return the next event, or None after timeout seconds.'''
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    # ........................................................................
+    async def aget(self, timeout):
+        '''Return the next event, or None after timeout seconds.'''
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+# ----------------------------------------------------------------------------
+class _Watch:
+    '''A watched folder: its subscriptions, and the task that watches it.
+
+    While current is True, the folder's cached listing is kept up to date.
+    '''
+
+    # ........................................................................
+    def __init__(self, key, path):
+        self.key = key
+        self.path = path
+        self.subscriptions = set()
+        self.future = None
+        self.current = False
+
+
+# ----------------------------------------------------------------------------
+class FolderWatcher:
+    '''Push the changes made to folders to the clients watching them.
+
+    Each watched folder has a single longpoll, shared by all the clients
+    watching it. Longpolls are run by a background thread, with its own
+    event loop, so any number of folders are watched by that one thread.
+    When Dropbox reports changes, they are listed from the folder's cursor,
+    applied to the cached listing, so that reloading the folder needs no
+    API call, and pushed to each Subscription. A folder is no longer
+    watched once its last subscription is closed.
+    '''
+
+    # ........................................................................
+    def __init__(self):
+        self._watches = {}
+        self._lock = Lock()
+        self._loop = None
+
+    # ........................................................................
+    def subscribe(self, dropbox, path, loop=None):
+        '''Start receiving the changes of a folder.
+
+        Return a Subscription, which must be given to unsubscribe() when
+        it is no longer read.
+
+        Parameters:
+        dropbox : the DropboxWrapper of a connected account
+        path    : the folder's Dropbox path
+        loop    : the event loop of an async client; see Subscription
+        '''
+        key = dropbox._listing_key(path)
+        subscription = Subscription(key, path, loop)
+        with self._lock:
+            watch = self._watches.get(key)
+            if watch is None:
+                watch = self._watches[key] = _Watch(key, path)
+                watch.future = asyncio.run_coroutine_threadsafe(
+                        self._watch(dropbox, watch), self._get_loop())
+            watch.subscriptions.add(subscription)
+        return subscription
+
+    # ........................................................................
+    def unsubscribe(self, subscription):
+        '''Stop receiving the changes of a folder.'''
+        with self._lock:
+            watch = self._watches.get(subscription.key)
+            if watch is None or subscription not in watch.subscriptions:
+                # E.g., the watch failed and was dropped
+                return
+            watch.subscriptions.discard(subscription)
+            if not watch.subscriptions:
+                del self._watches[subscription.key]
+                watch.future.cancel()
+
+    # ........................................................................
+    def watching(self, key):
+        '''Whether the cached listing with a key is kept current by the
+        watcher.'''
+        watch = self._watches.get(key)
+        return watch is not None and watch.current
+
+    # ........................................................................
+    def _get_loop(self):
+        '''Return the loop of the watcher's thread, started if needed; the
+        lock must be held.'''
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            Thread(target=self._loop.run_forever, daemon=True,
+                   name='folder-watcher').start()
+        return self._loop
+
+    # ........................................................................
+    def _publish(self, watch, event):
+        with self._lock:
+            subscriptions = list(watch.subscriptions)
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    # ........................................................................
+    async def _watch(self, dropbox, watch):
+        '''Follow the changes of a folder, until cancelled.'''
+        client = AsyncDropboxWrapper(dropbox)
+        # Longpolls only wait for Dropbox, so they are neither paced nor
+        # counted by the circuit breaker; failures are retried below
+        notify = AsyncDropbox(dropbox.access_token, get_http_client(),
+                CallScheduler(retries=0))
+        cursor = None
+        failures = 0
+        while True:
+            try:
+                if cursor is None:
+                    cursor = await self._cursor(client, notify, watch.path)
+                    watch.current = dropbox.listings is not None
+                result = await notify.files_list_folder_longpoll(cursor,
+                        LONGPOLL_TIMEOUT)
+                if result.changes:
+                    pages = [page async for page in
+                             client.list_pages(watch.path, cursor)]
+                    cursor = pages[-1].cursor
+                    await self._apply(client, watch.key, pages)
+                    changes = [metadata for page in pages
+                               for metadata in page.entries]
+                    if changes:
+                        self._publish(watch, ('changes', changes))
+                failures = 0
+                if result.backoff:
+                    await asyncio.sleep(result.backoff)
+            except AuthError:
+                self._drop(watch)
+                return
+            except ApiError as e:
+                # E.g., the cursor was reset, or the folder was removed
+                logger.info('Watching %s failed: %r', watch.path, e)
+                watch.current = False
+                await client._expire_listing(watch.path)
+                self._publish(watch, ('reset', None))
+                cursor = None
+                failures += 1
+            except (DropboxUnavailable,) + TRANSIENT_ERRORS as e:
+                logger.info('Watching %s failed: %r', watch.path, e)
+                watch.current = False
+                failures += 1
+            except Exception:
+                logger.exception('Watching %s failed', watch.path)
+                self._drop(watch)
+                return
+            if failures:
+                await asyncio.sleep(min(MAX_BACKOFF, 2 ** failures))
+
+    # ........................................................................
+    def _drop(self, watch):
+        '''Stop watching a folder that cannot be followed; its clients are
+        told to reload, which watches it again from scratch.'''
+        watch.current = False
+        with self._lock:
+            if self._watches.get(watch.key) is watch:
+                del self._watches[watch.key]
+        self._publish(watch, ('reset', None))
+
+    # ........................................................................
+    async def _cursor(self, client, notify, path):
+        '''Return the cursor from which the changes of a folder are
+        followed: that of its cached listing, so no change is missed.'''
+        if client.dropbox.listings is None:
+            return (await notify.files_list_folder_get_latest_cursor(
+                    client._full_path(path))).cursor
+        return (await client._folder_listing(path)).cursor
+
+    # ........................................................................
+    async def _apply(self, client, key, pages):
+        '''Apply changes to the cached listing of a folder.'''
+        dropbox = client.dropbox
+        if dropbox.index is not None:
+            dropbox.index.expire()
+        if dropbox.listings is None:
+            return
+        listing = await client._get_listing(key)
+        if listing is not None:
+            await client._set_listing(key, listing.apply(pages))
+
+
+# The watcher of all the accounts served by this process
+watcher = FolderWatcher()
@@ -1,7 +1,48 @@
-from dropbox.files import FolderMetadata
-from dropbox.oauth import DropboxOAuth2Flow
+import logging
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime
+from hashlib import sha1
+from heapq import nsmallest
+from threading import Lock
 
-from .dropbox import DropBoxStorage
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from dropbox import create_session
+from dropbox.exceptions import ApiError, AuthError
+from dropbox.files import DeletedMetadata, FolderMetadata, SearchOptions
+from dropbox.oauth import (
+    BadRequestException, BadStateException, CsrfException, DropboxOAuth2Flow,
+    NotApprovedException, ProviderException,
+)
+from requests.exceptions import HTTPError
+
+from .dropbox import DropBoxStorage, setting
+from .index import AccountIndex
+from .jobs import JobList
+from .thumbnails import Thumbnailer, has_thumbnail
+from .zipstream import stream_zip
+
+_DEFAULT_LISTING_CACHE = 'viewer.wrapper.MemoryListingCache'
+_DEFAULT_LISTING_TTL = 10
+_DEFAULT_POOL_SIZE = 16
+_DEFAULT_IDLE_TIMEOUT = 600
+_DEFAULT_ZIP_MODE = 'stream'
+_DEFAULT_ZIP_WORKERS = 4
+_DEFAULT_TREE_INDEX = False
+_DEFAULT_THUMBNAIL_SIZE = 'w64h64'
+_DEFAULT_DOWNLOAD_MODE = 'proxy'
+_DEFAULT_REDIRECT_MIN_SIZE = 0
+_DEFAULT_REDIRECT_EXTENSIONS = ()
+_DEFAULT_LINK_TTL = 4 * 60 * 60 - 10 * 60
+_MAX_LINKS = 4096
+
+# The operations of DropboxWrapper.start_job()
+BULK_OPERATIONS = ('copy', 'move', 'delete', 'create_folder')
+
+logger = logging.getLogger(__name__)
 
 # ----------------------------------------------------------------------------
 def human_readable(size):
@@ -28,26 +69,250 @@ def human_readable(size):
 class DropboxMetaFile:
     '''This class contains some information about a Dropbox file.
 
+    Only the values taken from the metadata are stored, in slots, since
+    folders may have many thousands of entries; the others are derived
+    from them when read.
+
     Attributes:
     path   : the file's absolute path in Dropbox
     url    : same as path, but without the initial '/'
     name   : the file's name
     is_dir : whether the file is a directory
-    date   : the server's date when the file was last modified
-    size   : the file's size as a human readable string
+    date   : the server's date when the file was last modified, or None
+             for folders
+    bytes  : the file's size in bytes; for folders, the size of all files
+             inside it, if known (see DropboxWrapper.add_folder_sizes())
+    size   : the same size as a human readable string, or None
+    count  : the number of files inside a folder, if known
+    rev    : the file's revision, or None for folders
+    thumbnail : whether Dropbox can make a thumbnail of the file
     '''
 
+    __slots__ = ('path', 'name', 'is_dir', 'date', 'bytes', 'count', 'rev')
+
     # ........................................................................
     def __init__(self, metadata):
         self.path = metadata.path_display
-        self.url = self.path[1:]
         self.name = metadata.name
+        self.count = None
         if isinstance(metadata, FolderMetadata):
             self.is_dir = True
+            self.date = None
+            self.bytes = None
+            self.rev = None
         else:
             self.is_dir = False
             self.date = metadata.server_modified
-            self.size = human_readable(metadata.size)
+            self.bytes = metadata.size
+            self.rev = metadata.rev
+
+    # ........................................................................
+    @property
+    def url(self):
+        return self.path[1:]
+
+    # ........................................................................
+    @property
+    def size(self):
+        return human_readable(self.bytes) if self.bytes is not None else None
+
+    # ........................................................................
+    @property
+    def thumbnail(self):
+        return not self.is_dir and has_thumbnail(self.name, self.bytes)
+
+    # ........................................................................
+    @staticmethod
+    def sort_key(metadata):
+        '''Key that sorts the metadata of folders first, then by
+        case-insensitive name.'''
+        return (not isinstance(metadata, FolderMetadata), metadata.name.lower())
+
+
+# ----------------------------------------------------------------------------
+class DropboxSearchMatch:
+    '''A file or folder found by DropboxWrapper.search().
+
+    Attributes:
+    path   : the entry's absolute path in Dropbox
+    url    : same as path, but without the initial '/'
+    name   : the entry's name
+    parent : the URL of the folder that contains the entry
+    is_dir : whether the entry is a directory
+    '''
+
+    # ........................................................................
+    def __init__(self, path, is_dir):
+        self.path = path
+        self.url = path[1:]
+        self.parent, _, self.name = self.url.rpartition('/')
+        self.is_dir = is_dir
+
+
+# ----------------------------------------------------------------------------
+class FolderListing:
+    '''The entries of a Dropbox folder, together with its listing cursor.
+
+    Listings are never modified once stored in a cache; applying changes
+    returns a new listing, so concurrent readers are safe.
+
+    Attributes:
+    entries : dict of Dropbox metadata, keyed by lower-case path
+    cursor  : the cursor that lists the changes made after this listing
+    checked : the time when the listing was last brought up to date
+    version : a digest of the names and revisions of the entries, which
+              changes whenever any of them does
+    '''
+
+    # Listings stored before versions existed
+    version = None
+
+    # ........................................................................
+    def __init__(self, entries=None, cursor=None, version=None):
+        self.entries = {} if entries is None else entries
+        self.cursor = cursor
+        self.checked = time.time()
+        self.version = version or self._digest(self.entries)
+
+    # ........................................................................
+    @staticmethod
+    def _digest(entries):
+        '''Return the version of a dict of entries.'''
+        digest = sha1()
+        for key in sorted(entries):
+            metadata = entries[key]
+            digest.update(f"{key}\0{metadata.name}\0"
+                          f"{getattr(metadata, 'rev', '')}\n".encode())
+        return digest.hexdigest()
+
+    # ........................................................................
+    def apply(self, results):
+        '''Return a new listing with the changes from listing results.
+
+        Parameter:
+        results : iterable of ListFolderResult, from files_list_folder or
+                  files_list_folder_continue
+        '''
+        entries = self.entries
+        cursor = self.cursor
+        copied = False
+        for result in results:
+            if result.entries and not copied:
+                entries = dict(entries)
+                copied = True
+            for metadata in result.entries:
+                if isinstance(metadata, DeletedMetadata):
+                    entries.pop(metadata.path_lower, None)
+                else:
+                    entries[metadata.path_lower] = metadata
+            cursor = result.cursor
+        return FolderListing(entries, cursor, None if copied else self.version)
+
+
+# ----------------------------------------------------------------------------
+class ListingCache:
+    '''Base class for the stores of FolderListing objects.
+
+    The store is chosen by settings.DROPBOX_LISTING_CACHE, the dotted path
+    of a subclass, and built with settings.DROPBOX_LISTING_CACHE_OPTIONS as
+    keyword arguments. Setting DROPBOX_LISTING_CACHE to None disables it.
+    '''
+
+    # ........................................................................
+    def get(self, key):
+        '''Return the listing stored under key, or None.'''
+        raise NotImplementedError
+
+    # ........................................................................
+    def set(self, key, listing):
+        '''Store a listing under key.'''
+        raise NotImplementedError
+
+    # ........................................................................
+    def delete(self, key):
+        '''Forget the listing stored under key, if any.'''
+        raise NotImplementedError
+
+
+# ----------------------------------------------------------------------------
+class MemoryListingCache(ListingCache):
+    '''Keep listings in the memory of the current process.
+
+    When the stored listings hold more than max_entries entries in all, the
+    least recently used ones are evicted. The last listing stored is always
+    kept, even if larger.
+    '''
+
+    # ........................................................................
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._listings = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    # ........................................................................
+    def get(self, key):
+        with self._lock:
+            listing = self._listings.get(key)
+            if listing is not None:
+                self._listings.move_to_end(key)
+            return listing
+
+    # ........................................................................
+    def set(self, key, listing):
+        with self._lock:
+            self._pop(key)
+            self._listings[key] = listing
+            self._size += len(listing.entries)
+            while self._size > self.max_entries and len(self._listings) > 1:
+                self._pop(next(iter(self._listings)))
+
+    # ........................................................................
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    # ........................................................................
+    def _pop(self, key):
+        '''Forget a listing; the lock must be held.'''
+        listing = self._listings.pop(key, None)
+        if listing is not None:
+            self._size -= len(listing.entries)
+
+
+# ----------------------------------------------------------------------------
+class DjangoListingCache(ListingCache):
+    '''Keep listings in one of the caches configured in settings.CACHES.
+
+    This allows listings to be shared among processes. The size limit and
+    eviction policy are those of the chosen cache (e.g., MAX_ENTRIES).
+    '''
+
+    # ........................................................................
+    def __init__(self, alias='default', timeout=None):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    # ........................................................................
+    def get(self, key):
+        return self.cache.get(key)
+
+    # ........................................................................
+    def set(self, key, listing):
+        self.cache.set(key, listing, self.timeout)
+
+    # ........................................................................
+    def delete(self, key):
+        self.cache.delete(key)
+
+
+# ----------------------------------------------------------------------------
+def load_listing_cache():
+    '''Create the ListingCache chosen in the settings, or return None.'''
+    path = setting('DROPBOX_LISTING_CACHE', _DEFAULT_LISTING_CACHE)
+    if path is None:
+        return None
+    return import_string(path)(**setting('DROPBOX_LISTING_CACHE_OPTIONS', {}))
 
 
 # ----------------------------------------------------------------------------
@@ -56,11 +321,84 @@ class DropboxWrapper():
 
     It uses Monthe's custom Storage class to access Dropbox files, but also
     explores other methods from Dropbox API.
+
+    Folder listings are kept in a ListingCache. A cached listing is reused
+    for settings.DROPBOX_LISTING_TTL seconds; after that, only the changes
+    since it was made are requested, using its cursor. Listings of the
+    folders followed by the watcher (see watcher.FolderWatcher) are kept
+    current by it, so they are always reused.
+
+    Access to the account is verified with Dropbox only once per token (see
+    has_access()).
+
+    Each wrapper gives access to a single account. Use DropboxRegistry to
+    obtain the wrapper of the account connected to a user's session.
+
+    Folders are downloaded as ZIP archives according to
+    settings.DROPBOX_ZIP_MODE: 'stream' builds the archive here, fetching
+    settings.DROPBOX_ZIP_WORKERS files at once, while 'dropbox' relays the
+    archive made by Dropbox (limited to 20 GB and 10,000 files).
+
+    With settings.DROPBOX_TREE_INDEX, the size of every folder, and the
+    names used by search(), are kept in an AccountIndex, updated in the
+    background. Building it lists the whole account, so it is off by
+    default.
+
+    Thumbnails of images, of settings.DROPBOX_THUMBNAIL_SIZE, are fetched
+    in batches by a Thumbnailer.
+
+    With settings.DROPBOX_DOWNLOAD_MODE set to 'redirect', files are
+    downloaded straight from Dropbox, through temporary links, rather than
+    relayed by the app (the default 'proxy' mode); see redirects().
+
+    Many entries are copied, moved or deleted, or many folders created, by
+    the batch routes of Dropbox, a thousand at a time. Such bulk jobs run
+    in the background; see start_job().
     '''
 
     # ........................................................................
-    def __init__(self, app_key):
+    def __init__(self, app_key, listings=None, http_session=None,
+                 watcher=None):
         self.app_key = app_key
+        self.storage = None
+        self.account = None
+        self.access_token = None
+        self.access_expires = None
+        self.listings = listings
+        self.listing_ttl = setting('DROPBOX_LISTING_TTL', _DEFAULT_LISTING_TTL)
+        self.watcher = watcher
+        self.http_session = http_session
+        self.zip_mode = setting('DROPBOX_ZIP_MODE', _DEFAULT_ZIP_MODE)
+        self.zip_workers = setting('DROPBOX_ZIP_WORKERS', _DEFAULT_ZIP_WORKERS)
+        self.tree_index = setting('DROPBOX_TREE_INDEX', _DEFAULT_TREE_INDEX)
+        self.index = None
+        self.thumbnail_size = setting('DROPBOX_THUMBNAIL_SIZE',
+                _DEFAULT_THUMBNAIL_SIZE)
+        self.thumbnails = None
+        self.download_mode = setting('DROPBOX_DOWNLOAD_MODE',
+                _DEFAULT_DOWNLOAD_MODE)
+        self.redirect_min_size = setting('DROPBOX_REDIRECT_MIN_SIZE',
+                _DEFAULT_REDIRECT_MIN_SIZE)
+        self.redirect_extensions = {extension.lower() for extension in
+                setting('DROPBOX_REDIRECT_EXTENSIONS',
+                        _DEFAULT_REDIRECT_EXTENSIONS)}
+        self.link_ttl = setting('DROPBOX_TEMPORARY_LINK_TTL', _DEFAULT_LINK_TTL)
+        self._links = OrderedDict()
+        self._links_lock = Lock()
+        self._removed = OrderedDict()
+        self._removed_lock = Lock()
+        self.jobs = JobList()
+
+    # ........................................................................
+    def _auth_flow(self, session, redirect):
+        '''Create the object that runs the OAuth2 authorization flow.'''
+        return DropboxOAuth2Flow(
+                self.app_key,
+                redirect,
+                session,
+                "dropbox-auth-csrf-token",
+                use_pkce=True,
+                token_access_type='online')
 
     # ........................................................................
     def request_access(self, session, redirect):
@@ -74,44 +412,223 @@ class DropboxWrapper():
         redirect : URL that will be redirected after authorization is granted;
                    validation data will be passed by GET
         '''
-        self.auth = DropboxOAuth2Flow(
-                self.app_key,
-                redirect,
-                session,
-                "dropbox-auth-csrf-token",
-                use_pkce=True,
-                token_access_type='online')
-        return self.auth.start()
+        auth = self._auth_flow(session, redirect)
+        url = auth.start()
+        # The flow is concluded by another request, maybe in another thread
+        session["dropbox-auth-code-verifier"] = auth.code_verifier
+        return url
 
     # ........................................................................
-    def conclude_access(self, query):
+    def conclude_access(self, session, redirect, query):
         '''Conclude authorization process, granting access to Dropbox.
 
-        Return True if the access was granted.
+        Return True if the access was granted. Failures to reach Dropbox
+        are raised, since a later attempt may succeed.
         
-        Parameter:
-        query : dict containing the GET information sent to a redirected URL
+        Parameters:
+        session  : dict containing the current session information
+        redirect : the same redirect URL given to request_access()
+        query    : dict containing the GET information sent to a redirected URL
         '''
         try:
-            result = self.auth.finish(query)
-            self.storage = DropBoxStorage(
-                    oauth2_access_token=result.access_token)
+            auth = self._auth_flow(session, redirect)
+            auth.code_verifier = session.pop("dropbox-auth-code-verifier")
+            result = auth.finish(query)
+            self.connect(result.access_token, result.expires_at)
             return self.has_access()
-        except Exception as e:
-            print(e)
+        except (BadRequestException, BadStateException, CsrfException,
+                NotApprovedException, ProviderException, HTTPError, KeyError) as e:
+            logger.warning('Dropbox authorization failed: %r', e)
             return False
 
+    # ........................................................................
+    def connect(self, access_token, expires=None):
+        '''Use an access token obtained by an authorization flow.
+
+        Parameters:
+        access_token : the OAuth2 access token
+        expires      : the token's expiration, as a UTC datetime, or None
+        '''
+        self.storage = DropBoxStorage(oauth2_access_token=access_token,
+                session=self.http_session)
+        self.account = None
+        self.access_token = access_token
+        self.access_expires = expires
+        self.index = None
+        if self.tree_index:
+            self.index = AccountIndex(self.storage, self.listing_ttl)
+        self.thumbnails = Thumbnailer(self.storage)
+
     # ........................................................................
     def has_access(self):
-        '''Whether there is access to a Dropbox account or not.'''
+        '''Whether there is access to a Dropbox account or not.
+
+        The account is fetched from Dropbox only the first time; afterwards
+        the answer comes from the cached account, without any API call,
+        until the token expires or forget_access() is called. Requests that
+        fail with dropbox.exceptions.AuthError should call forget_access(),
+        since the token was revoked. Failures to reach Dropbox are raised.
+        '''
+        if self.storage is None:
+            return False
+        if self.account is not None:
+            return self.access_expires is None or \
+                    datetime.utcnow() < self.access_expires
         try:
-            self.storage.client.users_get_current_account() 
+            self.account = self.storage.client.users_get_current_account()
+            self.thumbnails.account = self.account.account_id
             return True
-        except Exception:
+        except AuthError:
+            return False
+
+    # ........................................................................
+    def forget_access(self):
+        '''Discard the current access, requiring a new authorization.'''
+        self.storage = None
+        self.account = None
+        self.access_token = None
+        self.access_expires = None
+        self.index = None
+        self.thumbnails = None
+
+    # ........................................................................
+    def iter_folder(self, path):
+        '''Yield a DropboxMetaFile for each entry in the given path.
+
+        Entries come in Dropbox's order, as each page of the listing
+        arrives; further pages are only requested when needed.
+
+        Parameter:
+        path : a Dropbox absolute path
+        '''
+        for metadata in self._scan_folder(path):
+            yield DropboxMetaFile(metadata)
+
+    # ........................................................................
+    def _listing_key(self, path):
+        '''The key of a folder's listing in the cache, unique per account.'''
+        folder = f"{self.account.account_id}:{path.strip('/').lower()}"
+        return 'dropbox-listing:' + sha1(folder.encode()).hexdigest()
+
+    # ........................................................................
+    def _scan_folder(self, path):
+        '''Return an iterable with the metadata of the entries in a folder.
+
+        Without a listing cache, the entries are streamed from Dropbox.
+        Otherwise, they come from the cached listing; see _folder_listing().
+        '''
+        if self.listings is None:
+            return self.storage.scandir(path)
+        return self._folder_listing(path).entries.values()
+
+    # ........................................................................
+    def _folder_listing(self, path):
+        '''Return the FolderListing of a folder, from the listing cache.
+
+        The cached listing is updated with the recent changes if it is older
+        than the listing TTL and not kept current by the watcher, or made if
+        it is missing.
+        '''
+        key = self._listing_key(path)
+        listing = self.listings.get(key)
+        if listing is not None and self.removed_since(path, listing.checked):
+            listing = None
+        if listing is not None and self.is_current(listing, key):
+            return listing
+        if listing is not None:
+            try:
+                listing = listing.apply(
+                        self.storage.list_pages(path, listing.cursor))
+            except ApiError as e:
+                # Dropbox may reset a cursor, requiring a new listing
+                if not e.error.is_reset():
+                    raise
+                listing = None
+        if listing is None:
+            listing = FolderListing().apply(self.storage.list_pages(path))
+        self.listings.set(key, listing)
+        return listing
+
+    # ........................................................................
+    def is_current(self, listing, key):
+        '''Whether a cached listing can be reused: it is younger than the
+        listing TTL, or kept current by the watcher, and it was not expired
+        by a change made here (see _expire_listing()).'''
+        if not listing.checked:
             return False
+        return time.time() - listing.checked < self.listing_ttl or \
+                self.watcher is not None and self.watcher.watching(key)
+
+    # ........................................................................
+    def removed_since(self, path, checked):
+        '''Whether a folder, or one above it, was moved or deleted here
+        after the given time, so that its cached listing must be made again.
+
+        The removed paths are only kept for the listing TTL, since older
+        listings are checked for changes anyway.
+        '''
+        path = path.rstrip('/').lower()
+        with self._removed_lock:
+            while path:
+                removed = self._removed.get(path)
+                if removed is not None and removed >= checked:
+                    return True
+                path = path.rpartition('/')[0]
+        return False
 
     # ........................................................................
-    def listdir(self, path):
+    def _forget_folders(self, paths):
+        '''Record that entries were moved or deleted, so that the cached
+        listings of the folders inside them are not used again.'''
+        now = time.time()
+        with self._removed_lock:
+            for path in paths:
+                key = path.rstrip('/').lower()
+                self._removed[key] = now
+                self._removed.move_to_end(key)
+            while self._removed and \
+                    next(iter(self._removed.values())) < now - self.listing_ttl:
+                self._removed.popitem(last=False)
+
+    # ........................................................................
+    def folder_version(self, path):
+        '''Return a string that changes whenever the listing of a folder,
+        as displayed by listdir(), changes, or None if it is unknown.
+
+        It combines the version of the folder's listing with that of the
+        folder sizes in the account index. Without a listing cache, there
+        is no version.
+
+        Parameter:
+        path : a Dropbox absolute path
+        '''
+        if self.listings is None:
+            return None
+        version = self._folder_listing(path).version
+        if version is None:
+            return None
+        if self.index is not None:
+            self.index.refresh()
+            version += f'.{self.index.version}'
+        return version
+
+    # ........................................................................
+    def _expire_listing(self, path):
+        '''Make the next listing of a folder check for changes.'''
+        if self.index is not None:
+            self.index.expire()
+        if self.listings is None:
+            return
+        key = self._listing_key(path)
+        listing = self.listings.get(key)
+        if listing is not None:
+            listing = FolderListing(listing.entries, listing.cursor,
+                    listing.version)
+            listing.checked = 0
+            self.listings.set(key, listing)
+
+    # ........................................................................
+    def listdir(self, path, offset=0, limit=None):
         '''List all files and directories in the given path.
         
         It is similar to Storage.listdir(), but instead of returning two
@@ -120,21 +637,289 @@ class DropboxWrapper():
         order, and folders are places first. This method is faster than 
         calling the API many times to obtain metadata for each file retrieved.
 
+        When a limit is given, only the entries from offset to offset + limit
+        are returned, and no more than that many entries are kept in memory
+        while the listing is read. Only the entries returned are made into
+        DropboxMetaFile objects.
+
+        Parameters:
+        path   : a Dropbox absolute path
+        offset : the number of sorted entries to skip
+        limit  : the maximum number of entries to return
+        '''
+        entries = self._scan_folder(path)
+        key = DropboxMetaFile.sort_key
+        if limit is None:
+            entries = sorted(entries, key=key)[offset:]
+        else:
+            entries = nsmallest(offset + limit, entries, key=key)[offset:]
+        entries = [DropboxMetaFile(metadata) for metadata in entries]
+        self.check_links(entries)
+        return self.add_folder_sizes(entries)
+
+    # ........................................................................
+    def check_links(self, entries):
+        '''Discard the cached links of files changed since they were made.
+
+        Parameter:
+        entries : list of DropboxMetaFile, from a recent listing
+        '''
+        if not self._links:
+            return
+        with self._links_lock:
+            for entry in entries:
+                if entry.is_dir:
+                    continue
+                cached = self._links.get(entry.url.lower())
+                if cached is not None and cached[1].rev != entry.rev:
+                    del self._links[entry.url.lower()]
+
+    # ........................................................................
+    def add_folder_sizes(self, entries):
+        '''Set the size and file count of the folders in a list of
+        DropboxMetaFile, and return the list.
+
+        The sizes come from the account index, without any API call. The
+        index is built in the background, so sizes are unknown at first.
+        '''
+        if self.index is None:
+            return entries
+        self.index.refresh()
+        sizes = self.index.sizes
+        if sizes is None:
+            return entries
+        for entry in entries:
+            if entry.is_dir:
+                totals = sizes.get(entry.path)
+                if totals is not None:
+                    entry.bytes, entry.count = totals
+        return entries
+
+    # ........................................................................
+    def search(self, query, limit=100):
+        '''Find the files and folders whose names contain a string.
+
+        Return a list of DropboxSearchMatch. Names are looked up in the
+        account index, without any API call. Until the index is built, or if
+        it is disabled, Dropbox's own search is used instead, which matches
+        whole words and name prefixes rather than any substring.
+
+        Parameters:
+        query : the string searched, ignoring case
+        limit : the maximum number of matches returned
+        '''
+        if self.index is not None:
+            self.index.refresh()
+            names = self.index.names
+            if names is not None:
+                return [DropboxSearchMatch(path.rstrip('/'), path.endswith('/'))
+                        for path in names.search(query, limit)]
+        root = self.storage._full_path('')
+        result = self.storage.client.files_search_v2(query, SearchOptions(
+                path=None if root == '/' else root,
+                max_results=max(1, min(limit, 1000)),
+                filename_only=True))
+        matches = []
+        for match in result.matches:
+            metadata = match.metadata.get_metadata()
+            matches.append(DropboxSearchMatch(metadata.path_display,
+                    isinstance(metadata, FolderMetadata)))
+        return matches
+
+    # ........................................................................
+    def get_file(self, name, byte_range=None, metadata=None):
+        '''Obtain a File object after its name.
+
+        If the file's current metadata is given, the file is read through
+        the local content cache (see caches_content()).
+
+        Parameters:
+        name       : the file's path in Dropbox
+        byte_range : optional (start, end) tuple, both inclusive, to read
+                     only part of the file; end may be None
+        metadata   : optional metadata of the file, from get_metadata()
+        '''
+        if metadata is not None:
+            return self.storage.open_cached(name, metadata, byte_range)
+        if byte_range is None:
+            return self.storage.open(name)
+        return self.storage.open_range(name, *byte_range)
+
+    # ........................................................................
+    def get_temporary_link(self, name):
+        '''Obtain the metadata of a file and a link to download it.
+
+        Dropbox links last four hours, so each one is reused for
+        settings.DROPBOX_TEMPORARY_LINK_TTL seconds, a little less than that,
+        without any API call. Return a (metadata, link) tuple.
+
+        Parameter:
+        name : the file's path in Dropbox
+        '''
+        cached = self._cached_link(name)
+        if cached is not None:
+            return cached
+        result = self.storage.client.files_get_temporary_link(
+                self.storage._full_path(name))
+        return self._store_link(name, result.metadata, result.link)
+
+    # ........................................................................
+    def _cached_link(self, name):
+        '''Return the cached (metadata, link) tuple of a file, or None.'''
+        key = name.strip('/').lower()
+        with self._links_lock:
+            cached = self._links.get(key)
+            if cached is None:
+                return None
+            expires, metadata, link = cached
+            if time.monotonic() >= expires:
+                del self._links[key]
+                return None
+            self._links.move_to_end(key)
+        return metadata, link
+
+    # ........................................................................
+    def _store_link(self, name, metadata, link):
+        '''Cache the temporary link of a file, and return it with its
+        metadata.'''
+        key = name.strip('/').lower()
+        with self._links_lock:
+            self._links[key] = (time.monotonic() + self.link_ttl, metadata,
+                                link)
+            self._links.move_to_end(key)
+            while len(self._links) > _MAX_LINKS:
+                self._links.popitem(last=False)
+        return metadata, link
+
+    # ........................................................................
+    def _forget_link(self, name):
+        '''Discard the cached link of a file that was replaced.'''
+        with self._links_lock:
+            self._links.pop(name.strip('/').lower(), None)
+
+    # ........................................................................
+    def redirects(self, name, metadata=None):
+        '''Whether a file should be downloaded through a temporary link.
+
+        In 'redirect' mode, files with one of the
+        settings.DROPBOX_REDIRECT_EXTENSIONS are always redirected, and
+        other files if they have at least settings.DROPBOX_REDIRECT_MIN_SIZE
+        bytes. Without metadata, the answer is True whenever the size must
+        be checked.
+
+        Parameters:
+        name     : the file's path in Dropbox
+        metadata : optional metadata of the file
+        '''
+        if self.download_mode != 'redirect':
+            return False
+        extension = name[name.rfind('.'):].lower() if '.' in name else ''
+        if extension in self.redirect_extensions:
+            return True
+        return metadata is None or metadata.size >= self.redirect_min_size
+
+    # ........................................................................
+    def caches_content(self):
+        '''Whether downloaded files are kept in a local content cache.'''
+        return self.storage.content_cache is not None
+
+    # ........................................................................
+    def get_metadata(self, name):
+        '''Obtain the Dropbox metadata of a file, without downloading it.'''
+        return self.storage.get_metadata(name)
+
+    # ........................................................................
+    def prefetch_thumbnails(self, entries):
+        '''Start fetching the thumbnails of the images in a list of
+        DropboxMetaFile, in batches, so that they are ready when asked.'''
+        revs = [entry.rev for entry in entries
+                if not entry.is_dir and entry.thumbnail]
+        if revs:
+            self.thumbnails.prefetch(revs, self.thumbnail_size)
+
+    # ........................................................................
+    def get_thumbnail(self, rev, size=None):
+        '''Obtain the JPEG thumbnail of an image, as bytes.
+
+        Parameters:
+        rev  : the image's revision
+        size : one of thumbnails.SIZES; by default, the thumbnail_size
+        '''
+        return self.thumbnails.get(rev, size or self.thumbnail_size)
+
+    # ........................................................................
+    def walk(self, path):
+        '''Yield a DropboxMetaFile for each entry in a folder and, after each
+        subfolder, for the entries inside it.
+
+        Parameter:
+        path : a Dropbox absolute path
+        '''
+        for entry in self.iter_folder(path):
+            yield entry
+            if entry.is_dir:
+                yield from self.walk(entry.path)
+
+    # ........................................................................
+    def zip_folder(self, path):
+        '''Return an iterator over the bytes of a ZIP archive of a folder.
+
+        The archive contains all files and subfolders, and it is produced
+        while the files are downloaded, so it is never held in memory.
+
         Parameter:
         path : a Dropbox absolute path
         '''
-        result = self.storage.client.files_list_folder(path)
-        files = list()
-        for metadata in result.entries:
-            files.append(DropboxMetaFile(metadata))
-        files.sort(key=lambda fi: fi.name.lower())
-        files.sort(key=lambda fi: -1 if fi.is_dir else 1)
-        return files
+        if self.zip_mode == 'dropbox':
+            metadata, response = self.storage.client.files_download_zip(path)
+            return self._relay(response)
+        return stream_zip(self._zip_entries(path))
 
     # ........................................................................
-    def get_file(self, name):
-        '''Obtain a File object after its name.'''
-        return self.storage.open(name)
+    def _relay(self, response):
+        '''Yield the body of a Dropbox response in chunks.'''
+        with closing(response):
+            yield from response.iter_content(self.storage.STREAM_CHUNK_SIZE)
+
+    # ........................................................................
+    def _zip_entries(self, path):
+        '''Yield the entries for stream_zip() with the contents of a folder.
+
+        Up to zip_workers downloads are started in advance, so the latency
+        of each one is hidden while the previous ones are read.
+        '''
+        start = len(path.rstrip('/')) + 1
+        pending = deque()
+        executor = ThreadPoolExecutor(self.zip_workers)
+        try:
+            for entry in self.walk(path):
+                name = entry.path[start:]
+                if entry.is_dir:
+                    pending.append((name + '/', None, None))
+                else:
+                    fd = self.storage.open(entry.path)
+                    pending.append((name, entry.date,
+                            executor.submit(fd.prefetch)))
+                while len(pending) > self.zip_workers:
+                    yield self._zip_entry(*pending.popleft())
+            while pending:
+                yield self._zip_entry(*pending.popleft())
+        finally:
+            # Drop the downloads started for an interrupted archive
+            futures = [future for name, date, future in pending if future]
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+            for future in futures:
+                if not future.cancelled() and future.exception() is None:
+                    future.result().close()
+
+    # ........................................................................
+    def _zip_entry(self, name, date, future):
+        '''Build a stream_zip() entry, waiting for its download to start.'''
+        if future is None:
+            return name, date, None
+        return name, date, future.result().chunks()
 
     # ........................................................................
     def upload_file(self, path, upfile):
@@ -147,8 +932,42 @@ class DropboxWrapper():
         '''
         name = ('/' if path == '' else ('/' + path + '/')) + upfile.name
         self.storage.save(name, upfile)
+        self._expire_listing(path)
+        self._forget_link(name)
         return name
 
+    # ........................................................................
+    def upload_files(self, path, upfiles, names=None):
+        '''Upload many File objects to Dropbox, committing them together.
+
+        Names may contain '/' in order to upload a whole folder hierarchy.
+        Files whose names are already in use are renamed. Return the list
+        of names given to the files on Dropbox.
+
+        Parameters:
+        path    : the folder's absolute path where the files will be stored
+        upfiles : the File objects to be uploaded
+        names   : the names of the files, relative to path; by default, the
+                  names of the File objects
+        '''
+        if names is None:
+            names = [upfile.name for upfile in upfiles]
+        prefix = '/' if path == '' else ('/' + path + '/')
+        saved = self.storage.save_batch(
+                [(prefix + name, upfile) for name, upfile in zip(names, upfiles)])
+
+        # Every folder between path and the new files may have changed
+        folders = {path.strip('/')}
+        for name in names:
+            parts = name.strip('/').split('/')[:-1]
+            for i in range(len(parts)):
+                folders.add('/'.join([path.strip('/')] + parts[:i + 1]).strip('/'))
+        for folder in folders:
+            self._expire_listing(folder)
+        for name in saved:
+            self._forget_link(name)
+        return saved
+
     # ........................................................................
     def create_folder(self, path, name):
         '''Create a folder in Dropbox.
@@ -162,4 +981,245 @@ class DropboxWrapper():
         '''
         name = ('/' if path == '' else ('/' + path + '/')) + name
         self.storage.client.files_create_folder(name)
+        self.storage.clear_stat(name)
+        self._expire_listing(path)
+
+    # ........................................................................
+    def copy(self, paths, destination, progress=None):
+        '''Copy many files or folders into a folder, with a call for every
+        DropBoxStorage.BATCH_SIZE of them.
+
+        Return a (metadata, error) pair for each path: the metadata of the
+        copy, or None and the reason why it failed.
+
+        Parameters:
+        paths       : the absolute paths of the entries
+        destination : the absolute path of the folder
+        progress    : a function called with the number of entries done
+        '''
+        results = self.storage.copy_batch(
+                self._relocations(paths, destination), progress)
+        self._expire_listing(destination)
+        return results
+
+    # ........................................................................
+    def move(self, paths, destination, progress=None):
+        '''Move many files or folders into a folder; see copy().'''
+        results = self.storage.move_batch(
+                self._relocations(paths, destination), progress)
+        self._expire_listing(destination)
+        self._forget_entries(paths)
+        return results
+
+    # ........................................................................
+    def delete(self, paths, progress=None):
+        '''Delete many files or folders; see copy() for the results.'''
+        results = self.storage.delete_batch(paths, progress)
+        self._forget_entries(paths)
+        return results
+
+    # ........................................................................
+    def create_folders(self, paths, progress=None):
+        '''Create many folders, given their absolute paths; see copy() for
+        the results.'''
+        results = self.storage.create_folder_batch(paths, progress)
+        for folder in {path.rpartition('/')[0] for path in paths}:
+            self._expire_listing(folder)
+        return results
+
+    # ........................................................................
+    def _relocations(self, paths, destination):
+        '''The (path, new path) pairs that put entries into a folder.'''
+        folder = destination.rstrip('/')
+        return [(path, folder + '/' + path.rstrip('/').rpartition('/')[2])
+                for path in paths]
+
+    # ........................................................................
+    def _forget_entries(self, paths):
+        '''Expire the folders of entries that were removed, the listings
+        of the removed folders and of any folder inside them, and their
+        links.'''
+        self._forget_folders(paths)
+        for folder in {path.rpartition('/')[0] for path in paths}:
+            self._expire_listing(folder)
+        for path in paths:
+            self._forget_link(path)
+
+    # ........................................................................
+    def start_job(self, operation, paths, destination=None):
+        '''Start a bulk operation on many entries in the background, and
+        return its BulkJob; the job can be found later by its id, with
+        get_job().
+
+        Parameters:
+        operation   : one of BULK_OPERATIONS: 'copy' or 'move' the entries
+                      into destination, 'delete' them, or 'create_folder'
+                      with each of the paths
+        paths       : the absolute paths of the entries, or of the folders
+        destination : the absolute path of the folder, to copy or move
+        '''
+        if operation == 'copy':
+            run = lambda progress: self.copy(paths, destination, progress)
+        elif operation == 'move':
+            run = lambda progress: self.move(paths, destination, progress)
+        elif operation == 'delete':
+            run = lambda progress: self.delete(paths, progress)
+        elif operation == 'create_folder':
+            run = lambda progress: self.create_folders(paths, progress)
+        else:
+            raise ValueError(f'Unknown operation: {operation}')
+        return self.jobs.start(operation, paths, run)
+
+    # ........................................................................
+    def get_job(self, job_id):
+        '''Return the BulkJob with an id, or None if it is unknown.'''
+        return self.jobs.get(job_id)
+
+
+
+# ----------------------------------------------------------------------------
+class DropboxRegistry:
+    '''Thread-safe registry of DropboxWrapper objects, one per account.
+
+    The account connected by each user is recorded in their Django session,
+    along with its access token, so that any thread or process can find (or
+    rebuild) the wrapper for a request. All the wrappers share the listing
+    cache, a single pooled HTTP session, which keeps connections to
+    Dropbox alive among requests and users, and the watcher of folders, if
+    given.
+
+    The pool size is given by settings.DROPBOX_POOL_SIZE. Wrappers that are
+    not used for settings.DROPBOX_IDLE_TIMEOUT seconds are evicted, unless
+    their account has bulk jobs running. The JobList of each account is
+    kept here, and given to all its wrappers, so that jobs can still be
+    followed after the access of a session was forgotten. So are the
+    AccountIndex objects of the last MAX_INDEXES accounts used, which are
+    expensive to build.
+    '''
+
+    SESSION_KEY = 'dropbox-access'
+    MAX_INDEXES = 16
+
+    # ........................................................................
+    def __init__(self, app_key, watcher=None):
+        self.app_key = app_key
+        self.watcher = watcher
+        self.listings = load_listing_cache()
+        self.http_session = create_session(max_connections=setting(
+                'DROPBOX_POOL_SIZE', _DEFAULT_POOL_SIZE))
+        self.idle_timeout = setting('DROPBOX_IDLE_TIMEOUT',
+                _DEFAULT_IDLE_TIMEOUT)
+        self._wrappers = {}
+        self._last_used = {}
+        self._jobs = {}
+        self._indexes = OrderedDict()
+        self._lock = Lock()
+
+    # ........................................................................
+    def new(self):
+        '''Create a wrapper that is not yet connected to an account.'''
+        return DropboxWrapper(self.app_key, self.listings, self.http_session,
+                self.watcher)
+
+    # ........................................................................
+    def request_access(self, session, redirect):
+        '''Start authorization request; see DropboxWrapper.request_access.'''
+        return self.new().request_access(session, redirect)
+
+    # ........................................................................
+    def conclude_access(self, session, redirect, query):
+        '''Conclude authorization process, and register the new access.
+
+        Return True if the access was granted; see
+        DropboxWrapper.conclude_access.
+        '''
+        dropbox = self.new()
+        if not dropbox.conclude_access(session, redirect, query):
+            return False
+        self.register(session, dropbox)
+        return True
+
+    # ........................................................................
+    def register(self, session, dropbox):
+        '''Make a connected wrapper the one used by a session.'''
+        expires = dropbox.access_expires
+        session[self.SESSION_KEY] = {
+            'account': dropbox.account.account_id,
+            'token': dropbox.access_token,
+            'expires': expires.isoformat() if expires else None,
+        }
+        with self._lock:
+            self._wrappers[dropbox.account.account_id] = dropbox
+            self._last_used[dropbox.account.account_id] = time.monotonic()
+            self._adopt(dropbox.account.account_id, dropbox)
+
+    # ........................................................................
+    def get(self, session):
+        '''Return the wrapper used by a session, or None if not connected.'''
+        access = session.get(self.SESSION_KEY)
+        if access is None:
+            return None
+        account_id = access['account']
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            dropbox = self._wrappers.get(account_id)
+            if dropbox is None:
+                dropbox = self.new()
+                expires = access['expires']
+                dropbox.connect(access['token'],
+                        datetime.fromisoformat(expires) if expires else None)
+                self._adopt(account_id, dropbox)
+                self._wrappers[account_id] = dropbox
+            self._last_used[account_id] = now
+        return dropbox
+
+    # ........................................................................
+    def forget(self, session):
+        '''Discard the access used by a session.
+
+        The account's wrapper is only dropped from the registry, since other
+        requests may still be using it; it is left as it is. A wrapper with
+        another token, e.g. after a new authorization, is kept.
+        '''
+        access = session.pop(self.SESSION_KEY, None)
+        if access is None:
+            return
+        account_id = access['account']
+        with self._lock:
+            dropbox = self._wrappers.get(account_id)
+            if dropbox is not None and \
+                    dropbox.access_token == access['token']:
+                del self._wrappers[account_id]
+                self._last_used.pop(account_id, None)
 
+    # ........................................................................
+    def _adopt(self, account_id, dropbox):
+        '''Give a wrapper the JobList and the AccountIndex of its account;
+        the lock must be held.'''
+        dropbox.jobs = self._jobs.setdefault(account_id, dropbox.jobs)
+        if dropbox.index is None:
+            return
+        index = self._indexes.get(account_id)
+        if index is None:
+            self._indexes[account_id] = dropbox.index
+            while len(self._indexes) > self.MAX_INDEXES:
+                self._indexes.popitem(last=False)
+        else:
+            # The index follows the latest access to the account
+            index.storage = dropbox.storage
+            dropbox.index = index
+            self._indexes.move_to_end(account_id)
+
+    # ........................................................................
+    def _evict(self, now):
+        '''Drop the wrappers left idle for too long, and the jobs of the
+        accounts without a wrapper; the lock must be held.'''
+        for account_id, last_used in list(self._last_used.items()):
+            if now - last_used > self.idle_timeout and \
+                    not self._jobs[account_id].unfinished():
+                del self._last_used[account_id]
+                del self._wrappers[account_id]
+        for account_id, jobs in list(self._jobs.items()):
+            if account_id not in self._wrappers and not jobs.unfinished():
+                del self._jobs[account_id]
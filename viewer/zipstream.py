@@ -0,0 +1,61 @@
+import io
+import zipfile
+
+
+# ----------------------------------------------------------------------------
+class _ZipOutput(io.RawIOBase):
+    '''Unseekable file that keeps what is written until it is collected.'''
+
+    # ........................................................................
+    def __init__(self):
+        self._chunks = []
+
+    # ........................................................................
+    def writable(self):
+        return True
+
+    # ........................................................................
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    # ........................................................................
+    def collect(self):
+        '''Yield and forget everything written so far.'''
+        if self._chunks:
+            data = b''.join(self._chunks)
+            self._chunks.clear()
+            yield data
+
+
+# ----------------------------------------------------------------------------
+def stream_zip(entries):
+    '''Generate a ZIP archive as a sequence of byte strings.
+
+    The archive is produced as the content of the entries is read, so only
+    one chunk of it is held in memory at a time. Entries are stored without
+    compression, since most large files are compressed already.
+
+    Parameter:
+    entries : iterable of (name, date, chunks) tuples, where name is the
+              path inside the archive, date is a datetime or None, and
+              chunks is an iterable of byte strings; for folders, name ends
+              with '/' and chunks is None
+    '''
+    output = _ZipOutput()
+    with zipfile.ZipFile(output, 'w') as archive:
+        for name, date, chunks in entries:
+            info = zipfile.ZipInfo(name)
+            if date is not None and date.year >= 1980:
+                info.date_time = date.timetuple()[:6]
+            if chunks is None:
+                info.external_attr = 0o40775 << 16 | 0x10
+                archive.writestr(info, b'')
+            else:
+                info.external_attr = 0o644 << 16
+                with archive.open(info, 'w', force_zip64=True) as member:
+                    for chunk in chunks:
+                        member.write(chunk)
+                        yield from output.collect()
+            yield from output.collect()
+    yield from output.collect()